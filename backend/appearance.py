@@ -0,0 +1,293 @@
+import re
+from functools import lru_cache
+
+from pdfrw.objects import PdfArray, PdfDict, PdfName
+
+# Standard 14 Helvetica advance widths (1/1000 em) for printable ASCII 32-126
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+    1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+    667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+    333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+    556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+]
+DEFAULT_WIDTH = 556
+
+# Field flags (PDF 32000-1, 12.7.4)
+FLAG_MULTILINE = 1 << 12
+FLAG_RADIO = 1 << 15
+FLAG_PUSHBUTTON = 1 << 16
+FLAG_COMB = 1 << 24
+
+BORDER_PADDING = 2.0
+MAX_AUTO_FONT_SIZE = 12.0
+MIN_AUTO_FONT_SIZE = 4.0
+
+# Values that switch a checkbox on when the form data is free text
+TRUTHY_VALUES = {'yes', 'y', 'true', 'on', 'x', '1', 'checked'}
+
+_DA_FONT = re.compile(r'/([^\s/]+)\s+([\d.]+)\s+Tf')
+
+
+@lru_cache(maxsize=None)
+def glyph_widths(base_font):
+    """
+    Get the 256-entry advance width table (1/1000 em) for a base font.
+
+    Only Helvetica metrics are bundled; other fonts fall back to them, which
+    is close enough for fitting text into a field.
+    """
+    table = [DEFAULT_WIDTH] * 256
+    table[32:127] = HELVETICA_WIDTHS
+    return tuple(table)
+
+
+@lru_cache(maxsize=256)
+def scaled_widths(base_font, size):
+    """
+    Get the width table for a font at one size, in points.
+    """
+    return tuple(width * size / 1000.0 for width in glyph_widths(base_font))
+
+
+@lru_cache(maxsize=4096)
+def text_width(text, base_font, size):
+    """
+    Measure a WinAnsi-encoded string at a font size, in points.
+    """
+    widths = scaled_widths(base_font, size)
+    return sum(widths[ord(ch) & 0xFF] for ch in text)
+
+
+def to_win_ansi(text):
+    """
+    Convert text to the single-byte encoding used by the standard fonts.
+    """
+    return text.encode('cp1252', 'replace').decode('latin-1')
+
+
+def escape_text(text):
+    return text.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def parse_da(da):
+    """
+    Split a default appearance string like '/Helv 0 Tf 0 g' into
+    (font resource name, size, remaining operators such as the colour).
+    """
+    da = str(da or '').strip('()')
+    match = _DA_FONT.search(da)
+    if match is None:
+        return 'Helv', 0.0, '0 g'
+    color = (da[:match.start()] + da[match.end():]).strip() or '0 g'
+    return match.group(1), float(match.group(2)), color
+
+
+def wrap_lines(text, base_font, size, max_width):
+    """
+    Greedily wrap text into lines no wider than max_width.
+    """
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split(' '):
+            candidate = word if not line else line + ' ' + word
+            if line and text_width(candidate, base_font, size) > max_width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    return lines
+
+
+def _rect(widget):
+    x1, y1, x2, y2 = (float(v) for v in widget.Rect)
+    return abs(x2 - x1), abs(y2 - y1)
+
+
+class AppearanceBuilder:
+    """
+    Builds appearance streams for the widgets of one template.
+
+    Font resources and checkbox on/off streams are created once per template
+    and shared by every widget and every fill that uses them; text streams
+    are built per value using cached glyph-width tables.
+    """
+
+    def __init__(self, template):
+        self.template = template
+        acroform = template.Root.AcroForm
+        self.default_da = acroform.DA if acroform is not None else None
+        self.dr_fonts = acroform.DR.Font if acroform is not None and acroform.DR is not None else None
+        self._fonts = {}
+        self._checkbox_streams = {}
+
+    def font(self, name, base_font='Helvetica'):
+        """
+        Get the font dictionary for a DA font name, from the form's default
+        resources or a new standard-14 font.
+        """
+        if name not in self._fonts:
+            font = self.dr_fonts[PdfName(name)] if self.dr_fonts is not None else None
+            if font is None:
+                font = PdfDict(
+                    Type=PdfName.Font,
+                    Subtype=PdfName.Type1,
+                    BaseFont=PdfName(base_font),
+                    Encoding=PdfName.WinAnsiEncoding
+                )
+                font.indirect = True
+            self._fonts[name] = font
+        return self._fonts[name]
+
+    def _xobject(self, stream, width, height, font_name, font):
+        xobject = PdfDict(
+            Type=PdfName.XObject,
+            Subtype=PdfName.Form,
+            BBox=PdfArray([0, 0, round(width, 3), round(height, 3)]),
+            Resources=PdfDict(Font=PdfDict(**{font_name: font}))
+        )
+        xobject.stream = stream
+        return xobject
+
+    def text_appearance(self, widget, value):
+        """
+        Build the normal appearance stream showing a text (or choice) value.
+
+        Args:
+            widget (PdfDict): The widget annotation
+            value (str): The value to show
+
+        Returns:
+            PdfDict: Form XObject for the widget's /AP /N
+        """
+        inherited = widget.inheritable
+        font_name, size, color = parse_da(inherited.DA or self.default_da)
+        font = self.font(font_name)
+        base_font = str(font.BaseFont or '/Helvetica')[1:]
+        flags = int(inherited.Ff or 0)
+        width, height = _rect(widget)
+        inner_width = max(width - 2 * BORDER_PADDING, 1.0)
+        text = to_win_ansi(value)
+
+        multiline = bool(flags & FLAG_MULTILINE)
+        if size == 0:
+            # Auto size: fill the field height, then shrink until it fits
+            size = MAX_AUTO_FONT_SIZE if multiline else min(MAX_AUTO_FONT_SIZE, (height - 2 * BORDER_PADDING) / 1.15)
+            if not multiline:
+                while size > MIN_AUTO_FONT_SIZE and text_width(text, base_font, size) > inner_width:
+                    size -= 0.5
+            size = max(size, MIN_AUTO_FONT_SIZE)
+
+        alignment = int(inherited.Q or 0)
+        leading = size * 1.15
+        lines = wrap_lines(text, base_font, size, inner_width) if multiline else [text]
+
+        ops = ['/Tx BMC', 'q', f'{BORDER_PADDING} {BORDER_PADDING} {inner_width:.2f} {height - 2 * BORDER_PADDING:.2f} re W n',
+               'BT', f'/{font_name} {size:.2f} Tf', color]
+
+        if multiline:
+            y = height - BORDER_PADDING - size
+        else:
+            # Centre the glyphs vertically (descender is about 0.21 em)
+            y = (height - size) / 2 + 0.21 * size
+
+        comb_max = inherited.MaxLen
+        if flags & FLAG_COMB and comb_max and not multiline:
+            # Comb fields space characters evenly across MaxLen cells
+            cell = width / int(comb_max)
+            for i, ch in enumerate(text[:int(comb_max)]):
+                x = cell * i + (cell - text_width(ch, base_font, size)) / 2
+                ops.append(f'1 0 0 1 {x:.2f} {y:.2f} Tm ({escape_text(ch)}) Tj')
+        else:
+            for line in lines:
+                line_width = text_width(line, base_font, size)
+                if alignment == 1:
+                    x = (width - line_width) / 2
+                elif alignment == 2:
+                    x = width - BORDER_PADDING - line_width
+                else:
+                    x = BORDER_PADDING
+                ops.append(f'1 0 0 1 {x:.2f} {y:.2f} Tm ({escape_text(line)}) Tj')
+                y -= leading
+
+        ops.extend(['ET', 'Q', 'EMC'])
+        return self._xobject('\n'.join(ops), width, height, font_name, font)
+
+    def checkbox_appearances(self, widget, on_state):
+        """
+        Get on/off appearance streams for a button widget without usable ones.
+
+        Streams are shared by every widget of the same size in the template.
+
+        Args:
+            widget (PdfDict): The widget annotation
+            on_state (str): Name of the on state (without the slash)
+
+        Returns:
+            PdfDict: Appearance dictionary with /N holding both states
+        """
+        width, height = _rect(widget)
+        key = (round(width, 2), round(height, 2))
+        if key not in self._checkbox_streams:
+            font = self.font('ZaDb', 'ZapfDingbats')
+            size = min(width, height) * 0.8
+            # ZapfDingbats '4' is the check mark (advance 0.76 em)
+            x = (width - 0.76 * size) / 2
+            y = (height - size) / 2 + 0.15 * size
+            on = self._xobject(
+                f'q BT /ZaDb {size:.2f} Tf 0 g {x:.2f} {y:.2f} Td (4) Tj ET Q',
+                width, height, 'ZaDb', font
+            )
+            on.indirect = True
+            off = self._xobject('', width, height, 'ZaDb', font)
+            off.indirect = True
+            self._checkbox_streams[key] = (on, off)
+
+        on, off = self._checkbox_streams[key]
+        return PdfDict(N=PdfDict(**{on_state: on, 'Off': off}))
+
+
+def get_appearance_builder(template):
+    """
+    Get the template's appearance builder, creating it on first use.
+    """
+    builder = template.private.__dict__.get('appearance_builder')
+    if builder is None:
+        builder = AppearanceBuilder(template)
+        template.private.appearance_builder = builder
+    return builder
+
+
+def on_states(widget):
+    """
+    List a button widget's on-state names (without the slash).
+    """
+    normal = widget.AP.N if widget.AP is not None else None
+    if normal is None or not hasattr(normal, 'keys'):
+        return []
+    return [str(state)[1:] for state in normal.keys() if state != '/Off']
+
+
+def choose_state(value, states):
+    """
+    Pick the on state a form value selects, or None for off.
+
+    Accepts the state name itself, a prefix of it ('Yes' for 'YES_2'), or
+    a truthy word when the button has a single on state.
+    """
+    text = str(value).strip()
+    lowered = text.lower()
+    for state in states:
+        if state == text or state.lower() == lowered:
+            return state
+    for state in states:
+        if lowered and state.lower().startswith(lowered):
+            return state
+    if len(states) == 1 and lowered in TRUTHY_VALUES:
+        return states[0]
+    if not states and lowered in TRUTHY_VALUES:
+        return 'Yes'
+    return None
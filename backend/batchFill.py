@@ -0,0 +1,175 @@
+import logging
+import multiprocessing
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from fieldSchema import get_schema
+from fillPDF import fill_template, get_cached_template, restore_template
+from templateWriter import iter_incremental_update, supports_incremental_update
+
+logger = logging.getLogger(__name__)
+
+
+class TemplatePool:
+    """
+    Parsed templates kept pristine between fills.
+
+    Each template is parsed and serialized once per process (in the
+    get_cached_template() cache that single fills share). A fill mutates
+    only the widgets named in the record, only those objects are
+    re-serialized and spliced into the cached document, and the widgets are
+    then put back, so the next record starts from the original template
+    without re-reading or re-writing it.
+    """
+
+    def get(self, pdf_path):
+        """
+        Get the parsed template for a PDF, parsing it on first use.
+
+        Args:
+            pdf_path (str): Path to the PDF form
+
+        Returns:
+            PreparedTemplate: The parsed and pre-serialized template
+        """
+        cached, _ = get_cached_template(pdf_path)
+        prepared = cached.prepared
+        # Warm the schema registry from the parse we already have
+        get_schema(pdf_path, prepared.template)
+        return prepared
+
+    def fill_to_bytes(self, pdf_path, form_data, incremental=False):
+        """
+        Fill one record into a template and serialize the result.
+
+        Args:
+            pdf_path (str): Path to the PDF form
+            form_data (dict): Dictionary with field names as keys and values to fill
+            incremental (bool): Append the changed objects to the original
+                file instead of rewriting it (falls back to a rewrite for
+                files that cannot take an update)
+
+        Returns:
+            bytes: The filled PDF
+        """
+        cached, _ = get_cached_template(pdf_path)
+        with cached.lock:
+            _, touched = fill_template(cached.template, form_data)
+            try:
+                changed = [annotation for annotation, _ in touched]
+                if incremental and supports_incremental_update(cached.data, cached.template):
+                    return b''.join(iter_incremental_update(cached.data, cached.template, changed))
+                return cached.prepared.render(changed)
+            finally:
+                restore_template(touched)
+
+
+# Per-process pool used by the batch workers
+_worker_pool = None
+
+
+def _init_worker():
+    global _worker_pool
+    # Templates are parsed on their first job, so the parent never needs
+    # the whole job list up front
+    _worker_pool = TemplatePool()
+
+
+def _fill_job(job, output_dir, incremental):
+    """
+    Fill one (template_path, form_data, output_name) job in a worker.
+
+    Writes straight to output_dir when given (returning the path), otherwise
+    returns the bytes for the parent to stream into a zip.
+    """
+    pdf_path, form_data, output_name = job
+    data = _worker_pool.fill_to_bytes(pdf_path, form_data, incremental)
+    if output_dir is None:
+        return output_name, data
+    output_path = os.path.join(output_dir, output_name)
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return output_name, output_path
+
+
+def _fill_chunk(jobs, output_dir, incremental):
+    return [_fill_job(job, output_dir, incremental) for job in jobs]
+
+
+def _chunked(jobs, size):
+    chunk = []
+    for job in jobs:
+        chunk.append(job)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def fill_batch(jobs, output_dir=None, zip_path=None, workers=None, chunk_size=16, max_pending=None,
+               zip_compression=zipfile.ZIP_STORED, incremental=True):
+    """
+    Fill many records across a process pool.
+
+    Jobs are read lazily, chunk by chunk, so a generator over a month-end
+    run is never held in memory; at most max_pending chunks are in flight.
+
+    Args:
+        jobs (iterable): (template_path, form_data, output_name) tuples
+        output_dir (str): Directory to write each filled PDF to
+        zip_path (str): Zip archive to stream the filled PDFs into instead
+        workers (int): Worker processes (defaults to the CPU count)
+        chunk_size (int): Jobs handed to a worker at a time
+        max_pending (int): Chunks in flight at once (bounds memory on huge runs)
+        zip_compression (int): zipfile compression for zip output (stored by default, deflate is CPU-bound)
+        incremental (bool): Write each PDF as the original file plus an
+            incremental update of the changed objects, instead of a full rewrite
+
+    Returns:
+        dict: Number of PDFs filled, elapsed seconds and PDFs per second
+    """
+    if (output_dir is None) == (zip_path is None):
+        raise ValueError("Specify exactly one of output_dir or zip_path")
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+
+    start = time.perf_counter()
+    filled = 0
+    archive = zipfile.ZipFile(zip_path, 'w', zip_compression) if zip_path else None
+    try:
+        # Spawn rather than fork: the caller may have torch, faiss or an
+        # event loop's threads running, none of which is fork-safe
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+            pending = []
+            chunks = _chunked(jobs, chunk_size)
+
+            def drain(limit):
+                nonlocal filled
+                while len(pending) > limit:
+                    for output_name, result in pending.pop(0).result():
+                        if archive is not None:
+                            archive.writestr(output_name, result)
+                        filled += 1
+
+            for chunk in chunks:
+                pending.append(pool.submit(_fill_chunk, chunk, output_dir, incremental))
+                drain(max_pending)
+            drain(0)
+    finally:
+        if archive is not None:
+            archive.close()
+
+    elapsed = time.perf_counter() - start
+    logger.info("Filled %d PDFs in %.2fs", filled, elapsed)
+    return {
+        "filled": filled,
+        "seconds": elapsed,
+        "pdfs_per_second": filled / elapsed if elapsed else None,
+    }
@@ -0,0 +1,351 @@
+import argparse
+import cProfile
+import glob
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import pstats
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarkFill import make_records
+from togetherClient import run_sync
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PDF_DIR = os.path.join(os.path.dirname(__file__), '../public/pdfs')
+STAGES = ("ingest", "retrieve", "qa", "qa_stream", "fill", "chat")
+
+QUESTIONS = [
+    "What is the permit fee?",
+    "Do I need plan submittal?",
+    "Who must sign the application?",
+    "What is a PE code?",
+]
+
+CHAT_SCRIPT = [
+    "Acme Foods",
+    "You can reach us at 775-555-1234",
+    "123 Main St Suite 4",
+    "Reno",
+    "89501",
+    "info@acmefoods.com",
+    "about 1,200 sq ft",
+]
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, wall_seconds):
+    """
+    Summarise per-operation latencies.
+
+    Args:
+        latencies (list): Seconds per operation
+        wall_seconds (float): Wall time for all operations
+
+    Returns:
+        dict: Count, mean/p50/p95/p99/max in milliseconds and operations per second
+    """
+    values = sorted(latencies)
+    to_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "count": len(values),
+        "mean_ms": to_ms(sum(values) / len(values)) if values else None,
+        "p50_ms": to_ms(percentile(values, 0.50)),
+        "p95_ms": to_ms(percentile(values, 0.95)),
+        "p99_ms": to_ms(percentile(values, 0.99)),
+        "max_ms": to_ms(values[-1]) if values else None,
+        "ops_per_second": round(len(values) / wall_seconds, 2) if wall_seconds else None,
+    }
+
+
+def make_benchmark_embeddings(kind):
+    """
+    Create the embeddings model for a run: 'fake' is deterministic and
+    offline, 'minilm' is the production model.
+    """
+    if kind == "fake":
+        from langchain_community.embeddings import DeterministicFakeEmbedding
+        return DeterministicFakeEmbedding(size=384)
+    from sharedModels import get_embeddings
+    return get_embeddings()
+
+
+def _chatbot(config, cache_dir):
+    from indexCache import IndexCache
+    from processPDF import PDFChatBot
+    from responseCache import SemanticResponseCache
+
+    # No response cache, so every question pays for retrieval and generation
+    return PDFChatBot(config["api_key"], api_url=config["api_url"], index_cache=IndexCache(cache_dir),
+                      embeddings=make_benchmark_embeddings(config["embeddings"]),
+                      response_cache=SemanticResponseCache(max_entries=0))
+
+
+def _ingest(config, pdf_paths, measure):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for _ in range(config["iterations"]):
+            # A fresh bot and index cache per pass keeps every load cold
+            bot = _chatbot(config, tempfile.mkdtemp(dir=cache_dir))
+            for pdf_path in pdf_paths:
+                measure(lambda: bot.load_pdf(pdf_path))
+
+
+def _retrieve(config, pdf_paths, measure):
+    from fieldSchema import form_id_for
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        bot = _chatbot(config, cache_dir)
+        bot.load_corpus(config["pdf_dir"])
+        for _ in range(config["iterations"]):
+            for pdf_path in pdf_paths:
+                for question in QUESTIONS:
+                    measure(lambda: bot.retrieve(question, form_id=form_id_for(pdf_path)))
+
+
+def _qa(config, pdf_paths, measure, stream=False):
+    from fieldSchema import form_id_for
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        bot = _chatbot(config, cache_dir)
+        bot.load_corpus(config["pdf_dir"])
+        for _ in range(config["iterations"]):
+            for pdf_path in pdf_paths:
+                form_id = form_id_for(pdf_path)
+                for question in QUESTIONS:
+                    if stream:
+                        measure(lambda: "".join(bot.stream_question(question, form_id=form_id)))
+                    else:
+                        measure(lambda: bot.ask_question(question, form_id=form_id))
+
+
+def _qa_stream(config, pdf_paths, measure):
+    _qa(config, pdf_paths, measure, stream=True)
+
+
+def _fill(config, pdf_paths, measure):
+    from fillPDF import fill_pdf_form
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for pdf_path in pdf_paths:
+            records = make_records(pdf_path, config["iterations"])
+            output_path = os.path.join(output_dir, os.path.basename(pdf_path))
+            for form_data in records:
+                measure(lambda: fill_pdf_form(pdf_path, output_path, form_data))
+
+
+def _chat(config, pdf_paths, measure):
+    from chatForData import SimpleChatBot
+
+    for _ in range(config["iterations"]):
+        bot = SimpleChatBot(config["api_key"], api_url=config["api_url"])
+        for message in CHAT_SCRIPT:
+            measure(lambda: bot.get_response(message))
+
+
+_STAGE_RUNNERS = {
+    "ingest": _ingest,
+    "retrieve": _retrieve,
+    "qa": _qa,
+    "qa_stream": _qa_stream,
+    "fill": _fill,
+    "chat": _chat,
+}
+
+
+def run_stage(stage, config):
+    """
+    Run one benchmark stage and summarise it.
+
+    Runs in a fresh process per stage (see run_benchmarks), so the peak
+    RSS reported is the stage's own.
+
+    Args:
+        stage (str): One of STAGES
+        config (dict): Run settings (pdf_dir, iterations, embeddings, api_url, api_key, profile_dir)
+
+    Returns:
+        dict: Latency summary, peak RSS and, when profiling, the hottest functions
+    """
+    logging.basicConfig(level=logging.WARNING)
+    pdf_paths = sorted(glob.glob(os.path.join(config["pdf_dir"], "*.pdf")))
+    latencies = []
+    profiler = cProfile.Profile() if config.get("profile_dir") else None
+
+    def measure(operation):
+        if profiler is not None:
+            profiler.enable()
+        start = time.perf_counter()
+        try:
+            operation()
+        finally:
+            latencies.append(time.perf_counter() - start)
+            if profiler is not None:
+                profiler.disable()
+
+    start = time.perf_counter()
+    _STAGE_RUNNERS[stage](config, pdf_paths, measure)
+    result = summarize(latencies, sum(latencies))
+    result["stage_seconds"] = round(time.perf_counter() - start, 3)
+    result["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    if profiler is not None:
+        os.makedirs(config["profile_dir"], exist_ok=True)
+        profile_path = os.path.join(config["profile_dir"], f"{stage}.prof")
+        profiler.dump_stats(profile_path)
+        stats = pstats.Stats(profiler, stream=io.StringIO())
+        result["profile"] = profile_path
+        result["hot_functions"] = [
+            {"function": f"{os.path.basename(filename)}:{line}({name})",
+             "cumulative_s": round(cumulative, 4), "calls": calls}
+            for (filename, line, name), (_, calls, _, cumulative, _) in sorted(
+                stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:15]
+        ]
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(stages, config):
+    """
+    Run stages one after another, each in its own spawned process.
+
+    Returns:
+        dict: Run metadata and per-stage results
+    """
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for stage in stages:
+        with context.Pool(1) as pool:
+            results[stage] = pool.apply(run_stage, (stage, config))
+        logger.info("%s: p50 %.1f ms, p95 %.1f ms, %s ops/s", stage, results[stage]["p50_ms"] or 0,
+                    results[stage]["p95_ms"] or 0, results[stage]["ops_per_second"])
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "pdfs": len(glob.glob(os.path.join(config["pdf_dir"], "*.pdf"))),
+            "iterations": config["iterations"],
+            "embeddings": config["embeddings"],
+            "llm": "stub" if config["stub"] else config["api_url"],
+        },
+        "stages": results,
+    }
+
+
+def compare_results(baseline, current, threshold=0.10, metrics=("p50_ms", "p95_ms")):
+    """
+    Compare two runs stage by stage.
+
+    Args:
+        baseline (dict): Earlier run_benchmarks() output
+        current (dict): Newer run_benchmarks() output
+        threshold (float): Relative slowdown counted as a regression
+        metrics (tuple): Latency metrics to compare
+
+    Returns:
+        tuple: (rows of (stage, metric, baseline, current, relative change), regressions)
+    """
+    rows = []
+    regressions = []
+    for stage, result in current["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if before is None:
+            continue
+        for metric in metrics:
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            rows.append((stage, metric, old, new, change))
+            if change > threshold:
+                regressions.append((stage, metric, old, new, change))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ingest, retrieval, Q&A, fill and chat")
+    parser.add_argument("--pdf-dir", default=DEFAULT_PDF_DIR)
+    parser.add_argument("--stages", default=",".join(STAGES), help="Comma-separated subset of " + ",".join(STAGES))
+    parser.add_argument("--iterations", type=int, default=3)
+    parser.add_argument("--embeddings", default="fake", choices=["fake", "minilm"],
+                        help="'fake' is deterministic and needs no model download")
+    parser.add_argument("--api-url", default=None, help="Inference endpoint (defaults to a local stub server)")
+    parser.add_argument("--stub-latency", type=float, default=0.05, help="Seconds the stub waits before answering")
+    parser.add_argument("--profile", default=None, metavar="DIR",
+                        help="Write a cProfile .prof per stage to DIR (for hot paths across processes, "
+                             "run under py-spy record --subprocesses instead)")
+    parser.add_argument("--output", default=None, help="Write results as JSON")
+    parser.add_argument("--compare", default=None, help="Baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative slowdown that fails --compare")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stages = [stage.strip() for stage in args.stages.split(",") if stage.strip()]
+    unknown = [stage for stage in stages if stage not in STAGES]
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(unknown)}")
+
+    runner = None
+    api_url = args.api_url
+    if api_url is None:
+        from stubServer import start_stub_server
+        runner, api_url = run_sync(start_stub_server(latency=args.stub_latency))
+    config = {
+        "pdf_dir": args.pdf_dir,
+        "iterations": args.iterations,
+        "embeddings": args.embeddings,
+        "api_url": api_url,
+        "api_key": os.environ.get("TOGETHER_API_KEY", "offline"),
+        "stub": args.api_url is None,
+        "profile_dir": args.profile,
+    }
+    try:
+        results = run_benchmarks(stages, config)
+    finally:
+        if runner is not None:
+            run_sync(runner.cleanup())
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        rows, regressions = compare_results(baseline, results, args.threshold)
+        print(f"\nAgainst {args.compare} (commit {baseline.get('meta', {}).get('commit')}):")
+        for stage, metric, old, new, change in rows:
+            flag = "  REGRESSION" if change > args.threshold else ""
+            print(f"  {stage:<10} {metric:<7} {old:>10.2f} -> {new:>10.2f} ({change:+.1%}){flag}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
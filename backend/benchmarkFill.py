@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from pdfrw import PdfReader, PdfWriter
+
+from batchFill import fill_batch
+from fieldSchema import get_schema
+from fillPDF import fill_pdf_form, fill_template
+
+DEFAULT_TEMPLATE = os.path.join(os.path.dirname(__file__), '../public/pdfs', 'FoodHealthPermitApplicationFillable.pdf')
+
+
+def make_records(pdf_path, count):
+    """
+    Generate synthetic records that fill every text field of a template.
+
+    Args:
+        pdf_path (str): Path to the PDF form
+        count (int): Number of records
+
+    Returns:
+        list: form_data dicts
+    """
+    names = get_schema(pdf_path).names(field_type='Tx')
+    return [{name: f"Value {i}" for name in names} for i in range(count)]
+
+
+def _timed(fill, records):
+    start = time.perf_counter()
+    for i, form_data in enumerate(records):
+        fill(i, form_data)
+    elapsed = time.perf_counter() - start
+    return {"filled": len(records), "seconds": elapsed, "pdfs_per_second": len(records) / elapsed}
+
+
+def benchmark_uncached(pdf_path, records, output_dir):
+    """
+    Baseline: the original per-call fill, which parses the template with a
+    new PdfReader and rewrites the whole document with PdfWriter for every
+    record (with the same field filling as the other paths).
+    """
+    def fill(i, form_data):
+        template = PdfReader(pdf_path)
+        fill_template(template, form_data)
+        PdfWriter().write(os.path.join(output_dir, f"uncached-{i}.pdf"), template)
+
+    return _timed(fill, records)
+
+
+def benchmark_loop(pdf_path, records, output_dir):
+    """
+    Call fill_pdf_form once per record (reuses the cached parsed template).
+    """
+    return _timed(lambda i, form_data: fill_pdf_form(pdf_path, os.path.join(output_dir, f"loop-{i}.pdf"), form_data),
+                  records)
+
+
+def benchmark_batch(pdf_path, records, output_dir, workers=None, zip_output=False, incremental=True):
+    """
+    Fill the same records through the batch engine.
+    """
+    jobs = ((pdf_path, form_data, f"batch-{i}.pdf") for i, form_data in enumerate(records))
+    if zip_output:
+        return fill_batch(jobs, zip_path=os.path.join(output_dir, "batch.zip"), workers=workers,
+                          incremental=incremental)
+    return fill_batch(jobs, output_dir=output_dir, workers=workers, incremental=incremental)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the original per-call fill and looped fill_pdf_form "
+                                                 "against the batch fill engine")
+    parser.add_argument("--template", default=DEFAULT_TEMPLATE)
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--baseline-records", type=int, default=100)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--zip", action="store_true", help="Stream batch output into a zip")
+    parser.add_argument("--rewrite", action="store_true",
+                        help="Batch writes full rewrites instead of incremental updates")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        baseline_records = make_records(args.template, args.baseline_records)
+        uncached = benchmark_uncached(args.template, baseline_records, output_dir)
+        loop = benchmark_loop(args.template, baseline_records, output_dir)
+        batch = benchmark_batch(args.template, make_records(args.template, args.records), output_dir,
+                                workers=args.workers, zip_output=args.zip, incremental=not args.rewrite)
+
+    print(json.dumps({
+        "template": os.path.basename(args.template),
+        "uncached": uncached,
+        "loop": loop,
+        "batch": batch,
+        "speedup_vs_uncached": batch["pdfs_per_second"] / uncached["pdfs_per_second"],
+        "speedup_vs_loop": batch["pdfs_per_second"] / loop["pdfs_per_second"],
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import argparse
+import glob
+import json
+import os
+import resource
+import time
+
+from ingestPipeline import IngestPipeline, make_embeddings
+from sharedModels import DEFAULT_EMBEDDING_BACKEND
+
+DEFAULT_PDF_DIR = os.path.join(os.path.dirname(__file__), '../public/pdfs')
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process and its finished children, in MB.
+    """
+    # ru_maxrss is reported in kilobytes on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"self": own / 1024, "children": children / 1024}
+
+
+def benchmark_ingest(pdf_paths, embeddings, workers=None, batch_size=64, chunk_size=1000, chunk_overlap=200,
+                     chunker="text"):
+    """
+    Run the ingest pipeline over a set of PDFs, bypassing the index cache.
+
+    Args:
+        pdf_paths (list): PDFs to ingest
+        embeddings: Embeddings model exposing embed_documents()
+        workers (int): Extraction processes
+        batch_size (int): Chunks per embedding batch
+        chunk_size (int): Characters per chunk
+        chunk_overlap (int): Characters shared by neighbouring chunks
+        chunker (str): 'text' or 'layout'
+
+    Returns:
+        dict: Timings, chunk counts, throughput and peak RSS
+    """
+    pipeline = IngestPipeline(chunk_size, chunk_overlap, workers=workers, batch_size=batch_size, chunker=chunker)
+
+    start = time.perf_counter()
+    results = pipeline.run(pdf_paths, embeddings)
+    elapsed = time.perf_counter() - start
+
+    chunks = sum(len(chunks) for chunks, _ in results.values())
+    return {
+        "pdfs": len(pdf_paths),
+        "workers": pipeline.workers,
+        "batch_size": batch_size,
+        "chunker": chunker,
+        "chunks": chunks,
+        "chunk_chars": sum(len(chunk.page_content) for chunks, _ in results.values() for chunk in chunks),
+        "unique_chunks": pipeline.stats["unique_chunks"],
+        "extract_seconds": round(pipeline.stats["extract_seconds"], 4),
+        "embed_seconds": round(pipeline.stats["embed_seconds"], 4),
+        "total_seconds": round(elapsed, 4),
+        "chunks_per_second": round(chunks / elapsed, 2) if elapsed else None,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure PDF ingestion throughput")
+    parser.add_argument("--pdf-dir", default=DEFAULT_PDF_DIR)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--backend", default=DEFAULT_EMBEDDING_BACKEND, choices=["torch", "onnx", "onnx-qint8"],
+                        help="The onnx backends need optimum[onnxruntime]")
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--chunker", default="layout", choices=["text", "layout"])
+    args = parser.parse_args()
+
+    pdf_paths = sorted(glob.glob(os.path.join(args.pdf_dir, "*.pdf")))
+    embeddings = make_embeddings(args.model, backend=args.backend, batch_size=args.batch_size)
+
+    result = benchmark_ingest(pdf_paths, embeddings, workers=args.workers, batch_size=args.batch_size,
+                              chunker=args.chunker)
+    result["backend"] = args.backend
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,68 @@
-import requests
+import asyncio
 import json
+import logging
+import os
+from fieldSchema import get_schema
+from formState import FormExtractor, FormState
+from instrumentation import metrics
+from promptBuilder import PromptBuilder, count_tokens
+from togetherClient import DEFAULT_API_URL, TogetherAPIError, TogetherClient, iterate_sync, run_sync
 
-# data needed (replace with dynamically read PDF data)
-dataWeNeed = {
-    '(Name of Business DBA)': None,
-    '(Business Phone)': None,
-    '(Business Address include street directions and suite number if applicable)': None,
-    '(City)': None,
-    '(Zip)': None,
-    '(Business EMail)': None,
-    '(Square Footage)': None,
-}
-# Note: We need to exit loop after it gets all the info, or else it repeats itself
+logger = logging.getLogger(__name__)
+
+# Form the chatbot gathers data for
+FORM_PDF_PATH = os.path.join(os.path.dirname(__file__), '../public/pdfs', 'FoodHealthPermitApplicationFillable.pdf')
+
+# Applicant-facing fields to ask about; the rest of the form is office use.
+# Names are checked against the form's extracted field schema.
+QUESTION_FIELDS = [
+    '(Name of Business DBA)',
+    '(Business Phone)',
+    '(Business Address include street directions and suite number if applicable)',
+    '(City)',
+    '(Zip)',
+    '(Business EMail)',
+    '(Square Footage)',
+]
+
+# Sent instead of another question once every field has a value
+COMPLETE_MESSAGE = "Thanks, I have all the information I need for your permit form."
+
+def build_data_we_need(pdf_path, field_names=None):
+    """
+    Build the dictionary of fields the chatbot needs to collect, from the
+    form's field schema rather than a hand-written copy of its field names.
+    
+    Args:
+        pdf_path (str): Path to the PDF form
+        field_names (list): Fields to ask about (defaults to every text field)
+        
+    Returns:
+        dict: Field names mapped to None (not yet provided)
+    """
+    schema = get_schema(pdf_path)
+    if field_names is None:
+        field_names = schema.names(field_type='Tx')
+    
+    for name in field_names:
+        if name not in schema:
+            logger.warning("Field %s is not in form %s", name, pdf_path)
+    
+    return {name: None for name in field_names if name in schema}
 
 class SimpleChatBot:
-    def __init__(self, together_api_key, model_name="meta-llama/Llama-3.2-3B-Instruct-Turbo"):
+    def __init__(self, together_api_key, model_name="meta-llama/Llama-3.2-3B-Instruct-Turbo", pdf_path=FORM_PDF_PATH, field_names=QUESTION_FIELDS, api_url=None, client=None, history_budget=512):
         self.api_key = together_api_key
         self.model_name = model_name
-        self.api_url = "https://api.together.xyz/inference"
-        self.headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
+        # TOGETHER_API_URL lets the bot run against stubServer locally
+        self.api_url = api_url or os.environ.get("TOGETHER_API_URL", DEFAULT_API_URL)
+        self.client = client or TogetherClient(together_api_key, api_url=self.api_url)
         self.conversation = []
+        self.data_we_need = build_data_we_need(pdf_path, field_names)
+        # Values collected so far, updated from each new message
+        self.state = FormState(self.data_we_need)
+        self.extractor = FormExtractor(self.client, model_name)
+        self.prompt_builder = PromptBuilder(history_budget=history_budget)
         self.max_history = 20
         self.debug = False
 
@@ -38,99 +78,43 @@ class SimpleChatBot:
 
     def analyze_personal_info(self):
         """
-        Analyze conversation history to extract personal information.
+        Get the form data collected so far.
+        
+        Kept for callers of the old conversation-analysis API; values are now
+        recorded in self.state as each message arrives, so this is the same
+        as self.state.filled().
         """
-        # Convert conversation history to a numbered format
-        history = "\n".join([
-            f"{i}. {msg['role']}: {msg['content']}"
-            for i, msg in enumerate(self.conversation, 1)
-        ])
-
-        # Construct prompt to extract and populate form data from the conversation
-        analysis_prompt = (
-            "Based on the following conversation history, extract relevant information provided by the user "
-            "and populate the required fields in a Python dictionary. Only include information explicitly mentioned by the user, "
-            "and leave fields as None if they were not discussed in the conversation history. Format the response as a "
-            "valid Python dictionary with only the keys listed below.\n"
-            f"\n{dataWeNeed}\n\n"
-            f"Conversation history:\n{history}\n\n"
-            "Dictionary format:\n"
-            "{\n"
-            "    '(Name of Business DBA)': 'Example Business',\n"
-            "    '(Business Phone)': '(555) 123-4567',\n"
-            "    '(Business Address include street directions and suite number if applicable)': '123 Main St, Suite 101',\n"
-            "    '(City)': 'Los Angeles',\n"
-            "    '(Zip)': '90001',\n"
-            "    '(Business EMail)': 'example@business.com',\n"
-            "    '(Square Footage)': '2000'\n"
-            "}\n\n"
-            "Populate the dictionary based on the conversation history and return ONLY the Python dictionary, with values filled in if mentioned by the user.\n\n"
-            "Dictionary of user's form data:"
-        )
-
-
-        payload = {
-            "model": self.model_name,
-            "prompt": analysis_prompt,
-            "max_tokens": 100,
-            "temperature":0.3,  # Decrease temperature to reduce randomness
-            "top_k":20,  # Increase top-k to reduce randomness
-            "top_p":0.9,  # Increase top-p to reduce randomness
-            "stop": ["User:", "Assistant:", "Conversation history:"]
-        }
+        return self.state.filled()
 
-        try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            
-            if 'output' in result and 'choices' in result['output']:
-                personal_info = result['output']['choices'][0]['text'].strip()
-                self.print_debug("Personal Info Analysis", personal_info)
-                return personal_info
-            else:
-                return "Error: Unexpected API response format"
-                
-        except requests.exceptions.RequestException as e:
-            return f"API Error: {str(e)}"
+    def _last_question(self):
+        for msg in reversed(self.conversation):
+            if msg['role'] == 'assistant':
+                return msg['content']
+        return None
 
-    def get_response(self, user_input):
+    def _finish(self):
+        # Every field is filled: confirm instead of asking the model for another question
+        self._add_assistant_message(COMPLETE_MESSAGE)
+        return COMPLETE_MESSAGE
+
+    def _add_user_message(self, user_input):
         # Add user input to conversation history
         self.conversation.append({"role": "user", "content": user_input})
         self.print_debug("Current Conversation History", self.conversation)
 
-        # Extract the last `max_history` messages to include in the prompt
-        messages = self.conversation[-self.max_history:]
-        history = "\n".join([
-            f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
-            for msg in messages
-        ])
-
-
-        # Filter out fields that have already been provided by the user
-        user_provided_data = {msg['content'] for msg in self.conversation if msg['role'] == 'user'}
-        remaining_data_needed = {k: v for k, v in dataWeNeed.items() if v not in user_provided_data}
-
-        # Update the prompt to only include remaining data needed
-        prompt = (
-            "You are a chatbot designed to guide users through completing a permit form, "
-            "similar to an interactive assistant like TurboTax. "
-            "Use the conversation history below and the data requirements in 'dataWeNeed' "
-            "to ask only necessary questions and gather the required information for each field.\n\n"
-            "Only ask questions about fields that haven't been provided by the user yet. "
-            "Do not repeat questions the user has already answered, and focus on one field at a time.\n\n"
-            "If all required information has been collected, acknowledge this and let the user know.\n\n"
-            f"Here are the remaining data requirements:\n{remaining_data_needed}\n\n"
-            f"Conversation history:\n{history}\n\n"
-            "Based on the above history and the remaining fields in 'dataWeNeed', "
-            "ask the user a relevant question to complete their permit form.\n"
-            "Assistant:"
-        )
+    def _response_payload(self):
+        """
+        Build the request for the assistant's next question.
+        """
+        # Only the fields the form state is still missing, with older turns
+        # summarised to keep the history within its token budget
+        prompt = self.prompt_builder.build(self.conversation, self.state)
+        metrics.inc('permitpilot_prompt_tokens_total', 'Prompt tokens sent for chat replies', count_tokens(prompt))
 
         self.print_debug("Prompt Sent to Model", prompt)
 
         # Set up payload for API request
-        payload = {
+        return {
             "model": self.model_name,
             "prompt": prompt,
             "max_tokens": 100,
@@ -141,24 +125,172 @@ class SimpleChatBot:
             "stop": ["\n", "User:", "Assistant:", "Conversation history:", "(Note:"] # ignore responses after newlines
         }
 
+    async def _areply(self):
         try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            self.print_debug("Raw API Response", result)
-
-            if 'output' in result and 'choices' in result['output']:
-                bot_response = result['output']['choices'][0]['text'].strip()
-                self.conversation.append({"role": "assistant", "content": bot_response})
-                if len(self.conversation) > self.max_history:
-                    self.conversation = self.conversation[-self.max_history:]
-                return bot_response
-            else:
-                return "Error: Unexpected API response format"
-                    
-        except requests.exceptions.RequestException as e:
+            bot_response = await self.client.complete_text(self._response_payload())
+        except TogetherAPIError as e:
             return f"API Error: {str(e)}"
 
+        self._add_assistant_message(bot_response)
+        return bot_response
+
+    def _add_assistant_message(self, bot_response):
+        self.conversation.append({"role": "assistant", "content": bot_response})
+        if len(self.conversation) > self.max_history:
+            self.conversation = self.conversation[-self.max_history:]
+
+    async def aget_response(self, user_input):
+        response, _ = await self.arespond(user_input)
+        return response
+
+    def get_response(self, user_input):
+        return run_sync(self.aget_response(user_input))
+
+    async def arespond(self, user_input):
+        """
+        Run one chat turn: record the values in the user's message and ask
+        the next question.
+        
+        Values the local validators recognise are recorded before the next
+        question is generated; if the message needs the LLM extractor, that
+        call runs concurrently with the reply.
+        
+        Args:
+            user_input (str): The user's message
+            
+        Returns:
+            tuple: (assistant response, form data collected so far)
+        """
+        question = self._last_question()
+        self._add_user_message(user_input)
+        found, remainder = self.extractor.extract_local(user_input, self.state, question)
+        self.state.update(found)
+        self.print_debug("Form State", self.state.filled())
+        
+        if self.state.is_complete:
+            return self._finish(), self.state.filled()
+        
+        if self.extractor.needs_llm(remainder, self.state):
+            response, _ = await asyncio.gather(
+                self._areply(),
+                self.extractor.aextract_llm(user_input, self.state, question)
+            )
+            if self.state.is_complete:
+                # The extractor filled the last field while the reply was generated
+                if self.conversation[-1]['role'] == 'assistant':
+                    self.conversation.pop()
+                response = self._finish()
+        else:
+            response = await self._areply()
+        return response, self.state.filled()
+
+    def respond(self, user_input):
+        return run_sync(self.arespond(user_input))
+
+    async def astream_response(self, user_input):
+        """
+        Stream the assistant's reply token by token.
+        
+        As in arespond(), a message that completes the form (whether its
+        values are found locally or by the LLM extractor) is answered with
+        the completion message instead of another question.
+        
+        The conversation only records the turn once the stream completes; if
+        the caller stops early (e.g. the client disconnected) the request is
+        cancelled, the user's message is dropped again and the values taken
+        from it are removed from the form state.
+        
+        Args:
+            user_input (str): The user's message
+            
+        Yields:
+            str: Pieces of the reply as they arrive
+        """
+        question = self._last_question()
+        self._add_user_message(user_input)
+        user_message = self.conversation[-1]
+        # Restored with the conversation if the turn does not complete
+        previous_values = dict(self.state.values)
+        found, remainder = self.extractor.extract_local(user_input, self.state, question)
+        self.state.update(found)
+        if self.state.is_complete:
+            yield self._finish()
+            return
+        
+        extraction = None
+        if self.extractor.needs_llm(remainder, self.state):
+            extraction = asyncio.ensure_future(self.extractor.aextract_llm(user_input, self.state, question))
+        payload = self._response_payload()
+        pieces = []
+        completed = False
+        stream = self.client.stream_text(payload)
+        try:
+            async for token in stream:
+                if extraction is not None:
+                    # Hold the first token until the extractor is done: if it
+                    # filled the last field, the reply is the completion message
+                    await extraction
+                    extraction = None
+                    if self.state.is_complete:
+                        break
+                if not pieces:
+                    token = token.lstrip()
+                    if not token:
+                        continue
+                pieces.append(token)
+                yield token
+            completed = True
+        except TogetherAPIError as e:
+            yield f"API Error: {str(e)}"
+        finally:
+            await stream.aclose()
+            if not completed:
+                self.conversation = [msg for msg in self.conversation if msg is not user_message]
+                if extraction is not None:
+                    extraction.cancel()
+                self.state.values.update(previous_values)
+        if completed:
+            if extraction is not None:
+                await extraction
+            if self.state.is_complete and not pieces:
+                yield self._finish()
+                return
+            self._add_assistant_message(''.join(pieces).strip())
+
+    def stream_response(self, user_input):
+        """
+        Blocking generator over astream_response(), for callers that are not async.
+        """
+        return iterate_sync(self.astream_response(user_input))
+
+    def restore_session(self, session):
+        """
+        Continue a stored session: take over its conversation and form state.
+        
+        Args:
+            session (Session): Session loaded from a session store
+        """
+        self.conversation = list(session.conversation)
+        if session.form_state is not None and session.form_state.field_names == self.state.field_names:
+            self.state = session.form_state
+        else:
+            self.state = FormState(self.data_we_need)
+
+    def save_session(self, session):
+        """
+        Copy this bot's conversation and form state into a session, to be
+        saved to a session store after the turn.
+        
+        Args:
+            session (Session): The session to update
+            
+        Returns:
+            Session: The updated session
+        """
+        session.conversation = list(self.conversation)
+        session.form_state = self.state
+        return session
+
     def show_memory(self):
         print("\n--- Current Conversation Memory ---")
         for i, msg in enumerate(self.conversation, 1):
@@ -166,7 +298,9 @@ class SimpleChatBot:
         print("--------------------------------\n")
 
 def main():
-    API_KEY = "b0222468fe741dec70c263c2db264b97a79e1b8169cc23625c314d316bf09b27"
+    API_KEY = os.environ.get("TOGETHER_API_KEY")
+    if not API_KEY:
+        raise SystemExit("Set TOGETHER_API_KEY (any value works against stubServer)")
     chatbot = SimpleChatBot(API_KEY)
     
     print("ChatBot initialized. Type 'quit' to exit.")
@@ -197,20 +331,16 @@ def main():
             print("Please enter a message.")
             continue
             
-        response = chatbot.get_response(user_input)
+        # The reply and the extraction of the new message's values run concurrently
+        response, form_data = chatbot.respond(user_input)
         print(f"Bot: {response}")
         
-        # After each response, analyze and display personal information
         print("\n--- Current Information Analysis ---")
-        personal_info = chatbot.analyze_personal_info()
-
-        # Find the position of the closing brace and trim everything after it (extra unecessary dialogue)
-        closing_brace_pos = personal_info.find('}')
-        if closing_brace_pos != -1:
-            personal_info = personal_info[:closing_brace_pos + 1]
-
-        print(personal_info)
+        print(json.dumps(form_data, indent=2))
         print("-------------------------------------\n")
+        
+        if chatbot.state.is_complete:
+            break
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
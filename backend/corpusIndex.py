@@ -0,0 +1,258 @@
+import glob
+import logging
+import os
+import threading
+
+from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from fieldSchema import form_id_for
+from hybridRetriever import HybridIndex, HybridRetriever
+from indexCache import IndexCache
+from ingestPipeline import IngestPipeline
+
+logger = logging.getLogger(__name__)
+
+
+class CorpusIndex:
+    """
+    A single FAISS index over every loaded permit form.
+
+    Each chunk carries 'form' and 'page' metadata so retrieval can be
+    restricted to one form, letting one process answer questions about any
+    template without keeping an index (or an embeddings model) per form.
+    """
+
+    def __init__(self, embeddings, embedding_model_name, chunk_size=1000, chunk_overlap=200, index_cache=None, pipeline=None,
+                 chunker="layout", retrieval="hybrid", index_type="flat", alpha=0.5, embeddings_backend=None):
+        """
+        Args:
+            embeddings: Embeddings shared by every form in the corpus
+            embedding_model_name (str): Name of the embeddings model (part of the cache key)
+            chunk_size (int): Characters per chunk
+            chunk_overlap (int): Characters shared by neighbouring chunks
+            index_cache (IndexCache): Store for per-form indexes (defaults to backend/.index_cache)
+            pipeline (IngestPipeline): Extraction/embedding pipeline for cache misses
+            chunker (str): 'layout' (sections and form fields) or 'text' (fixed-size chunks)
+            retrieval (str): 'hybrid' (BM25 and embeddings, fused) or 'dense' (FAISS similarity only)
+            index_type (str): Vector index for hybrid corpus-wide search: 'flat', 'ivf' or 'hnsw'
+            alpha (float): Weight of the embedding score in hybrid retrieval
+            embeddings_backend (str): Backend the embeddings run on ('torch', 'onnx' or
+                'onnx-qint8'; part of the cache key, as their vectors differ slightly)
+        """
+        if retrieval not in ("hybrid", "dense"):
+            raise ValueError(f"Unknown retrieval mode '{retrieval}'")
+        self.embeddings = embeddings
+        self.embedding_model_name = embedding_model_name
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.index_cache = index_cache if index_cache is not None else IndexCache()
+        self.pipeline = pipeline if pipeline is not None else IngestPipeline(
+            chunk_size, chunk_overlap, chunker=chunker, embedding_model=embedding_model_name,
+            embeddings_backend=embeddings_backend)
+        self.chunker = self.pipeline.chunker
+        self.retrieval = retrieval
+        self.index_type = index_type
+        self.alpha = alpha
+
+        self.vector_store = None
+        # Built from vector_store on first hybrid search after a change
+        self._hybrid_index = None
+        # Concurrent first searches build the hybrid index once
+        self._hybrid_lock = threading.Lock()
+        # form_id -> {'path', 'content_hash', 'ids'}
+        self.forms = {}
+
+    def index_params(self):
+        """
+        Parameters that determine the index built for a PDF.
+
+        Returns:
+            dict: Embedding model and chunking settings
+        """
+        params = {
+            "embedding_model": self.embedding_model_name,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "chunker": self.chunker
+        }
+        # Left out for torch so existing cache entries keep their keys
+        if self.pipeline.embeddings_backend != "torch":
+            params["embeddings_backend"] = self.pipeline.embeddings_backend
+        return params
+
+    def build_form_indexes(self, pdf_paths):
+        """
+        Build (or load from cache) the vector store for each PDF.
+
+        Cache misses go through the ingest pipeline together, so extraction
+        is spread across processes and text shared between forms is only
+        embedded once.
+
+        Args:
+            pdf_paths (list): Paths to the PDF files
+
+        Returns:
+            dict: pdf_path -> FAISS vector store tagged with form and page
+        """
+        index_params = self.index_params()
+        stores = {}
+        misses = []
+        for pdf_path in pdf_paths:
+            vector_store = self.index_cache.load(pdf_path, self.embeddings, **index_params)
+            if vector_store is None:
+                misses.append(pdf_path)
+            else:
+                stores[pdf_path] = vector_store
+
+        if misses:
+            for pdf_path, (chunks, vectors) in self.pipeline.run(misses, self.embeddings).items():
+                vector_store = FAISS.from_embeddings(
+                    [(chunk.page_content, vector) for chunk, vector in zip(chunks, vectors)],
+                    self.embeddings,
+                    metadatas=[chunk.metadata for chunk in chunks]
+                )
+                self.index_cache.save(pdf_path, vector_store, **index_params)
+                stores[pdf_path] = vector_store
+
+        for pdf_path, vector_store in stores.items():
+            self._tag_form(pdf_path, vector_store)
+        return stores
+
+    def _tag_form(self, pdf_path, vector_store):
+        # Tag and re-key chunks by form; identical templates saved under
+        # different names share a cache entry and must not collide in the corpus
+        form_id = form_id_for(pdf_path)
+        ids = []
+        docs = {}
+        for i in range(vector_store.index.ntotal):
+            doc = vector_store.docstore.search(vector_store.index_to_docstore_id[i])
+            doc.metadata["form"] = form_id
+            ids.append(f"{form_id}:{i}")
+            docs[ids[-1]] = doc
+        vector_store.docstore = InMemoryDocstore(docs)
+        vector_store.index_to_docstore_id = dict(enumerate(ids))
+
+    def add_pdfs(self, pdf_paths):
+        """
+        Add PDFs to the corpus, replacing older versions of the same forms.
+
+        Args:
+            pdf_paths (list): Paths to the PDF files
+
+        Returns:
+            list: The form IDs the chunks were tagged with, in input order
+        """
+        pending = []
+        for pdf_path in pdf_paths:
+            existing = self.forms.get(form_id_for(pdf_path))
+            if existing is None or existing["content_hash"] != self.index_cache.content_hash(pdf_path):
+                pending.append(pdf_path)
+
+        for pdf_path, form_store in self.build_form_indexes(pending).items():
+            self._hybrid_index = None
+            form_id = form_id_for(pdf_path)
+            existing = self.forms.get(form_id)
+            if existing is not None:
+                logger.info("Replacing form %s in corpus index", form_id)
+                self.vector_store.delete(existing["ids"])
+
+            ids = [form_store.index_to_docstore_id[i] for i in range(form_store.index.ntotal)]
+            if self.vector_store is None:
+                self.vector_store = form_store
+            else:
+                self.vector_store.merge_from(form_store)
+
+            self.forms[form_id] = {
+                "path": pdf_path,
+                "content_hash": self.index_cache.content_hash(pdf_path),
+                "ids": ids
+            }
+            logger.info("Indexed form %s (%d chunks)", form_id, len(ids))
+
+        return [form_id_for(pdf_path) for pdf_path in pdf_paths]
+
+    def add_pdf(self, pdf_path):
+        """
+        Add a PDF to the corpus, replacing an older version of the same form.
+
+        Args:
+            pdf_path (str): Path to the PDF file
+
+        Returns:
+            str: The form ID the chunks were tagged with
+        """
+        return self.add_pdfs([pdf_path])[0]
+
+    def add_directory(self, pdf_dir):
+        """
+        Add every PDF in a directory to the corpus.
+
+        Args:
+            pdf_dir (str): Directory containing the permit templates
+
+        Returns:
+            list: Form IDs in the corpus after ingestion
+        """
+        self.add_pdfs(sorted(glob.glob(os.path.join(pdf_dir, "*.pdf"))))
+        return list(self.forms)
+
+    def hybrid_index(self):
+        """
+        Get the BM25 + embeddings index over the corpus, building it if the
+        corpus changed since it was last built.
+
+        Returns:
+            HybridIndex: Index over every chunk in the corpus
+        """
+        if self.vector_store is None:
+            raise ValueError("Corpus index is empty; add a PDF first")
+        with self._hybrid_lock:
+            if self._hybrid_index is None:
+                self._hybrid_index = HybridIndex.from_vector_store(self.vector_store, self.embeddings,
+                                                                   index_type=self.index_type, alpha=self.alpha)
+                logger.info("Built %s hybrid index over %d chunks", self.index_type, len(self._hybrid_index))
+            return self._hybrid_index
+
+    def search(self, questions, form_id=None, k=4):
+        """
+        Retrieve chunks for a batch of questions in one pass (hybrid retrieval).
+
+        Args:
+            questions (list): Questions to search for
+            form_id (str): Only return chunks from this form (None searches all forms)
+            k (int): Chunks per question
+
+        Returns:
+            list: For each question, a list of (Document, score), best first
+        """
+        if form_id is not None and form_id not in self.forms:
+            raise KeyError(f"Form '{form_id}' is not in the corpus")
+        return self.hybrid_index().search(questions, k=k, form_id=form_id)
+
+    def as_retriever(self, form_id=None, k=4):
+        """
+        Get a retriever over the corpus, optionally restricted to one form.
+
+        Args:
+            form_id (str): Only return chunks from this form (None searches all forms)
+            k (int): Number of chunks to return
+
+        Returns:
+            BaseRetriever: Retriever for use in a retrieval chain
+        """
+        if self.vector_store is None:
+            raise ValueError("Corpus index is empty; add a PDF first")
+        if form_id is not None and form_id not in self.forms:
+            raise KeyError(f"Form '{form_id}' is not in the corpus")
+
+        if self.retrieval == "hybrid":
+            return HybridRetriever(index=self.hybrid_index(), form_id=form_id, k=k)
+
+        search_kwargs = {"k": k}
+        if form_id is not None:
+            # FAISS applies metadata filters after the search, so fetch enough
+            # candidates that the target form is still represented
+            search_kwargs["filter"] = {"form": form_id}
+            search_kwargs["fetch_k"] = min(self.vector_store.index.ntotal, max(20, k * len(self.forms) * 4))
+
+        return self.vector_store.as_retriever(search_kwargs=search_kwargs)
@@ -0,0 +1,293 @@
+import json
+import logging
+import os
+import tempfile
+
+from pdfrw import PdfReader
+from pdfrw.objects import PdfString
+from fileHash import cached_file_sha256
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCHEMA_DIR = os.path.join(os.path.dirname(__file__), '.schema_cache')
+SCHEMA_VERSION = 1
+
+
+def form_id_for(pdf_path):
+    """
+    Derive a template's form ID (used in URLs and to tag and filter
+    chunks) from its path.
+
+    Args:
+        pdf_path (str): Path to the PDF file
+
+    Returns:
+        str: File name without extension (e.g. 'FoodHealthPermitApplicationFillable')
+    """
+    return os.path.splitext(os.path.basename(pdf_path))[0]
+
+
+def _text(value):
+    """
+    Decode a PDF string (or name) into plain text for the JSON artifact.
+    """
+    if value is None:
+        return None
+    if isinstance(value, PdfString):
+        return value.to_unicode()
+    return str(value)
+
+
+def field_parts(annotation):
+    """
+    Collect the partial names (/T) from the root field down to this widget.
+    """
+    parts = []
+    node = annotation
+    while node is not None:
+        if node.T is not None:
+            parts.append(node.T)
+        node = node.Parent
+    parts.reverse()
+    return parts
+
+
+def qualified_field_name(annotation):
+    """
+    Get the fully qualified name of the field a widget belongs to.
+
+    Top-level fields keep their raw PDF string (e.g. '(City)'), which is how
+    callers key form_data. Nested fields join their partial names with '.'
+    and are re-encoded the same way, e.g. '(topmostSubform[0].Page1[0].f1_1[0])'.
+
+    Args:
+        annotation (PdfDict): A widget annotation
+
+    Returns:
+        str: The qualified field name, or None for a widget with no named field
+    """
+    parts = field_parts(annotation)
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    return PdfString.from_unicode('.'.join(part.to_unicode() for part in parts))
+
+
+def field_node(annotation):
+    """
+    Get the dictionary holding a widget's field value: the widget itself when
+    it carries /T, otherwise the parent field it is a kid of.
+    """
+    if annotation.T is None and annotation.Parent is not None:
+        return annotation.Parent
+    return annotation
+
+
+def widget_states(annotation):
+    """
+    List the appearance states a button widget can switch to (besides /Off).
+    """
+    if annotation.AP is None or annotation.AP.N is None or not hasattr(annotation.AP.N, 'keys'):
+        return []
+    return [str(state)[1:] for state in annotation.AP.N.keys() if state != '/Off']
+
+
+def extract_schema(template):
+    """
+    Walk a parsed template once and describe every fillable field.
+
+    Args:
+        template (PdfReader): The parsed PDF form
+
+    Returns:
+        list: One dict per field, in document order
+    """
+    fields = {}
+
+    for page_number, page in enumerate(template.pages):
+        for annotation in page.Annots or []:
+            if annotation.Subtype != '/Widget':
+                continue
+
+            name = qualified_field_name(annotation)
+            if name is None:
+                continue
+
+            inherited = annotation.inheritable
+            widget = {
+                'page': page_number,
+                'rect': [float(v) for v in annotation.Rect] if annotation.Rect else None,
+                'states': widget_states(annotation),
+            }
+
+            if name in fields:
+                fields[name]['widgets'].append(widget)
+                continue
+
+            options = inherited.Opt
+            fields[name] = {
+                'name': str(name),
+                'label': _text(inherited.TU),
+                'type': str(inherited.FT)[1:] if inherited.FT else None,
+                'flags': int(inherited.Ff or 0),
+                'page': page_number,
+                'max_length': int(inherited.MaxLen) if inherited.MaxLen is not None else None,
+                'options': [
+                    _text(option[-1] if isinstance(option, list) else option)
+                    for option in options
+                ] if options is not None else None,
+                'default': _text(inherited.DV),
+                'parents': [part.to_unicode() for part in field_parts(annotation)[:-1]],
+                'widgets': [widget],
+            }
+
+    return list(fields.values())
+
+
+class FormSchema:
+    """
+    Field schema for one template, as extracted by extract_schema().
+    """
+
+    def __init__(self, content_hash, fields):
+        self.content_hash = content_hash
+        self.fields = {field['name']: field for field in fields}
+
+    def __contains__(self, name):
+        return name in self.fields
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def field(self, name):
+        """
+        Get one field's description, or None if the form has no such field.
+        """
+        return self.fields.get(name)
+
+    def names(self, field_type=None):
+        """
+        List field names in document order.
+
+        Args:
+            field_type (str): Only include fields of this type ('Tx', 'Btn', 'Ch', 'Sig')
+
+        Returns:
+            list: Qualified field names
+        """
+        return [
+            name for name, field in self.fields.items()
+            if field_type is None or field['type'] == field_type
+        ]
+
+    def pages_for(self, names):
+        """
+        Get the pages holding widgets for the given fields.
+
+        Args:
+            names (iterable): Field names
+
+        Returns:
+            set: Zero-based page numbers
+        """
+        pages = set()
+        for name in names:
+            field = self.fields.get(name)
+            if field is not None:
+                pages.update(widget['page'] for widget in field['widgets'])
+        return pages
+
+
+class FieldSchemaRegistry:
+    """
+    Extracts each template's field schema once and serves it from memory.
+
+    Schemas are persisted as compact JSON named by the template's content
+    hash, so worker restarts skip the annotation walk and a replaced
+    template is re-extracted automatically.
+    """
+
+    def __init__(self, schema_dir=DEFAULT_SCHEMA_DIR):
+        """
+        Args:
+            schema_dir (str): Directory where schema artifacts are stored
+        """
+        self.schema_dir = schema_dir
+        self._schemas = {}
+        os.makedirs(self.schema_dir, exist_ok=True)
+
+    def _artifact_path(self, content_hash):
+        return os.path.join(self.schema_dir, f"{content_hash}.json")
+
+    def get(self, pdf_path, template=None):
+        """
+        Get the field schema of a template.
+
+        Args:
+            pdf_path (str): Path to the PDF form
+            template (PdfReader): Already parsed template, used on a miss to avoid re-reading
+
+        Returns:
+            FormSchema: The template's fields
+        """
+        content_hash = cached_file_sha256(pdf_path)
+        schema = self._schemas.get(content_hash)
+        if schema is not None:
+            return schema
+
+        artifact = self._artifact_path(content_hash)
+        try:
+            with open(artifact, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('version') != SCHEMA_VERSION:
+                raise ValueError(f"schema version {data.get('version')}")
+            fields = data['fields']
+        except (OSError, ValueError, KeyError):
+            logger.debug("Extracting field schema for %s", pdf_path)
+            fields = extract_schema(template if template is not None else PdfReader(pdf_path))
+            self._persist(artifact, {
+                'version': SCHEMA_VERSION,
+                'source': os.path.basename(pdf_path),
+                'content_hash': content_hash,
+                'fields': fields,
+            })
+
+        schema = FormSchema(content_hash, fields)
+        self._schemas[content_hash] = schema
+        return schema
+
+    def _persist(self, artifact, data):
+        # Write to a temp file and rename so readers never see partial JSON
+        fd, tmp_path = tempfile.mkstemp(dir=self.schema_dir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_path, artifact)
+        except OSError as e:
+            logger.warning("Could not persist field schema %s: %s", artifact, e)
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+_default_registry = None
+
+
+def get_schema(pdf_path, template=None):
+    """
+    Get a template's field schema from the process-wide registry.
+
+    Args:
+        pdf_path (str): Path to the PDF form
+        template (PdfReader): Already parsed template, used on a miss
+
+    Returns:
+        FormSchema: The template's fields
+    """
+    global _default_registry
+    if _default_registry is None:
+        _default_registry = FieldSchemaRegistry()
+    return _default_registry.get(pdf_path, template)
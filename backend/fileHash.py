@@ -0,0 +1,40 @@
+import hashlib
+import os
+
+# (realpath, mtime, size) -> content hash, so repeat lookups skip re-hashing
+_hashes = {}
+
+
+def file_sha256(path, block_size=1 << 20):
+    """
+    Hash the contents of a file.
+
+    Args:
+        path (str): Path to the file
+        block_size (int): Number of bytes read per iteration
+
+    Returns:
+        str: Hex digest of the file contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cached_file_sha256(path):
+    """
+    Hash a file's contents, memoized on its path, mtime and size.
+
+    Args:
+        path (str): Path to the file
+
+    Returns:
+        str: Hex digest of the file contents
+    """
+    stat = os.stat(path)
+    stamp = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+    if stamp not in _hashes:
+        _hashes[stamp] = file_sha256(path)
+    return _hashes[stamp]
@@ -1,12 +1,21 @@
-from pdfrw import PdfReader, PdfWriter
+from pdfrw import PdfReader
 from pdfrw.buildxobj import pagexobj
 from pdfrw.objects.pdfdict import PdfDict
+from pdfrw.objects import PdfName, PdfObject
+from appearance import FLAG_PUSHBUTTON, choose_state, get_appearance_builder, on_states
+from fieldSchema import field_node, form_id_for, get_schema, qualified_field_name
+from fileHash import cached_file_sha256
+from instrumentation import StageTimer, metrics
+from templateWriter import (DEFAULT_CHUNK_SIZE, PreparedTemplate, iter_chunks, iter_incremental_update,
+                            supports_incremental_update)
+from collections import OrderedDict
+import hashlib
 import logging
 import os
+import threading
 
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Logging is configured by the entry point (see __main__ below), not at import
 logger = logging.getLogger(__name__)
 
 def list_form_fields(template):
@@ -35,86 +44,405 @@ def list_form_fields(template):
                     'value': field_value,
                     'type': field_type
                 }
-                logger.debug(f"Found field: {field_name} (Type: {field_type}, Current Value: {field_value})")
+                logger.debug("Found field: %s (Type: %s)", field_name, field_type)
     
     return fields
 
+def build_field_index(template):
+    """
+    Index every widget by the fully qualified name of the field it belongs to.
+    
+    Kids that share one field (e.g. the buttons of a radio group, or a text
+    field shown on several pages) are listed together under the parent's name.
+    
+    Args:
+        template (PdfReader): The parsed PDF form
+        
+    Returns:
+        dict: Field name -> list of widget annotations
+    """
+    index = {}
+    for page in template.pages:
+        for annotation in page.Annots or []:
+            if annotation.Subtype != '/Widget':
+                continue
+            field_name = qualified_field_name(annotation)
+            if field_name is not None:
+                index.setdefault(field_name, []).append(annotation)
+    return index
+
+def get_field_index(template):
+    """
+    Get the field index of a template, building it on first use.
+    
+    The index is kept on the parsed template, and templates are reused
+    across fills (see get_cached_template()), so each is only scanned once.
+    """
+    index = template.private.__dict__.get('field_index')
+    if index is None:
+        index = build_field_index(template)
+        template.private.field_index = index
+    return index
+
+def missing_fields(form_data, pdf_path, template):
+    """
+    List the requested fields a template does not have, logging them.
+    
+    Templates on disk are checked against the field schema registry, so
+    the schema the chatbot asks questions from is the one fills are held
+    to; templates held only in memory are checked against their own field
+    index.
+    
+    Args:
+        form_data (dict): Field names to values
+        pdf_path (str): Path of the template, or None for one held in memory
+        template (PdfReader): The parsed template (warms the registry on a miss)
+        
+    Returns:
+        list: Field names from form_data that the form does not have
+    """
+    available_fields = get_schema(pdf_path, template) if pdf_path is not None else get_field_index(template)
+    missed = [field_name for field_name in form_data if field_name not in available_fields]
+    if missed:
+        logger.warning("%d field(s) from input data not found in PDF form: %s", len(missed), missed)
+    return missed
+
+# Parsed templates kept between fills, least recently used dropped first
+MAX_CACHED_TEMPLATES = 32
+
+class CachedTemplate:
+    """
+    A template parsed once and reused, pristine, by every fill of it.
+    
+    Fills mutate the parsed objects and put them back afterwards, so they
+    hold the template's lock from filling until the output is serialized.
+    """
+    
+    def __init__(self, data):
+        """
+        Args:
+            data (bytes): The template file
+        """
+        self.data = data
+        self.template = PdfReader(fdata=data)
+        self.lock = threading.Lock()
+        self._prepared = None
+    
+    @property
+    def prepared(self):
+        """
+        The template pre-serialized for full rewrites, built on first use.
+        """
+        if self._prepared is None:
+            self._prepared = PreparedTemplate(self.template)
+        return self._prepared
+
+_cached_templates = OrderedDict()
+_cached_templates_lock = threading.Lock()
+
+def get_cached_template(source):
+    """
+    Get the parsed template for a PDF, parsing it on first use.
+    
+    Templates on disk are keyed by form ID and content hash (the key the
+    schema registry uses), so a replaced file is parsed again; templates
+    given as bytes are keyed by the hash of the bytes.
+    
+    Args:
+        source: Path, bytes-like object or binary file object of the PDF
+        
+    Returns:
+        tuple: (CachedTemplate, template path or None)
+    """
+    if isinstance(source, (str, os.PathLike)):
+        pdf_path = os.fspath(source)
+        key = (form_id_for(pdf_path), cached_file_sha256(pdf_path))
+        data = None
+    else:
+        pdf_path = None
+        data = read_pdf_source(source)
+        key = (None, hashlib.sha256(data).hexdigest())
+    
+    with _cached_templates_lock:
+        cached = _cached_templates.get(key)
+        if cached is not None:
+            _cached_templates.move_to_end(key)
+            metrics.inc('permitpilot_template_cache_total', 'Parsed template cache lookups', result='hit')
+            return cached, pdf_path
+    
+    metrics.inc('permitpilot_template_cache_total', 'Parsed template cache lookups', result='miss')
+    cached = CachedTemplate(data if data is not None else read_pdf_source(pdf_path))
+    with _cached_templates_lock:
+        # Another thread may have parsed it meanwhile; keep the first copy
+        cached = _cached_templates.setdefault(key, cached)
+        _cached_templates.move_to_end(key)
+        while len(_cached_templates) > MAX_CACHED_TEMPLATES:
+            _cached_templates.popitem(last=False)
+    return cached, pdf_path
+
+def fill_template(template, form_data):
+    """
+    Fill the widgets of an already parsed template in place.
+    
+    Args:
+        template (PdfReader): The parsed PDF form
+        form_data (dict): Dictionary with field names as keys and values to fill
+        
+    Returns:
+        tuple: (number of fields filled, list of (object, previous values)
+            that restore_template() uses to return the template to its original state)
+    """
+    field_index = get_field_index(template)
+    appearances = get_appearance_builder(template)
+    fields_filled = 0
+    touched = []
+    need_appearances = False
+    
+    # Only visit the widgets of the fields being filled
+    for field_name, value in form_data.items():
+        widgets = field_index.get(field_name)
+        if not widgets:
+            continue
+        
+        try:
+            # The value lives on the field; kids without their own /T share
+            # their parent's
+            node = field_node(widgets[0])
+            inherited = widgets[0].inheritable
+            field_type = inherited.FT
+            flags = int(inherited.Ff or 0)
+            logger.debug("Filling field %s (%d widget(s))", field_name, len(widgets))
+            
+            touched.append((node, {'V': node.V}))
+            if field_type == '/Btn' and not flags & FLAG_PUSHBUTTON:
+                # Checkboxes and radio groups: select the matching on state
+                # and switch every other widget off
+                states = []
+                for widget in widgets:
+                    states.extend(state for state in on_states(widget) if state not in states)
+                state = choose_state(value, states)
+                node.V = PdfName(state) if state else PdfName.Off
+                for widget in widgets:
+                    touched.append((widget, {'AS': widget.AS, 'AP': widget.AP}))
+                    if state and not states:
+                        widget.AP = appearances.checkbox_appearances(widget, state)
+                    widget.AS = PdfName(state) if state in on_states(widget) else PdfName.Off
+            elif field_type in ('/Tx', '/Ch'):
+                value = str(value)
+                node.V = value
+                for widget in widgets:
+                    touched.append((widget, {'AP': widget.AP}))
+                    widget.AP = PdfDict(N=appearances.text_appearance(widget, value))
+            else:
+                # No generator for this field type; leave drawing to the viewer
+                node.V = str(value)
+                need_appearances = True
+            fields_filled += 1
+        except Exception as e:
+            logger.error("Error filling field %s: %s", field_name, e)
+    
+    acroform = template.Root.AcroForm
+    if need_appearances and acroform is not None:
+        touched.append((acroform, {'NeedAppearances': acroform.NeedAppearances}))
+        acroform.NeedAppearances = PdfObject('true')
+    
+    return fields_filled, touched
+
+def restore_template(touched):
+    """
+    Undo fill_template() so a parsed template can be reused for the next record.
+    
+    Args:
+        touched (list): The (annotation, previous values) list from fill_template()
+    """
+    for annotation, previous in reversed(touched):
+        for key, value in previous.items():
+            # Setting None removes the key, as it was absent before filling
+            setattr(annotation, key, value)
+
+def record_fill(summary):
+    """
+    Log a fill's structured summary and feed it into the process metrics.
+    
+    Only counts, timings and field names are recorded - never field values,
+    which carry applicant PII.
+    
+    Args:
+        summary (dict): Summary as built by fill_pdf_form()
+    """
+    template = summary['template']
+    metrics.inc('permitpilot_fill_total', 'PDF fills completed', template=template)
+    metrics.inc('permitpilot_fill_fields_matched_total', 'Fields filled', summary['fields_matched'], template=template)
+    metrics.inc('permitpilot_fill_fields_missed_total', 'Requested fields not in the form', summary['fields_missed'], template=template)
+    for stage, seconds in summary['timings'].items():
+        metrics.observe('permitpilot_fill_stage_seconds', 'Time spent per fill stage', seconds, stage=stage)
+    logger.info("Filled %s: %d matched, %d missed in %.1f ms",
+                template, summary['fields_matched'], summary['fields_missed'],
+                sum(summary['timings'].values()) * 1000,
+                extra={'fill_summary': summary})
+
 def fill_pdf_form(input_pdf_path, output_pdf_path, form_data):
     """
     Fill a PDF form with given data.
     
+    The template is parsed once per process and content hash (see
+    get_cached_template()); each fill only re-serializes the objects it
+    changed.
+    
     Args:
         input_pdf_path (str): Path to the input PDF form
         output_pdf_path (str): Path where to save the filled PDF
         form_data (dict): Dictionary with field names as keys and values to fill
+        
+    Returns:
+        dict: Summary of the fill (fields matched/missed, seconds spent in
+            parse/fill/write), also logged as the record's 'fill_summary'
     """
-    logger.info(f"Reading PDF from: {input_pdf_path}")
+    timer = StageTimer()
+    logger.debug("Reading PDF from: %s", input_pdf_path)
     
     try:
-        template = PdfReader(input_pdf_path)
-        logger.info(f"Successfully read PDF, number of pages: {len(template.pages)}")
+        with timer.stage('parse'):
+            cached, _ = get_cached_template(input_pdf_path)
+            prepared = cached.prepared
     except Exception as e:
-        logger.error(f"Failed to read PDF: {e}")
+        logger.error("Failed to read PDF %s: %s", input_pdf_path, e)
         raise
     
-    # First, list all available fields
-    logger.info("Analyzing form fields...")
-    available_fields = list_form_fields(template)
-    logger.info(f"Available fields in PDF: {list(available_fields.keys())}")
-    logger.info(f"Data to be filled: {form_data}")
+    template = prepared.template
+    with cached.lock:
+        with timer.stage('fill'):
+            # Check requested fields against the template's registered schema
+            missed = missing_fields(form_data, input_pdf_path, template)
+            fields_filled, touched = fill_template(template, form_data)
+        
+        # Write the filled PDF to a new file
+        try:
+            with timer.stage('write'):
+                with open(output_pdf_path, 'wb') as f:
+                    prepared.render([obj for obj, _ in touched], output=f)
+        except Exception as e:
+            logger.error("Failed to write PDF %s: %s", output_pdf_path, e)
+            raise
+        finally:
+            restore_template(touched)
     
-    # Check for mismatched fields
-    for field_name in form_data:
-        if field_name not in available_fields:
-            logger.warning(f"Field '{field_name}' from input data not found in PDF form")
+    summary = {
+        'template': os.path.basename(input_pdf_path),
+        'pages': len(template.pages),
+        'fields_requested': len(form_data),
+        'fields_matched': fields_filled,
+        'fields_missed': len(missed),
+        'missed_fields': missed,
+        'timings': timer.durations
+    }
+    record_fill(summary)
+    return summary
+
+def read_pdf_source(source):
+    """
+    Get the raw bytes of a PDF held in memory or on disk.
     
-    fields_filled = 0
+    Args:
+        source: A path, bytes-like object (bytes, bytearray, memoryview,
+            mmap.mmap) or binary file object
+        
+    Returns:
+        bytes: The file contents
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            return f.read()
+    if isinstance(source, bytes):
+        return source
+    if hasattr(source, 'read'):
+        return source.read()
+    return bytes(source)
+
+def _fill_parts(source, form_data, incremental, name):
+    """
+    Fill a PDF from memory and serialize it into a list of byte pieces.
     
-    # Fill in the form fields
-    for page in template.pages:
-        if '/Annots' not in page:
-            logger.warning("No annotations found on page")
-            continue
-            
-        annotations = page['/Annots']
-        if annotations is None:
-            logger.warning("Annotations is None")
-            continue
-            
-        for annotation in annotations:
-            if annotation['/Subtype'] == '/Widget':
-                field_name = annotation['/T']
-                
-                if field_name in form_data:
-                    try:
-                        # Get the field type if available
-                        field_type = annotation['/FT'] if '/FT' in annotation else 'Unknown'
-                        logger.debug(f"Filling field '{field_name}' (Type: {field_type}) with value: {form_data[field_name]}")
-                        
-                        annotation.update(
-                            PdfDict(
-                                V=str(form_data[field_name]),
-                                AS=str(form_data[field_name])
-                            )
-                        )
-                        fields_filled += 1
-                        logger.debug(f"Successfully filled field '{field_name}'")
-                    except Exception as e:
-                        logger.error(f"Error filling field '{field_name}': {e}")
-    
-    logger.info(f"Filled {fields_filled} fields")
-    
-    # Write the filled PDF to a new file
-    try:
-        logger.info(f"Writing filled PDF to: {output_pdf_path}")
-        PdfWriter().write(output_pdf_path, template)
-        logger.info("Successfully wrote PDF")
-    except Exception as e:
-        logger.error(f"Failed to write PDF: {e}")
-        raise
+    Returns:
+        tuple: (pieces of the filled PDF, fill summary)
+    """
+    timer = StageTimer()
+    with timer.stage('parse'):
+        cached, pdf_path = get_cached_template(source)
+    
+    template = cached.template
+    with cached.lock:
+        with timer.stage('fill'):
+            missed = missing_fields(form_data, pdf_path, template)
+            fields_filled, touched = fill_template(template, form_data)
+        
+        try:
+            with timer.stage('write'):
+                incremental = incremental and supports_incremental_update(cached.data, template)
+                changed = [obj for obj, _ in touched]
+                if incremental:
+                    parts = list(iter_incremental_update(cached.data, template, changed))
+                else:
+                    parts = list(cached.prepared.iter_render(changed))
+        finally:
+            restore_template(touched)
+    
+    summary = {
+        'template': name or (os.path.basename(pdf_path) if pdf_path else 'memory'),
+        'pages': len(template.pages),
+        'fields_requested': len(form_data),
+        'fields_matched': fields_filled,
+        'fields_missed': len(missed),
+        'missed_fields': missed,
+        'incremental': incremental,
+        'timings': timer.durations
+    }
+    record_fill(summary)
+    return parts, summary
+
+def fill_pdf_bytes(source, form_data, incremental=False, name=None):
+    """
+    Fill a PDF form without touching the filesystem.
+    
+    Args:
+        source: The PDF form as bytes, a buffer, a memory map, a binary file object or a path
+        form_data (dict): Dictionary with field names as keys and values to fill
+        incremental (bool): Append only the changed objects to the original
+            file instead of rewriting it (files with cross-reference streams
+            get a stream section; encrypted files or files with an unreadable
+            trailer fall back to a full rewrite)
+        name (str): Template name used in the fill summary and metrics
+        
+    Returns:
+        bytes: The filled PDF
+    """
+    parts, _ = _fill_parts(source, form_data, incremental, name)
+    return b''.join(parts)
+
+def iter_filled_pdf(source, form_data, incremental=False, name=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Fill a PDF form in memory and return it as chunks for a streaming response.
+    
+    The fill happens before this returns, so errors surface here rather
+    than part way through a response.
+    
+    Args:
+        source: The PDF form as bytes, a buffer, a memory map, a binary file object or a path
+        form_data (dict): Dictionary with field names as keys and values to fill
+        incremental (bool): Append only the changed objects to the original file
+        name (str): Template name used in the fill summary and metrics
+        chunk_size (int): Approximate size of each chunk in bytes
+        
+    Returns:
+        iterator: bytes chunks of the filled PDF
+    """
+    parts, _ = _fill_parts(source, form_data, incremental, name)
+    return iter_chunks(parts, chunk_size)
 
 # Example usage
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+    
     # Example form data
     sample_data = {
         '(New Facility requires plan submittal)': 'Yes',
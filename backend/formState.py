@@ -0,0 +1,365 @@
+import ast
+import json
+import logging
+import re
+
+from pdfrw.objects import PdfString
+from instrumentation import metrics
+from togetherClient import TogetherAPIError, run_sync
+
+logger = logging.getLogger(__name__)
+
+PHONE_RE = re.compile(r'(?<!\d)(?:\+?1[\s.-]?)?\(?(\d{3})\)?[\s.-]?(\d{3})[\s.-]?(\d{4})(?!\d)')
+ZIP_RE = re.compile(r'(?<![\d-])(\d{5})(?:-(\d{4}))?(?![\d-])')
+EMAIL_RE = re.compile(r'[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}')
+SQFT_RE = re.compile(r'(\d[\d,]*(?:\.\d+)?)\s*(?:sq\.?\s*(?:ft|feet|foot)\.?|square\s*(?:feet|foot|footage|ft)|sf)\b', re.I)
+NUMBER_RE = re.compile(r'(?<![\d.])(\d[\d,]*)(?![\d.])')
+
+# Short replies left over after local extraction that carry no other data
+_FILLER_WORDS = {'it', 'is', 'its', "it's", 'my', 'our', 'the', 'a', 'an', 'and', 'number', 'phone', 'zip', 'code',
+                 'email', 'e-mail', 'address', 'at', 'sure', 'yes', 'ok', 'okay', 'thanks', 'thank', 'you', 'square',
+                 'footage', 'feet', 'ft', 'sq', 'about', 'around', 'roughly', 'call', 'us', 'we', 'are', 'can', 'be',
+                 'reached', 'reach', 'contact', 'me', 'i', 'am', 'mail'}
+_WORD_RE = re.compile(r"[a-z0-9']+")
+
+
+def display_name(field_name):
+    """
+    Get the readable name of a field, e.g. 'City' for '(City)'.
+    """
+    if field_name[:1] in '(<':
+        return PdfString(field_name).to_unicode()
+    return field_name
+
+
+def field_kind(field_name):
+    """
+    Classify a field by the kind of value a local validator can recognise.
+
+    Returns:
+        str: 'phone', 'zip', 'email', 'sqft', or None for free text
+    """
+    name = display_name(field_name).lower()
+    if 'phone' in name or 'fax' in name:
+        return 'phone'
+    if 'zip' in name or 'postal' in name:
+        return 'zip'
+    if 'email' in name or 'e-mail' in name:
+        return 'email'
+    if 'square footage' in name or 'sq ft' in name or 'square feet' in name:
+        return 'sqft'
+    return None
+
+
+def normalize_value(kind, value):
+    """
+    Validate and normalise a value for a field kind.
+
+    Returns:
+        str: The normalised value, or None if it is not valid for the kind
+    """
+    value = str(value).strip()
+    if not value:
+        return None
+    if kind == 'phone':
+        match = PHONE_RE.search(value)
+        return f"({match.group(1)}) {match.group(2)}-{match.group(3)}" if match else None
+    if kind == 'zip':
+        match = ZIP_RE.search(value)
+        if not match:
+            return None
+        return match.group(1) + (f"-{match.group(2)}" if match.group(2) else '')
+    if kind == 'email':
+        match = EMAIL_RE.search(value)
+        return match.group(0).lower() if match else None
+    if kind == 'sqft':
+        match = SQFT_RE.search(value) or NUMBER_RE.search(value)
+        return match.group(1).replace(',', '') if match else None
+    return value
+
+
+def _find(kind, text, loose=False):
+    """
+    Find a value of one kind in free text.
+
+    Args:
+        kind (str): Field kind
+        text (str): Message text
+        loose (bool): Accept a bare number for square footage (when that
+            is what was just asked)
+
+    Returns:
+        tuple: (normalised value, matched span) or None
+    """
+    if kind == 'phone':
+        match = PHONE_RE.search(text)
+    elif kind == 'zip':
+        match = ZIP_RE.search(text)
+    elif kind == 'email':
+        match = EMAIL_RE.search(text)
+    elif kind == 'sqft':
+        match = SQFT_RE.search(text) or (NUMBER_RE.search(text) if loose else None)
+    else:
+        return None
+    if match is None:
+        return None
+    return normalize_value(kind, match.group(0)), match.span()
+
+
+def _literal_dict(candidate):
+    try:
+        parsed = ast.literal_eval(candidate)
+    except (ValueError, TypeError, SyntaxError, MemoryError, RecursionError):
+        # e.g. {[1]: 2} raises TypeError (unhashable key)
+        return None
+    return parsed if isinstance(parsed, dict) else None
+
+
+def parse_json_object(text):
+    """
+    Parse the first JSON object in a model's output, tolerating surrounding
+    prose and Python-style dict literals.
+
+    Returns:
+        dict: The parsed object, or {} if none could be parsed
+    """
+    start = text.find('{')
+    if start < 0:
+        return {}
+    try:
+        parsed, _ = json.JSONDecoder().raw_decode(text, start)
+    except (ValueError, RecursionError):
+        parsed = None
+    if isinstance(parsed, dict):
+        return parsed
+    # Not JSON: try the shortest Python literal starting at the same brace
+    end = text.find('}', start)
+    while end >= 0:
+        parsed = _literal_dict(text[start:end + 1])
+        if parsed is not None:
+            return parsed
+        end = text.find('}', end + 1)
+    return {}
+
+
+class FormState:
+    """
+    Values collected so far for one applicant's form.
+    """
+
+    def __init__(self, field_names, values=None):
+        """
+        Args:
+            field_names (list): Fields to collect, in the order to ask for them
+            values (dict): Values already collected
+        """
+        self.field_names = list(field_names)
+        self.values = {name: None for name in self.field_names}
+        if values:
+            self.update(values)
+
+    def missing(self):
+        return [name for name in self.field_names if self.values[name] in (None, '')]
+
+    @property
+    def is_complete(self):
+        return not self.missing()
+
+    def next_field(self):
+        """
+        Get the next field to ask about, or None when the form is complete.
+        """
+        missing = self.missing()
+        return missing[0] if missing else None
+
+    def update(self, values):
+        """
+        Record new values, ignoring unknown fields and empty values.
+
+        Returns:
+            dict: The values that were recorded
+        """
+        recorded = {}
+        for name, value in values.items():
+            if name in self.values and value not in (None, ''):
+                self.values[name] = value
+                recorded[name] = value
+        return recorded
+
+    def filled(self):
+        return {name: value for name, value in self.values.items() if value not in (None, '')}
+
+    def to_dict(self):
+        return {"field_names": self.field_names, "values": self.filled()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["field_names"], data.get("values"))
+
+
+def asked_field(question, missing):
+    """
+    Guess which missing field an assistant question was about, from the
+    words the question shares with the field names.
+
+    Returns:
+        str: The best matching field name, or None
+    """
+    if not question:
+        return None
+    words = set(_WORD_RE.findall(question.lower().replace('e-mail', 'email')))
+    best, best_score = None, 0
+    for name in missing:
+        name_words = set(_WORD_RE.findall(display_name(name).lower()))
+        score = len(words & name_words)
+        if score > best_score:
+            best, best_score = name, score
+    return best
+
+
+class FormExtractor:
+    """
+    Extracts form values from each new user message.
+
+    Phone numbers, ZIP codes, email addresses and square footage are picked
+    out locally with validators. The LLM is only called for fields that are
+    still missing and only sees the newest message (plus the question it
+    answers), so its cost no longer grows with the length of the
+    conversation.
+    """
+
+    def __init__(self, client, model_name, max_tokens=120):
+        """
+        Args:
+            client (TogetherClient): Client for the fallback LLM call
+            model_name (str): Model used for the fallback
+            max_tokens (int): Cap on the fallback's output
+        """
+        self.client = client
+        self.model_name = model_name
+        self.max_tokens = max_tokens
+
+    def extract_local(self, message, state, question=None):
+        """
+        Extract values the local validators can recognise.
+
+        A value goes to the field the assistant just asked about when it is
+        of that field's kind, otherwise to the only missing field of its kind.
+
+        Args:
+            message (str): The newest user message
+            state (FormState): The session's form state
+            question (str): The assistant message the user is replying to
+
+        Returns:
+            tuple: (values found, message text left after removing them)
+        """
+        missing = state.missing()
+        target = asked_field(question, missing)
+        found = {}
+        remainder = message
+        # Email first, then phone before ZIP, so a phone number's digits are
+        # not mistaken for a ZIP code
+        for kind in ('email', 'phone', 'zip', 'sqft'):
+            candidates = [name for name in missing if field_kind(name) == kind]
+            if not candidates:
+                continue
+            if target in candidates:
+                field = target
+            elif len(candidates) == 1:
+                field = candidates[0]
+            else:
+                continue
+            hit = _find(kind, remainder, loose=field == target)
+            if hit is None or hit[0] is None:
+                continue
+            value, (start, end) = hit
+            if kind == 'zip' and field != target and remainder[end:].strip(' .,!'):
+                # Unprompted, only trust five digits that end the message
+                # (as in an address), not e.g. a house number
+                continue
+            found[field] = value
+            remainder = remainder[:start] + ' ' + remainder[end:]
+        if found:
+            metrics.inc('permitpilot_extract_fields_total', 'Form values extracted by method', len(found), method='local')
+        return found, remainder
+
+    def _llm_payload(self, message, fields, question):
+        names = [display_name(name) for name in fields]
+        prompt = (
+            "Extract permit form values from the applicant's latest reply.\n"
+            f"Fields still missing: {json.dumps(names)}\n"
+            + (f"Assistant asked: {json.dumps(question)}\n" if question else "")
+            + f"Applicant replied: {json.dumps(message)}\n\n"
+            "Respond with a JSON object mapping field names from the list to the values the reply provides. "
+            "Omit fields the reply does not provide. Respond with {} if it provides none.\n"
+            "JSON:"
+        )
+        return {
+            "model": self.model_name,
+            "prompt": prompt,
+            "max_tokens": self.max_tokens,
+            "temperature": 0.0,
+            "stop": ["\n\n", "Applicant replied:"]
+        }
+
+    def needs_llm(self, remainder, state):
+        """
+        Decide whether anything in the message is left for the LLM to read.
+        """
+        if state.is_complete:
+            return False
+        words = set(_WORD_RE.findall(remainder.lower()))
+        return bool(words - _FILLER_WORDS)
+
+    async def aextract_llm(self, message, state, question=None):
+        """
+        Ask the LLM for the still-missing fields the message provides.
+
+        Returns:
+            dict: The values recorded in the state
+        """
+        fields = state.missing()
+        by_display = {display_name(name): name for name in fields}
+        metrics.inc('permitpilot_extract_llm_calls_total', 'Fallback LLM calls for form extraction')
+        try:
+            output = await self.client.complete_text(self._llm_payload(message, fields, question))
+        except TogetherAPIError as e:
+            logger.warning("Form extraction failed: %s", e)
+            return {}
+
+        values = {}
+        for key, value in parse_json_object(output).items():
+            name = by_display.get(str(key).strip('()')) or (key if key in state.values else None)
+            if name is None or value in (None, '') or not isinstance(value, (str, int, float)):
+                continue
+            kind = field_kind(name)
+            # Values of a checkable kind must pass the same validator
+            value = normalize_value(kind, value)
+            if value is not None:
+                values[name] = value
+        recorded = state.update(values)
+        if recorded:
+            metrics.inc('permitpilot_extract_fields_total', 'Form values extracted by method', len(recorded), method='llm')
+        return recorded
+
+    async def aextract(self, message, state, question=None):
+        """
+        Update the form state from the newest user message.
+
+        Args:
+            message (str): The newest user message
+            state (FormState): The session's form state
+            question (str): The assistant message the user is replying to
+
+        Returns:
+            dict: The values recorded in the state
+        """
+        found, remainder = self.extract_local(message, state, question)
+        recorded = state.update(found)
+        if self.needs_llm(remainder, state):
+            recorded.update(await self.aextract_llm(message, state, question))
+        return recorded
+
+    def extract(self, message, state, question=None):
+        return run_sync(self.aextract(message, state, question))
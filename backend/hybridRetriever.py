@@ -0,0 +1,276 @@
+import logging
+import math
+import re
+from typing import Any, Optional
+
+import numpy as np
+from scipy import sparse
+from langchain_core.retrievers import BaseRetriever
+from pydantic import ConfigDict
+
+logger = logging.getLogger(__name__)
+
+INDEX_TYPES = ("flat", "ivf", "hnsw")
+
+# Below this many chunks an approximate index is no faster than a flat one
+MIN_ANN_VECTORS = 1024
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text):
+    """
+    Lowercase alphanumeric tokens, so "PE Code:" and "pe code" match.
+    """
+    return _TOKEN_RE.findall(text.lower())
+
+
+def _normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _min_max(scores):
+    # Scale each query's candidate scores to [0, 1] so BM25 and cosine
+    # scores can be added; a constant row carries no ranking signal
+    low = scores.min(axis=1, keepdims=True)
+    span = scores.max(axis=1, keepdims=True) - low
+    span[span == 0] = 1.0
+    return (scores - low) / span
+
+
+class BM25Index:
+    """
+    Okapi BM25 over chunk texts as a precomputed sparse matrix.
+
+    Each (term, chunk) weight is computed once at build time, so scoring a
+    batch of queries is one sparse product of their term counts with the
+    weight matrix.
+    """
+
+    def __init__(self, texts, k1=1.5, b=0.75):
+        """
+        Args:
+            texts (list): Chunk texts
+            k1 (float): Term frequency saturation
+            b (float): Length normalisation
+        """
+        self.vocabulary = {}
+        rows, cols, counts = [], [], []
+        lengths = np.zeros(len(texts), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            term_counts = {}
+            for token in tokens:
+                column = self.vocabulary.setdefault(token, len(self.vocabulary))
+                term_counts[column] = term_counts.get(column, 0) + 1
+            rows.extend([row] * len(term_counts))
+            cols.extend(term_counts)
+            counts.extend(term_counts.values())
+
+        shape = (len(texts), len(self.vocabulary))
+        tf = sparse.csr_matrix((np.asarray(counts, dtype=np.float32), (rows, cols)), shape=shape)
+        document_frequency = np.bincount(tf.indices, minlength=shape[1])
+        idf = np.log1p((len(texts) - document_frequency + 0.5) / (document_frequency + 0.5)).astype(np.float32)
+
+        average_length = lengths.mean() if len(texts) else 0.0
+        norm = k1 * (1 - b + b * lengths / (average_length or 1.0))
+        # Row i of tf.data runs from indptr[i] to indptr[i + 1]
+        row_norm = np.repeat(norm, np.diff(tf.indptr))
+        tf.data = idf[tf.indices] * tf.data * (k1 + 1) / (tf.data + row_norm)
+        # Terms x chunks, so a query batch multiplies straight through
+        self.weights = tf.T.tocsr()
+
+    def query_matrix(self, queries):
+        """
+        Term counts of a batch of queries (unknown terms are dropped).
+        """
+        rows, cols = [], []
+        for row, query in enumerate(queries):
+            for token in tokenize(query):
+                column = self.vocabulary.get(token)
+                if column is not None:
+                    rows.append(row)
+                    cols.append(column)
+        data = np.ones(len(rows), dtype=np.float32)
+        return sparse.csr_matrix((data, (rows, cols)), shape=(len(queries), len(self.vocabulary)))
+
+    def scores(self, queries):
+        """
+        BM25 score of every chunk for each query.
+
+        Returns:
+            np.ndarray: queries x chunks
+        """
+        return (self.query_matrix(queries) @ self.weights).toarray()
+
+
+def build_vector_index(vectors, index_type="flat", nlist=None, nprobe=8, hnsw_m=32, ef_search=64):
+    """
+    Build a FAISS inner-product index over unit vectors.
+
+    Args:
+        vectors (np.ndarray): Normalised chunk vectors
+        index_type (str): 'flat' (exact), 'ivf' (inverted lists) or 'hnsw' (graph)
+        nlist (int): IVF cells (defaults to about 4 * sqrt(n))
+        nprobe (int): IVF cells searched per query
+        hnsw_m (int): HNSW neighbours per node
+        ef_search (int): HNSW candidate list size per query
+
+    Returns:
+        faiss.Index: The populated index
+    """
+    import faiss
+
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}'")
+    count, dimension = vectors.shape
+    if index_type != "flat" and count < MIN_ANN_VECTORS:
+        index_type = "flat"
+
+    if index_type == "ivf":
+        nlist = nlist or max(1, min(count // 39, int(4 * math.sqrt(count))))
+        quantizer = faiss.IndexFlatIP(dimension)
+        index = faiss.IndexIVFFlat(quantizer, dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        index.train(vectors)
+        index.nprobe = nprobe
+    elif index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = ef_search
+    else:
+        index = faiss.IndexFlatIP(dimension)
+    index.add(vectors)
+    return index
+
+
+class HybridIndex:
+    """
+    BM25 and embedding search over the same chunks, with fused scores.
+
+    Dense search finds paraphrases; BM25 finds exact field labels such as
+    "PE Code" or "Anniversary Date" that embeddings rank poorly. Candidates
+    from both are re-scored with both (cosine exactly, from the stored
+    vectors), each score is min-max scaled per query and the two are
+    combined as alpha * dense + (1 - alpha) * bm25.
+
+    Searches restricted to a form score only that form's chunks, exactly;
+    corpus-wide searches take dense candidates from the FAISS index, which
+    can be IVF or HNSW to stay sublinear as the library grows.
+    """
+
+    def __init__(self, documents, vectors, embeddings, index_type="flat", alpha=0.5, fetch_k=20, **index_options):
+        """
+        Args:
+            documents (list): Chunk Documents (with 'form' metadata)
+            vectors (np.ndarray): The chunks' embeddings, one row per document
+            embeddings: Embeddings model for queries
+            index_type (str): 'flat', 'ivf' or 'hnsw' (see build_vector_index())
+            alpha (float): Weight of the dense score, 1 - alpha goes to BM25
+            fetch_k (int): Candidates taken from each of BM25 and dense search
+            **index_options: Passed to build_vector_index()
+        """
+        self.documents = list(documents)
+        self.embeddings = embeddings
+        self.alpha = alpha
+        self.fetch_k = fetch_k
+        self.vectors = _normalize_rows(np.asarray(vectors, dtype=np.float32))
+        self.forms = np.array([doc.metadata.get("form") for doc in self.documents], dtype=object)
+        self.bm25 = BM25Index([doc.page_content for doc in self.documents])
+        self.index = build_vector_index(self.vectors, index_type, **index_options)
+        self._form_rows = {}
+
+    @classmethod
+    def from_vector_store(cls, vector_store, embeddings=None, **options):
+        """
+        Build a hybrid index over the chunks of a langchain FAISS store.
+
+        Args:
+            vector_store (FAISS): Store whose index holds the chunk vectors
+            embeddings: Embeddings model for queries (defaults to the store's)
+            **options: Passed to HybridIndex()
+        """
+        count = vector_store.index.ntotal
+        documents = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in range(count)]
+        vectors = vector_store.index.reconstruct_n(0, count)
+        return cls(documents, vectors, embeddings or vector_store.embeddings, **options)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def _rows_for(self, form_id):
+        rows = self._form_rows.get(form_id)
+        if rows is None:
+            rows = self._form_rows[form_id] = np.flatnonzero(self.forms == form_id)
+        return rows
+
+    def _embed(self, queries):
+        if len(queries) == 1:
+            vectors = [self.embeddings.embed_query(queries[0])]
+        else:
+            vectors = self.embeddings.embed_documents(list(queries))
+        return _normalize_rows(np.asarray(vectors, dtype=np.float32))
+
+    def search(self, queries, k=4, form_id=None):
+        """
+        Find the best chunks for a batch of queries.
+
+        Args:
+            queries (list): Query strings, embedded in one call
+            k (int): Chunks per query
+            form_id (str): Only return chunks from this form (None searches all forms)
+
+        Returns:
+            list: For each query, a list of (Document, fused score), best first
+        """
+        if not queries or not self.documents:
+            return [[] for _ in queries]
+        query_vectors = self._embed(queries)
+        lexical = self.bm25.scores(queries)
+
+        if form_id is not None:
+            # One form is a few dozen chunks: score them all exactly
+            rows = self._rows_for(form_id)
+            candidates = np.broadcast_to(rows, (len(queries), len(rows)))
+        else:
+            fetch_k = min(len(self.documents), max(self.fetch_k, k))
+            _, dense_rows = self.index.search(query_vectors, fetch_k)
+            lexical_rows = np.argpartition(-lexical, fetch_k - 1, axis=1)[:, :fetch_k]
+            candidates = np.concatenate([dense_rows, lexical_rows], axis=1)
+
+        results = []
+        for query_index, rows in enumerate(candidates):
+            rows = np.unique(rows[rows >= 0])
+            if len(rows) == 0:
+                results.append([])
+                continue
+            dense = self.vectors[rows] @ query_vectors[query_index]
+            fused = (self.alpha * _min_max(dense[None, :]) +
+                     (1 - self.alpha) * _min_max(lexical[query_index, rows][None, :]))[0]
+            order = np.argsort(-fused, kind="stable")[:k]
+            results.append([(self.documents[rows[i]], float(fused[i])) for i in order])
+        return results
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Retriever over a HybridIndex, optionally restricted to one form.
+
+    batch() embeds and scores all its queries together instead of running
+    one search per query.
+    """
+
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    index: Any
+    form_id: Optional[str] = None
+    k: int = 4
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return [doc for doc, _ in self.index.search([query], k=self.k, form_id=self.form_id)[0]]
+
+    def batch(self, inputs, config=None, **kwargs):
+        if not inputs:
+            return []
+        return [[doc for doc, _ in hits] for hits in self.index.search(list(inputs), k=self.k, form_id=self.form_id)]
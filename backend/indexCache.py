@@ -0,0 +1,215 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import faiss
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from fileHash import cached_file_sha256
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(__file__), '.index_cache')
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+INDEX_FILE = 'index.faiss'
+CHUNKS_FILE = 'chunks.json'
+META_FILE = 'meta.json'
+
+
+class IndexCache:
+    """
+    On-disk store of FAISS indexes built from PDF templates.
+
+    Entries are keyed by the PDF's content hash plus the parameters that shape
+    the index (embedding model, chunk size, overlap), so a changed template or
+    a changed chunking setup can never be served a stale index. Each entry is a
+    directory holding the raw FAISS index, the chunk texts/metadata as JSON and
+    a small meta file whose mtime doubles as the LRU access time.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            cache_dir (str): Directory where index entries are stored
+            max_bytes (int): Upper bound on the total size of all entries
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def content_hash(self, pdf_path):
+        """
+        Hash a PDF's contents, memoized on its path, mtime and size.
+        """
+        return cached_file_sha256(pdf_path)
+
+    def make_key(self, pdf_path, **params):
+        """
+        Build the cache key for a PDF and the index parameters.
+
+        Args:
+            pdf_path (str): Path to the PDF file
+            **params: Anything that changes the resulting index (model name, chunking)
+
+        Returns:
+            str: Hex key naming the entry directory
+        """
+        payload = json.dumps(params, sort_keys=True)
+        digest = hashlib.sha256(f"{self.content_hash(pdf_path)}:{payload}".encode())
+        return digest.hexdigest()
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def load(self, pdf_path, embeddings, **params):
+        """
+        Load a cached vector store for a PDF.
+
+        Args:
+            pdf_path (str): Path to the PDF file
+            embeddings: Embeddings used for queries against the loaded index
+            **params: Index parameters, as passed to save()
+
+        Returns:
+            FAISS: The cached vector store, or None on a miss
+        """
+        entry = self._entry_dir(self.make_key(pdf_path, **params))
+        if not os.path.isdir(entry):
+            logger.debug("Index cache miss for %s", pdf_path)
+            return None
+
+        try:
+            # A plain read: these are flat indexes, which FAISS cannot
+            # memory-map, and CorpusIndex copies their vectors into the
+            # shared index on merge anyway
+            index = faiss.read_index(os.path.join(entry, INDEX_FILE))
+            with open(os.path.join(entry, CHUNKS_FILE), 'r', encoding='utf-8') as f:
+                chunks = json.load(f)
+        except (OSError, ValueError, RuntimeError) as e:
+            logger.warning("Discarding unreadable index cache entry %s: %s", entry, e)
+            shutil.rmtree(entry, ignore_errors=True)
+            return None
+
+        docstore = InMemoryDocstore({
+            chunk['id']: Document(page_content=chunk['page_content'], metadata=chunk['metadata'])
+            for chunk in chunks
+        })
+        index_to_docstore_id = {i: chunk['id'] for i, chunk in enumerate(chunks)}
+
+        # Touch the entry so LRU eviction sees it as recently used
+        os.utime(os.path.join(entry, META_FILE))
+        logger.debug("Index cache hit for %s", pdf_path)
+        return FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+    def save(self, pdf_path, vector_store, **params):
+        """
+        Store a vector store built from a PDF.
+
+        Any older entries for the same file with different contents are dropped,
+        since the template they were built from has been replaced.
+
+        Args:
+            pdf_path (str): Path to the PDF file the index was built from
+            vector_store (FAISS): The vector store to persist
+            **params: Index parameters that produced the vector store
+        """
+        key = self.make_key(pdf_path, **params)
+        entry = self._entry_dir(key)
+        source = os.path.realpath(pdf_path)
+        content_hash = self.content_hash(pdf_path)
+
+        chunks = []
+        for i in range(vector_store.index.ntotal):
+            doc_id = vector_store.index_to_docstore_id[i]
+            doc = vector_store.docstore.search(doc_id)
+            chunks.append({'id': doc_id, 'page_content': doc.page_content, 'metadata': doc.metadata})
+
+        # Build the entry in a scratch directory and rename it into place, so
+        # concurrent readers never see a half-written entry
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            faiss.write_index(vector_store.index, os.path.join(tmp_dir, INDEX_FILE))
+            with open(os.path.join(tmp_dir, CHUNKS_FILE), 'w', encoding='utf-8') as f:
+                json.dump(chunks, f)
+            with open(os.path.join(tmp_dir, META_FILE), 'w', encoding='utf-8') as f:
+                json.dump({
+                    'source': source,
+                    'content_hash': content_hash,
+                    'params': params,
+                    'created': time.time(),
+                }, f)
+            shutil.rmtree(entry, ignore_errors=True)
+            os.replace(tmp_dir, entry)
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        logger.debug("Cached index for %s (%d chunks)", pdf_path, len(chunks))
+        self.invalidate(pdf_path, keep_hash=content_hash)
+        self.evict()
+
+    def _entries(self):
+        """
+        Yield (entry_dir, meta, last_used, size) for every complete entry.
+        """
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            meta_path = os.path.join(entry, META_FILE)
+            if name.startswith('.') or not os.path.isfile(meta_path):
+                continue
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+                last_used = os.path.getmtime(meta_path)
+                size = sum(
+                    os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry)
+                )
+            except (OSError, ValueError):
+                continue
+            yield entry, meta, last_used, size
+
+    def invalidate(self, pdf_path, keep_hash=None):
+        """
+        Drop cached indexes built from a PDF, e.g. after the template is replaced.
+
+        Args:
+            pdf_path (str): Path to the PDF whose entries should be removed
+            keep_hash (str): Content hash whose entries are kept (the current version)
+
+        Returns:
+            int: Number of entries removed
+        """
+        source = os.path.realpath(pdf_path)
+        removed = 0
+        for entry, meta, _, _ in list(self._entries()):
+            if meta.get('source') == source and meta.get('content_hash') != keep_hash:
+                shutil.rmtree(entry, ignore_errors=True)
+                removed += 1
+        if removed:
+            logger.info("Invalidated %d cached index(es) for %s", removed, pdf_path)
+        return removed
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes.
+        """
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(e[3] for e in entries)
+        while entries and total > self.max_bytes:
+            entry, _, _, size = entries.pop(0)
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            logger.debug("Evicted index cache entry %s", entry)
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        for entry, _, _, _ in list(self._entries()):
+            shutil.rmtree(entry, ignore_errors=True)
@@ -0,0 +1,278 @@
+import hashlib
+import importlib.util
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+logger = logging.getLogger(__name__)
+
+# Pre-exported MiniLM weights shipped in the sentence-transformers hub repo
+ONNX_FILES = {
+    "onnx": "onnx/model.onnx",
+    "onnx-qint8": "onnx/model_quint8_avx2.onnx",
+}
+
+# sentence-transformers' ONNX backend runs on optimum, which is not in
+# requirements.txt: install it with pip install "optimum[onnxruntime]"
+ONNX_REQUIREMENTS = ("optimum", "onnxruntime")
+
+# 'text' splits page text into fixed-size overlapping chunks; 'layout'
+# follows sections and form fields (see layoutChunker)
+CHUNKERS = ("text", "layout")
+
+
+def make_embeddings(model_name, backend="torch", batch_size=64, device="cpu"):
+    """
+    Create a HuggingFace embeddings model for ingestion.
+
+    Args:
+        model_name (str): Sentence-transformers model to load
+        backend (str): 'torch', 'onnx' or 'onnx-qint8' (quantized ONNX for CPU;
+            both need optimum[onnxruntime])
+        batch_size (int): Batch size used inside the model's encode()
+        device (str): Torch device, ignored by the ONNX backends
+
+    Returns:
+        HuggingFaceEmbeddings: The embeddings model
+
+    Raises:
+        ImportError: If an ONNX backend is requested without optimum[onnxruntime]
+    """
+    model_kwargs = {"device": device}
+    if backend in ONNX_FILES:
+        # Fail here, not deep inside model loading
+        missing = [name for name in ONNX_REQUIREMENTS if importlib.util.find_spec(name) is None]
+        if missing:
+            raise ImportError(f"The '{backend}' embeddings backend needs {', '.join(missing)}: "
+                              f"pip install \"optimum[onnxruntime]\"")
+        model_kwargs = {
+            "backend": "onnx",
+            "model_kwargs": {"file_name": ONNX_FILES[backend]},
+        }
+    elif backend != "torch":
+        raise ValueError(f"Unknown embeddings backend '{backend}'")
+
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs={"batch_size": batch_size}
+    )
+
+
+def extract_chunks(pdf_path, chunk_size=1000, chunk_overlap=200, chunker="text"):
+    """
+    Extract and split the pages of one PDF.
+
+    Runs in pool workers, so it only takes and returns picklable values.
+
+    Args:
+        pdf_path (str): Path to the PDF file
+        chunk_size (int): Characters per chunk
+        chunk_overlap (int): Characters shared by neighbouring chunks (text chunker only)
+        chunker (str): 'text' or 'layout'
+
+    Returns:
+        list: Chunk Documents with source/page metadata
+    """
+    if chunker == "layout":
+        from layoutChunker import layout_chunks
+        return layout_chunks(pdf_path, chunk_size)
+
+    documents = PyPDFLoader(pdf_path).load()
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    )
+    return text_splitter.split_documents(documents)
+
+
+class IngestPipeline:
+    """
+    Turns PDFs into chunks and chunk embeddings.
+
+    Page extraction and splitting run in a process pool (one PDF per task)
+    and each PDF's chunks are handed to the embedder as soon as its task
+    finishes, so embedding overlaps with the extraction still running.
+    Chunks whose text is identical - boilerplate repeated across the Bldg
+    forms, or two copies of the same template - are embedded once, and the
+    embedder is fed fixed-size batches so memory stays flat on large runs.
+    """
+
+    def __init__(self, chunk_size=1000, chunk_overlap=200, workers=None, batch_size=64, chunker="text",
+                 embedding_model=None, embeddings_backend=None):
+        """
+        Args:
+            chunk_size (int): Characters per chunk
+            chunk_overlap (int): Characters shared by neighbouring chunks
+            workers (int): Extraction processes (defaults to the CPU count)
+            batch_size (int): Chunks per embed_documents() call
+            chunker (str): 'text' or 'layout'
+            embedding_model (str): Model used when run() is not given embeddings
+                (defaults to MiniLM)
+            embeddings_backend (str): 'torch', 'onnx' or 'onnx-qint8' for that
+                model (defaults to PERMITPILOT_EMBEDDINGS_BACKEND, else 'torch')
+        """
+        from sharedModels import DEFAULT_EMBEDDING_BACKEND, DEFAULT_EMBEDDING_MODEL
+
+        if chunker not in CHUNKERS:
+            raise ValueError(f"Unknown chunker '{chunker}'")
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.chunker = chunker
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.embedding_model = embedding_model or DEFAULT_EMBEDDING_MODEL
+        self.embeddings_backend = embeddings_backend or DEFAULT_EMBEDDING_BACKEND
+        if self.embeddings_backend != "torch" and self.embeddings_backend not in ONNX_FILES:
+            raise ValueError(f"Unknown embeddings backend '{self.embeddings_backend}'")
+        self.stats = {}
+
+    def embeddings(self):
+        """
+        Get the process-wide embeddings model this pipeline is configured for.
+        """
+        from sharedModels import get_embeddings
+
+        return get_embeddings(self.embedding_model, self.embeddings_backend)
+
+    def iter_extract(self, pdf_paths):
+        """
+        Extract chunks from several PDFs, in parallel when it pays off.
+
+        Args:
+            pdf_paths (list): Paths to the PDF files
+
+        Yields:
+            tuple: (pdf_path, list of chunk Documents), as each PDF finishes
+        """
+        start = time.perf_counter()
+        workers = min(self.workers, len(pdf_paths))
+        chunks = 0
+
+        if workers <= 1:
+            for pdf_path in pdf_paths:
+                result = extract_chunks(pdf_path, self.chunk_size, self.chunk_overlap, self.chunker)
+                chunks += len(result)
+                yield pdf_path, result
+        else:
+            # Spawn rather than fork: the parent usually has torch (and its
+            # thread pools) loaded, which is not fork-safe
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+                futures = {
+                    pool.submit(extract_chunks, pdf_path, self.chunk_size, self.chunk_overlap, self.chunker): pdf_path
+                    for pdf_path in pdf_paths
+                }
+                for future in as_completed(futures):
+                    result = future.result()
+                    chunks += len(result)
+                    yield futures[future], result
+
+        self.stats["extract_seconds"] = time.perf_counter() - start
+        self.stats["chunks"] = chunks
+        logger.info("Extracted %d chunks from %d PDFs in %.2fs", chunks, len(pdf_paths), self.stats["extract_seconds"])
+
+    def extract(self, pdf_paths):
+        """
+        Extract chunks from several PDFs.
+
+        Returns:
+            dict: pdf_path -> list of chunk Documents, in input order
+        """
+        chunks_by_path = dict(self.iter_extract(pdf_paths))
+        return {pdf_path: chunks_by_path[pdf_path] for pdf_path in pdf_paths}
+
+    def embed(self, texts, embeddings):
+        """
+        Embed texts in batches, embedding each distinct text only once.
+
+        Args:
+            texts (list): Chunk texts, possibly with duplicates
+            embeddings: Embeddings model exposing embed_documents()
+
+        Returns:
+            list: One vector per input text, in input order
+        """
+        embedder = _DedupEmbedder(embeddings, self.batch_size)
+        slots = [embedder.add(text) for text in texts]
+        embedder.flush()
+        self._record_embed(embedder, len(texts))
+        return [embedder.vectors[slot] for slot in slots]
+
+    def _record_embed(self, embedder, total):
+        self.stats["embed_seconds"] = embedder.seconds
+        self.stats["unique_chunks"] = len(embedder.vectors)
+        logger.info("Embedded %d unique of %d chunks in %.2fs", len(embedder.vectors), total, embedder.seconds)
+
+    def run(self, pdf_paths, embeddings=None):
+        """
+        Extract and embed several PDFs, embedding each PDF's chunks while
+        the rest are still being extracted.
+
+        Args:
+            pdf_paths (list): Paths to the PDF files
+            embeddings: Embeddings model exposing embed_documents() (defaults
+                to the pipeline's configured model and backend)
+
+        Returns:
+            dict: pdf_path -> (chunk Documents, vectors)
+        """
+        if embeddings is None:
+            embeddings = self.embeddings()
+        embedder = _DedupEmbedder(embeddings, self.batch_size)
+        chunks_by_path = {}
+        slots_by_path = {}
+        for pdf_path, chunks in self.iter_extract(pdf_paths):
+            chunks_by_path[pdf_path] = chunks
+            slots_by_path[pdf_path] = [embedder.add(chunk.page_content) for chunk in chunks]
+        embedder.flush()
+        self._record_embed(embedder, sum(len(slots) for slots in slots_by_path.values()))
+
+        return {
+            pdf_path: (chunks_by_path[pdf_path], [embedder.vectors[slot] for slot in slots_by_path[pdf_path]])
+            for pdf_path in pdf_paths
+        }
+
+
+class _DedupEmbedder:
+    """
+    Collects texts and embeds each distinct one once, a full batch at a time.
+    """
+
+    def __init__(self, embeddings, batch_size):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.vectors = []
+        self.seconds = 0.0
+        self._pending = []
+        self._slots = {}
+
+    def add(self, text):
+        """
+        Queue a text for embedding.
+
+        Returns:
+            int: Index of its vector in self.vectors once flushed
+        """
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        slot = self._slots.get(digest)
+        if slot is None:
+            slot = self._slots[digest] = len(self.vectors) + len(self._pending)
+            self._pending.append(text)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+        return slot
+
+    def flush(self):
+        if self._pending:
+            start = time.perf_counter()
+            self.vectors.extend(self.embeddings.embed_documents(self._pending))
+            self.seconds += time.perf_counter() - start
+            self._pending = []
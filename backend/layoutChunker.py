@@ -0,0 +1,262 @@
+import logging
+import statistics
+
+from langchain_core.documents import Document
+from fieldSchema import get_schema
+from formState import display_name
+
+logger = logging.getLogger(__name__)
+
+# Widgets further than this (in points) from any text line are not
+# attached to a line, only to their page
+MAX_LABEL_DISTANCE = 150.0
+
+# Headings are short bold or enlarged single lines
+MAX_HEADING_CHARS = 60
+HEADING_SIZE_RATIO = 1.15
+
+
+def _line_text(line):
+    return ''.join(span['text'] for span in line['spans']).strip()
+
+
+def _is_heading(block, body_size):
+    """
+    Decide whether a text block is a section heading: a single short line
+    set in bold capitals or noticeably larger than the page's body text.
+    """
+    lines = [line for line in block['lines'] if _line_text(line)]
+    if len(lines) != 1:
+        return False
+    text = _line_text(lines[0])
+    spans = [span for span in lines[0]['spans'] if span['text'].strip()]
+    if not spans or len(text) < 2 or len(text) > MAX_HEADING_CHARS or text.endswith(':'):
+        return False
+    bold = all(span['flags'] & 16 for span in spans)
+    size = max(span['size'] for span in spans)
+    return (bold and text.isupper()) or size >= body_size * HEADING_SIZE_RATIO
+
+
+def _label_distance(line_box, widget_box):
+    """
+    Distance from a text line to a widget, for lines that could be its
+    label: to the left on the same row, above it, or underneath it.
+
+    Returns:
+        float: Distance in points, or None if the line cannot be its label
+    """
+    x0, y0, x1, y1 = line_box
+    wx0, wy0, wx1, wy1 = widget_box
+    overlaps_x = x0 < wx1 and wx0 < x1
+    overlaps_y = y0 < wy1 and wy0 < y1
+    if overlaps_x and overlaps_y:
+        return 0.0
+    if overlaps_y and x1 <= wx0 + 2:
+        return wx0 - x1
+    if overlaps_x and y1 <= wy0 + 2:
+        return wy0 - y1
+    return None
+
+
+def _page_widgets(schema, page, page_number):
+    """
+    List a page's widgets as (field name, rect in PyMuPDF coordinates).
+    """
+    import pymupdf
+
+    widgets = []
+    for name in schema:
+        for widget in schema.field(name)['widgets']:
+            if widget['page'] == page_number and widget['rect']:
+                rect = pymupdf.Rect(widget['rect']) * page.transformation_matrix
+                rect.normalize()
+                widgets.append((name, tuple(rect)))
+    return widgets
+
+
+def _field_lines(widgets, blocks):
+    """
+    Attach each widget's field to its most likely label line.
+
+    Returns:
+        tuple: (dict of (block index, line index) -> field names, field
+            names with no label line)
+    """
+    lines = [
+        (block_index, line_index, line['bbox'])
+        for block_index, block in enumerate(blocks)
+        for line_index, line in enumerate(block['lines'])
+        if _line_text(line)
+    ]
+    attached = {}
+    unplaced = []
+    for name, rect in widgets:
+        best, best_distance = None, MAX_LABEL_DISTANCE
+        for block_index, line_index, box in lines:
+            distance = _label_distance(box, rect)
+            if distance is not None and distance < best_distance:
+                best, best_distance = (block_index, line_index), distance
+        if best is None:
+            unplaced.append(name)
+        else:
+            names = attached.setdefault(best, [])
+            if name not in names:
+                names.append(name)
+    return attached, unplaced
+
+
+def _split_long(text, max_chars):
+    """
+    Split an oversized block on line boundaries.
+    """
+    pieces = []
+    current = ''
+    for line in text.split('\n'):
+        while len(line) > max_chars:
+            if current:
+                pieces.append(current)
+                current = ''
+            pieces.append(line[:max_chars])
+            line = line[max_chars:]
+        if current and len(current) + 1 + len(line) > max_chars:
+            pieces.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+class _ChunkBuilder:
+    """
+    Accumulates a page's blocks into sections (split at headings, and
+    where a section outgrows max_chars) without splitting any block, then
+    packs neighbouring small sections together.
+    """
+
+    def __init__(self, pdf_path, page_number, max_chars):
+        self.pdf_path = pdf_path
+        self.page_number = page_number
+        self.max_chars = max_chars
+        self.pieces = []
+        self.section = None
+        self._texts = []
+        self._fields = []
+
+    def _size(self):
+        return sum(len(text) + 1 for text in self._texts)
+
+    def heading(self, text):
+        self.flush()
+        self.section = text
+        self._texts = [text]
+
+    def add(self, text, fields):
+        for piece in _split_long(text, self.max_chars):
+            has_body = len(self._texts) > (1 if self.section else 0)
+            if has_body and self._size() + len(piece) > self.max_chars:
+                self.flush()
+                # Repeat the heading so every chunk of a section says which section it is
+                if self.section:
+                    self._texts = [self.section]
+            self._texts.append(piece)
+        self._fields.extend(name for name in fields if name not in self._fields)
+
+    def flush(self):
+        if self._fields or len(self._texts) > (1 if self.section else 0):
+            self.pieces.append({
+                "sections": [self.section] if self.section else [],
+                "text": '\n'.join(self._texts),
+                "fields": self._fields,
+            })
+        self._texts = []
+        self._fields = []
+
+    def documents(self):
+        """
+        Pack the page's sections into chunk Documents.
+        """
+        self.flush()
+        packed = []
+        for piece in self.pieces:
+            previous = packed[-1] if packed else None
+            if previous is not None and len(previous["text"]) + len(piece["text"]) + 2 <= self.max_chars:
+                previous["sections"] = previous["sections"] + piece["sections"]
+                previous["text"] += '\n\n' + piece["text"]
+                previous["fields"] = previous["fields"] + [name for name in piece["fields"]
+                                                           if name not in previous["fields"]]
+            else:
+                packed.append(dict(piece))
+
+        documents = []
+        for piece in packed:
+            text = piece["text"]
+            if piece["fields"]:
+                text += "\nFields: " + ", ".join(display_name(name) for name in piece["fields"])
+            documents.append(Document(page_content=text.strip(), metadata={
+                "source": self.pdf_path,
+                "page": self.page_number,
+                "sections": piece["sections"],
+                "fields": [str(name) for name in piece["fields"]],
+            }))
+        return documents
+
+
+def layout_chunks(pdf_path, max_chars=1000):
+    """
+    Split a PDF into chunks along its layout and form fields.
+
+    Text blocks are read in page order and grouped into chunks that start
+    at section headings (short bold or enlarged lines) and never split a
+    block, so a field's label stays with its instructions and no overlap is
+    needed. Each widget is attached to its label line (to its left, above
+    it or under it), and the chunk holding that line lists the field in its
+    text and in its 'fields' metadata. Neighbouring small sections on a
+    page are then packed into one chunk, up to max_chars.
+
+    Runs in pool workers, so it only takes and returns picklable values.
+
+    Args:
+        pdf_path (str): Path to the PDF file
+        max_chars (int): Approximate upper bound on a chunk's length
+
+    Returns:
+        list: Chunk Documents with 'source', 'page', 'sections' and 'fields' metadata
+    """
+    import pymupdf
+
+    schema = get_schema(pdf_path)
+    chunks = []
+    with pymupdf.open(pdf_path) as document:
+        for page in document:
+            blocks = [
+                block for block in page.get_text("dict")["blocks"]
+                if block["type"] == 0 and any(_line_text(line) for line in block["lines"])
+            ]
+            # Top to bottom, then left to right, so a heading comes before
+            # the rows it starts
+            blocks.sort(key=lambda block: (round(block['bbox'][1]), block['bbox'][0]))
+            sizes = [span['size'] for block in blocks for line in block['lines'] for span in line['spans']
+                     if span['text'].strip()]
+            body_size = statistics.median(sizes) if sizes else 0.0
+            attached, unplaced = _field_lines(_page_widgets(schema, page, page.number), blocks)
+
+            builder = _ChunkBuilder(pdf_path, page.number, max_chars)
+            for block_index, block in enumerate(blocks):
+                fields = [
+                    name for line_index in range(len(block['lines']))
+                    for name in attached.get((block_index, line_index), [])
+                ]
+                if not fields and _is_heading(block, body_size):
+                    builder.heading(_line_text(next(line for line in block['lines'] if _line_text(line))))
+                    continue
+                text = '\n'.join(_line_text(line) for line in block['lines'] if _line_text(line))
+                builder.add(text, fields)
+            if unplaced:
+                # Fields with no label nearby get a chunk of their own
+                builder.flush()
+                builder.section = None
+                builder.add('', unplaced)
+            chunks.extend(builder.documents())
+    return chunks
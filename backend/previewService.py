@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import importlib.util
+import json
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from fieldSchema import get_schema
+from fileHash import cached_file_sha256
+from fillPDF import fill_pdf_bytes, read_pdf_source
+from instrumentation import metrics
+from togetherClient import run_sync
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DPI = 96
+MIN_DPI = 24
+MAX_DPI = 300
+FORMATS = ("png", "webp")
+DEFAULT_CACHE_BYTES = 128 * 1024 * 1024
+
+
+def render_pages(source, page_numbers, dpi=DEFAULT_DPI, fmt="png", form_data=None):
+    """
+    Render pages of a PDF to images, filling it first if form data is given.
+
+    Runs in pool workers, so it only takes and returns picklable values.
+
+    Args:
+        source: Path or bytes of the PDF
+        page_numbers (list): Zero-based pages to render
+        dpi (int): Resolution
+        fmt (str): 'png' or 'webp' (WebP needs Pillow)
+        form_data (dict): Values to fill before rendering
+
+    Returns:
+        dict: page number -> image bytes
+    """
+    import pymupdf
+
+    if form_data:
+        # Incremental fill: only the touched widgets are re-serialised
+        source = fill_pdf_bytes(source, form_data, incremental=True)
+    with (pymupdf.open(stream=source) if isinstance(source, bytes) else pymupdf.open(source)) as document:
+        images = {}
+        for page_number in page_numbers:
+            pixmap = document[page_number].get_pixmap(dpi=dpi, annots=True)
+            if fmt == "webp":
+                images[page_number] = pixmap.pil_tobytes(format="WEBP", quality=80)
+            else:
+                images[page_number] = pixmap.tobytes("png")
+        return images
+
+
+def page_count(source):
+    import pymupdf
+
+    with (pymupdf.open(stream=source) if isinstance(source, bytes) else pymupdf.open(source)) as document:
+        return document.page_count
+
+
+class PreviewCache:
+    """
+    Rendered page images in memory, least recently used evicted first once
+    their total size passes max_bytes.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        """
+        Args:
+            max_bytes (int): Upper bound on the total size of cached images
+        """
+        self.max_bytes = max_bytes
+        self._images = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+        metrics.inc('permitpilot_preview_cache_total', 'Preview page cache lookups',
+                    result='hit' if image is not None else 'miss')
+        return image
+
+    def put(self, key, image):
+        with self._lock:
+            previous = self._images.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= len(previous)
+            self._images[key] = image
+            self._total_bytes += len(image)
+            while len(self._images) > 1 and self._total_bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self._total_bytes -= len(evicted)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._images)
+
+
+class PreviewService:
+    """
+    Renders template and filled-form pages to images in a process pool.
+
+    A page's cache key is the template's content hash, the page number,
+    the resolution and format, and only the values of fields with a widget
+    on that page. After a chat turn fills one field, every other page is
+    served from the cache and only the page holding that field is filled
+    and rendered again.
+    """
+
+    def __init__(self, workers=None, cache=None, executor=None):
+        """
+        Args:
+            workers (int): Render processes (defaults to the CPU count); with
+                executor, the number of tasks a request is spread over
+            cache (PreviewCache): Image cache (defaults to a 128 MB in-memory cache)
+            executor (concurrent.futures.Executor): Pool to render in instead
+                of starting one (e.g. the server's fill pool)
+        """
+        self.cache = cache if cache is not None else PreviewCache()
+        self.workers = workers or os.cpu_count() or 1
+        self._owns_executor = executor is None
+        if executor is None:
+            # Spawn rather than fork, as the parent may have torch loaded
+            executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+        self.executor = executor
+        self._page_counts = {}
+
+    def _check(self, dpi, fmt):
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown image format '{fmt}'")
+        if fmt == "webp" and importlib.util.find_spec("PIL") is None:
+            raise ValueError("WebP previews need Pillow")
+        if not MIN_DPI <= dpi <= MAX_DPI:
+            raise ValueError(f"dpi must be between {MIN_DPI} and {MAX_DPI}")
+
+    async def _run(self, *args):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        images = await loop.run_in_executor(self.executor, render_pages, *args)
+        metrics.observe('permitpilot_preview_render_seconds', 'Time to fill and render preview pages',
+                        time.perf_counter() - start)
+        return images
+
+    async def _page_count(self, content_hash, source):
+        count = self._page_counts.get(content_hash)
+        if count is None:
+            count = self._page_counts[content_hash] = await asyncio.to_thread(page_count, source)
+        return count
+
+    async def apreview_form(self, pdf_path, form_data=None, pages=None, dpi=DEFAULT_DPI, fmt="png"):
+        """
+        Render pages of a template, filled with form_data if given.
+
+        Args:
+            pdf_path (str): Path to the PDF form
+            form_data (dict): Field values to show (None for the blank template)
+            pages (list): Zero-based pages to render (defaults to every page)
+            dpi (int): Resolution
+            fmt (str): 'png' or 'webp'
+
+        Returns:
+            dict: page number -> image bytes
+
+        Raises:
+            ValueError: For an unknown format, a dpi out of range or a page out of range
+        """
+        self._check(dpi, fmt)
+        content_hash = cached_file_sha256(pdf_path)
+        count = await self._page_count(content_hash, pdf_path)
+        pages = list(range(count)) if pages is None else list(pages)
+        if any(not 0 <= page < count for page in pages):
+            raise ValueError(f"Pages must be between 0 and {count - 1}")
+
+        form_data = form_data or {}
+        schema = get_schema(pdf_path)
+        page_values = {page: {} for page in pages}
+        for name, value in form_data.items():
+            for page in schema.pages_for([name]):
+                if page in page_values:
+                    page_values[page][name] = value
+
+        images = {}
+        keys = {}
+        for page in pages:
+            digest = hashlib.sha256(json.dumps(page_values[page], sort_keys=True, default=str).encode('utf-8'))
+            keys[page] = (content_hash, page, dpi, fmt, digest.hexdigest())
+            image = self.cache.get(keys[page])
+            if image is not None:
+                images[page] = image
+
+        dirty = [page for page in pages if page not in images]
+        if dirty:
+            # Fill with just the dirty pages' values: the rest are not rendered
+            values = {name: value for page in dirty for name, value in page_values[page].items()}
+            groups = self._groups(dirty)
+            rendered = await asyncio.gather(*[self._run(pdf_path, group, dpi, fmt, values) for group in groups])
+            for result in rendered:
+                for page, image in result.items():
+                    self.cache.put(keys[page], image)
+                    images[page] = image
+        return {page: images[page] for page in pages}
+
+    async def apreview_pdf(self, source, pages=None, dpi=DEFAULT_DPI, fmt="png"):
+        """
+        Render pages of an already filled PDF (e.g. fill_pdf_form() output).
+
+        Args:
+            source: Path, bytes or file object of the PDF
+            pages (list): Zero-based pages to render (defaults to every page)
+            dpi (int): Resolution
+            fmt (str): 'png' or 'webp'
+
+        Returns:
+            dict: page number -> image bytes
+        """
+        self._check(dpi, fmt)
+        data = read_pdf_source(source)
+        content_hash = hashlib.sha256(data).hexdigest()
+        count = await self._page_count(content_hash, data)
+        pages = list(range(count)) if pages is None else list(pages)
+        if any(not 0 <= page < count for page in pages):
+            raise ValueError(f"Pages must be between 0 and {count - 1}")
+
+        images = {}
+        for page in pages:
+            image = self.cache.get((content_hash, page, dpi, fmt))
+            if image is not None:
+                images[page] = image
+        dirty = [page for page in pages if page not in images]
+        if dirty:
+            rendered = await asyncio.gather(*[self._run(data, group, dpi, fmt) for group in self._groups(dirty)])
+            for result in rendered:
+                for page, image in result.items():
+                    self.cache.put((content_hash, page, dpi, fmt), image)
+                    images[page] = image
+        return {page: images[page] for page in pages}
+
+    def _groups(self, pages):
+        # One task per worker: each fills (if needed) once, then renders its share
+        count = min(self.workers, len(pages))
+        return [pages[i::count] for i in range(count)]
+
+    def preview_form(self, pdf_path, form_data=None, pages=None, dpi=DEFAULT_DPI, fmt="png"):
+        return run_sync(self.apreview_form(pdf_path, form_data, pages, dpi, fmt))
+
+    def preview_pdf(self, source, pages=None, dpi=DEFAULT_DPI, fmt="png"):
+        return run_sync(self.apreview_pdf(source, pages, dpi, fmt))
+
+    def close(self):
+        if self._owns_executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
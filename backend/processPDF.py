@@ -1,94 +1,337 @@
+import asyncio
+import hashlib
 import os
-from langchain_together import Together
-from langchain_core.messages import HumanMessage
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_community.vectorstores import FAISS
-from langchain_core.prompts import ChatPromptTemplate
-from langchain.chains.conversational_retrieval.base import ConversationalRetrievalChain
-from langchain_huggingface import HuggingFaceEmbeddings  # Updated import
+import threading
+from responseCache import SemanticResponseCache
+from sharedModels import DEFAULT_EMBEDDING_BACKEND, DEFAULT_EMBEDDING_MODEL, get_embeddings, report_startup, startup_stage
+from togetherClient import DEFAULT_API_URL, TogetherClient, iterate_sync, run_sync
+
+def format_chat_history(chat_history):
+    """
+    Format (question, answer) pairs the way the QA chain's condense prompt expects
+    """
+    return "".join(f"\nHuman: {question}\nAssistant: {answer}" for question, answer in chat_history or [])
 
 class PDFChatBot:
-    def __init__(self, together_api_key, model_name="meta-llama/Llama-3.2-3B-Instruct-Turbo"):
+    def __init__(self, together_api_key, model_name="meta-llama/Llama-3.2-3B-Instruct-Turbo", index_cache=None, api_url=None,
+                 response_cache=None, embeddings=None, embeddings_backend=None):
         """
         Initialize the PDF chatbot with TogetherAI
         
         Args:
             together_api_key (str): Your TogetherAI API key
             model_name (str): The model to use from TogetherAI
+            index_cache (IndexCache): Store for per-form indexes (defaults to backend/.index_cache)
+            api_url (str): Inference endpoint for streamed answers (defaults to TOGETHER_API_URL or Together's API)
+            response_cache (SemanticResponseCache): Cache of answers to first questions (defaults to an in-memory cache)
+            embeddings: Embeddings model (defaults to the process-wide MiniLM model)
+            embeddings_backend (str): 'torch', 'onnx' or 'onnx-qint8' for the MiniLM model
+                (defaults to PERMITPILOT_EMBEDDINGS_BACKEND, else 'torch')
         """
+        # langchain and FAISS are imported on first use, so importing this
+        # module (e.g. for the fill path) stays cheap
+        with startup_stage("import:qa"):
+            from langchain_together import Together
+            from corpusIndex import CorpusIndex
+
+        # The langchain LLM only supplies the chain's prompts and the sampling
+        # parameters; every request goes through the pooled client below
         self.llm = Together(
             together_api_key=together_api_key,
             model=model_name,
             temperature=0.7,
             max_tokens=512
         )
-        
-        # Initialize embeddings (using a free model that runs locally)
-        self.embeddings = HuggingFaceEmbeddings(
-            model_name="sentence-transformers/all-MiniLM-L6-v2"
+        self.client = TogetherClient(
+            together_api_key,
+            api_url=api_url or os.environ.get("TOGETHER_API_URL", DEFAULT_API_URL)
         )
         
-        self.vector_store = None
-        self.qa_chain = None
+        # Embeddings (a free model that runs locally), loaded once per process
+        self.embedding_model_name = DEFAULT_EMBEDDING_MODEL
+        self.embeddings_backend = embeddings_backend or DEFAULT_EMBEDDING_BACKEND
+        self.embeddings = embeddings if embeddings is not None else get_embeddings(
+            self.embedding_model_name, self.embeddings_backend)
+        
+        # Shared index over every loaded form; chunks are tagged with form and page
+        self.corpus = CorpusIndex(
+            self.embeddings,
+            self.embedding_model_name,
+            chunk_size=1000,
+            chunk_overlap=200,
+            index_cache=index_cache,
+            embeddings_backend=self.embeddings_backend
+        )
+        # Standalone questions are answered the same way for every applicant,
+        # so their answers are shared by similarity of the question
+        self.response_cache = response_cache if response_cache is not None else SemanticResponseCache()
+        self.active_form = None
+        self.qa_chains = {}
+        # Chains are built once per form, even when first questions arrive together
+        self._chain_lock = threading.Lock()
+        self._chain_build_locks = {}
         self.system_prompt = "Assume the role of an expert form-filler for permit applications. Your goal is gather all the information needed, from the user (e.g. What is your Business Name?, Who is the Business Owner?, etc). Store this info in your memory. You should only be asking questions! and gathering"
 
+    @property
+    def vector_store(self):
+        return self.corpus.vector_store
+
     def load_pdf(self, pdf_path):
         """
-        Load and process a PDF file
+        Load and process a PDF file into the shared index and make it the
+        default form for questions
         
         Args:
             pdf_path (str): Path to the PDF file
         """
-        # Load PDF
-        loader = PyPDFLoader(pdf_path)
-        documents = loader.load()
+        self.active_form = self.corpus.add_pdf(pdf_path)
+        # The index changed, so chains built against the old one are stale
+        self.qa_chains = {}
         
-        # Split text into chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200
-        )
-        chunks = text_splitter.split_documents(documents)
+        return f"Processed PDF: {pdf_path}"
+
+    def load_corpus(self, pdf_dir):
+        """
+        Load every PDF in a directory into the shared index
         
-        # Create vector store
-        self.vector_store = FAISS.from_documents(chunks, self.embeddings)
+        Args:
+            pdf_dir (str): Directory containing the permit templates
+            
+        Returns:
+            list: Form IDs available for questions
+        """
+        form_ids = self.corpus.add_directory(pdf_dir)
+        self.active_form = None
+        self.qa_chains = {}
+        return form_ids
+
+    def get_qa_chain(self, form_id=None):
+        """
+        Get the QA chain retrieving from one form (or the whole corpus)
         
-        # Create QA chain
-        self.qa_chain = ConversationalRetrievalChain.from_llm(
-            llm=self.llm,
-            retriever=self.vector_store.as_retriever(),
-            return_source_documents=True,
-            verbose=True
-        )
+        Args:
+            form_id (str): Form to restrict retrieval to, None for all forms
+            
+        Returns:
+            ConversationalRetrievalChain: Chain for the requested scope
+        """
+        with self._chain_lock:
+            if form_id not in self.qa_chains:
+                from langchain.chains.conversational_retrieval.base import ConversationalRetrievalChain
+                from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+
+                self.qa_chains[form_id] = ConversationalRetrievalChain.from_llm(
+                    llm=self.llm,
+                    retriever=self.corpus.as_retriever(form_id=form_id),
+                    condense_question_prompt=CONDENSE_QUESTION_PROMPT,
+                    return_source_documents=True,
+                    verbose=True
+                )
+            return self.qa_chains[form_id]
+
+    async def aget_qa_chain(self, form_id=None):
+        """
+        Get the QA chain for a form without blocking the event loop
         
-        return f"Processed PDF: {pdf_path}"
+        The first chain may build the hybrid index, so it is built in a
+        thread; concurrent callers for the same form wait for that build
+        instead of starting their own.
+        """
+        qa_chain = self.qa_chains.get(form_id)
+        if qa_chain is not None:
+            return qa_chain
+        lock = self._chain_build_locks.setdefault(form_id, asyncio.Lock())
+        async with lock:
+            qa_chain = self.qa_chains.get(form_id)
+            if qa_chain is None:
+                qa_chain = await asyncio.to_thread(self.get_qa_chain, form_id)
+            return qa_chain
 
-    def ask_question(self, question, chat_history=[]):
+    def cache_scope(self, form_id=None):
         """
-        Ask a question about the loaded PDF
+        Get the response cache scope for a form (or the whole corpus)
+        
+        The scope includes the content hash of the form(s) answered from,
+        so replacing a template retires the answers given about it.
+        """
+        if form_id is not None:
+            form = self.corpus.forms.get(form_id)
+            return (form_id, form["content_hash"] if form else None)
+        digest = hashlib.sha256()
+        for loaded_id in sorted(self.corpus.forms):
+            digest.update(f"{loaded_id}:{self.corpus.forms[loaded_id]['content_hash']}\n".encode('utf-8'))
+        return (None, digest.hexdigest())
+
+    def format_result(self, answer, docs):
+        return {
+            "answer": answer,
+            "sources": [doc.page_content[:200] + "..." for doc in docs],
+            "source_pages": [
+                {"form": doc.metadata.get("form"), "page": doc.metadata.get("page"),
+                 "fields": doc.metadata.get("fields", [])}
+                for doc in docs
+            ]
+        }
+
+    def llm_payload(self, prompt):
+        """
+        Build the inference request for a prompt with the LLM's sampling parameters
+        """
+        params = {key: value for key, value in self.llm.default_params.items() if value is not None}
+        return dict(params, prompt=prompt)
+
+    async def aask_question(self, question, chat_history=None, form_id=None):
+        """
+        Ask a question about the loaded PDFs
+        
+        Questions without chat history are looked up in the response cache
+        first, so near-duplicates of earlier questions about the same form
+        skip retrieval and the LLM call.
         
         Args:
             question (str): The question to ask
             chat_history (list): List of previous Q&A pairs
+            form_id (str): Restrict retrieval to this form (defaults to the last loaded PDF)
             
         Returns:
-            dict: Contains the answer and source documents
+            dict: The answer, source snippets and source pages (see format_result())
         """
-        if not self.qa_chain:
-            return "Please load a PDF first using load_pdf()"
+        if self.vector_store is None:
+            return self.format_result("Please load a PDF first using load_pdf()", [])
         
-        result = self.qa_chain({"question": question, "chat_history": chat_history})
+        form_id = form_id or self.active_form
+        cacheable = not chat_history
+        if cacheable:
+            # Follow-ups depend on the conversation, so only first questions are cached
+            scope = self.cache_scope(form_id)
+            cached, vector = await asyncio.to_thread(self.response_cache.get, scope, question, self.embeddings)
+            if cached is not None:
+                return cached
         
-        return {
-            "answer": result["answer"],
-            "sources": [doc.page_content[:200] + "..." for doc in result["source_documents"]]
-        }
+        standalone_question, docs = await self.aretrieve(question, chat_history, form_id)
+        answer = await self.client.complete_text(self.llm_payload(self.answer_prompt(standalone_question, docs, form_id)))
+        
+        response = self.format_result(answer, docs)
+        if cacheable:
+            self.response_cache.put(scope, question, response, self.embeddings, vector)
+        return response
+
+    def ask_question(self, question, chat_history=None, form_id=None):
+        """
+        Blocking wrapper around aask_question(), for callers that are not async
+        """
+        return run_sync(self.aask_question(question, chat_history, form_id))
+
+    async def aretrieve(self, question, chat_history=None, form_id=None):
+        """
+        Run the retrieval half of the QA chain: condense the question with
+        the chat history, then fetch the matching chunks
+        
+        Args:
+            question (str): The question to ask
+            chat_history (list): List of previous Q&A pairs
+            form_id (str): Restrict retrieval to this form (defaults to the last loaded PDF)
+            
+        Returns:
+            tuple: (standalone question, source documents)
+        """
+        from langchain.chains.conversational_retrieval.prompts import CONDENSE_QUESTION_PROMPT
+
+        qa_chain = await self.aget_qa_chain(form_id or self.active_form)
+        chat_history_str = format_chat_history(chat_history)
+        if chat_history_str:
+            prompt = CONDENSE_QUESTION_PROMPT.format(question=question, chat_history=chat_history_str)
+            question = await self.client.complete_text(self.llm_payload(prompt))
+        # Embedding the query is CPU work
+        docs = await asyncio.to_thread(qa_chain.retriever.invoke, question)
+        return question, docs
+
+    def retrieve(self, question, chat_history=None, form_id=None):
+        """
+        Blocking wrapper around aretrieve(), for callers that are not async
+        """
+        return run_sync(self.aretrieve(question, chat_history, form_id))
+
+    def answer_prompt(self, question, docs, form_id=None):
+        """
+        Build the answer prompt the QA chain would send for these documents
+        """
+        from langchain_core.prompts import format_document
+
+        combine_chain = self.get_qa_chain(form_id or self.active_form).combine_docs_chain
+        context = combine_chain.document_separator.join(
+            format_document(doc, combine_chain.document_prompt) for doc in docs
+        )
+        return combine_chain.llm_chain.prompt.format(**{combine_chain.document_variable_name: context,
+                                                        "question": question})
+
+    async def astream_answer(self, question, docs, form_id=None):
+        """
+        Stream the answer to an already retrieved question
+        
+        Args:
+            question (str): The standalone question from retrieve()
+            docs (list): The source documents from retrieve()
+            form_id (str): Form the documents came from
+            
+        Yields:
+            str: Pieces of the answer as they arrive
+        """
+        async for token in self.client.stream_text(self.llm_payload(self.answer_prompt(question, docs, form_id))):
+            yield token
+
+    async def astream_question(self, question, chat_history=None, form_id=None):
+        """
+        Ask a question and stream the answer token by token
+        
+        Retrieval runs first (embedding the query in a thread, as it is CPU
+        work); the caller appends the (question, answer) pair to its chat
+        history once the stream has completed. A cached answer to a first
+        question is yielded whole; a completed stream is added to the cache.
+        
+        Args:
+            question (str): The question to ask
+            chat_history (list): List of previous Q&A pairs
+            form_id (str): Restrict retrieval to this form (defaults to the last loaded PDF)
+            
+        Yields:
+            str: Pieces of the answer as they arrive
+        """
+        if self.vector_store is None:
+            yield "Please load a PDF first using load_pdf()"
+            return
+        
+        form_id = form_id or self.active_form
+        cacheable = not chat_history
+        if cacheable:
+            scope = self.cache_scope(form_id)
+            cached, vector = await asyncio.to_thread(self.response_cache.get, scope, question, self.embeddings)
+            if cached is not None:
+                yield cached["answer"]
+                return
+        
+        original_question = question
+        question, docs = await self.aretrieve(question, chat_history, form_id)
+        answer = []
+        async for token in self.astream_answer(question, docs, form_id):
+            answer.append(token)
+            yield token
+        if cacheable:
+            # Only reached when the stream completed, never for a cancelled one
+            self.response_cache.put(scope, original_question, self.format_result("".join(answer).strip(), docs),
+                                    self.embeddings, vector)
+
+    def stream_question(self, question, chat_history=None, form_id=None):
+        """
+        Blocking generator over astream_question(), for callers that are not async
+        """
+        return iterate_sync(self.astream_question(question, chat_history, form_id))
 
 def main():
     # Get API key from environment variable
-    api_key = "b0222468fe741dec70c263c2db264b97a79e1b8169cc23625c314d316bf09b27"
+    api_key = os.environ.get("TOGETHER_API_KEY")
+    if not api_key:
+        raise SystemExit("Set TOGETHER_API_KEY (any value works against stubServer)")
 
     # Initialize chatbot
     chatbot = PDFChatBot(api_key)
@@ -97,6 +340,7 @@ def main():
     pdf_path = os.path.join(os.path.dirname(__file__), '../public/pdfs', 'FoodHealthPermitApplicationFillable.pdf')
     
     chatbot.load_pdf(pdf_path)
+    print("Startup: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in report_startup().items()))
     
     chat_history = []
     while True:
@@ -104,14 +348,20 @@ def main():
         if question.lower() == 'quit':
             break
             
-        response = chatbot.ask_question(question, chat_history)
-        print("\nAnswer:", response["answer"])
+        # Print the answer as it is generated
+        standalone_question, docs = chatbot.retrieve(question, chat_history)
+        print("\nAnswer: ", end="", flush=True)
+        answer = []
+        for token in iterate_sync(chatbot.astream_answer(standalone_question, docs)):
+            answer.append(token)
+            print(token, end="", flush=True)
+        print()
         print("\nSources:")
-        for i, source in enumerate(response["sources"], 1):
-            print(f"\nSource {i}:", source)
+        for i, doc in enumerate(docs, 1):
+            print(f"\nSource {i}:", doc.page_content[:200] + "...")
             
-        # Update chat history
-        chat_history.append((question, response["answer"]))
+        # Update chat history once the answer is complete
+        chat_history.append((question, "".join(answer).strip()))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
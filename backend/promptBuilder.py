@@ -0,0 +1,172 @@
+import logging
+import threading
+from functools import lru_cache
+
+from formState import display_name
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = "cl100k_base"
+
+# Instructions shared by every turn of every session. Kept byte-identical
+# and at the very start of the prompt so provider-side prompt caching can
+# reuse it; everything that changes per turn comes after it.
+STATIC_PREFIX = (
+    "You are a chatbot designed to guide users through completing a permit form, "
+    "similar to an interactive assistant like TurboTax. "
+    "Use the conversation history and the list of fields still needed "
+    "to ask only necessary questions and gather the required information for each field.\n\n"
+    "Only ask questions about fields that are still needed. "
+    "Do not repeat questions the user has already answered, and focus on one field at a time.\n\n"
+    "If all required information has been collected, acknowledge this and let the user know.\n\n"
+)
+
+QUESTION_SUFFIX = (
+    "Based on the above history and the fields still needed, "
+    "ask the user a relevant question to complete their permit form.\n"
+    "Assistant:"
+)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    """
+    Load the tiktoken encoding once, or return False if it is unavailable
+    (tiktoken not installed, or the BPE file cannot be downloaded).
+    """
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding(DEFAULT_ENCODING)
+            except Exception as e:
+                logger.warning("tiktoken unavailable (%s), estimating tokens as characters / 4", e)
+                _encoding = False
+    return _encoding
+
+
+def load_encoding():
+    """
+    Load the tokenizer now rather than on the first count_tokens() call.
+
+    Loading can download the BPE file (and retry when offline), so servers
+    call this at startup, off the event loop.
+
+    Returns:
+        bool: Whether tiktoken is in use (False: character estimate)
+    """
+    return bool(_get_encoding())
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """
+    Count the tokens in a piece of text.
+
+    Uses tiktoken's cl100k_base, which is close to (but not exactly) the
+    served model's tokenizer; without it, estimates one token per four
+    characters. Results are cached, since history messages are counted
+    again on every turn.
+
+    Args:
+        text (str): The text
+
+    Returns:
+        int: Token count
+    """
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def format_message(msg):
+    return f"{'User' if msg['role'] == 'user' else 'Assistant'}: {msg['content']}"
+
+
+class PromptBuilder:
+    """
+    Builds the next-question prompt within a token budget.
+
+    The prompt is the static prefix, then the fields still missing from the
+    session's form state, a summary of turns that no longer fit, the most
+    recent turns, and the closing instruction. Older turns are summarised
+    from the form state, which already holds every value they provided.
+    """
+
+    def __init__(self, history_budget=512, static_prefix=STATIC_PREFIX, suffix=QUESTION_SUFFIX):
+        """
+        Args:
+            history_budget (int): Tokens allowed for the summary and recent turns
+            static_prefix (str): Instructions shared across turns
+            suffix (str): Closing instruction ending in the assistant cue
+        """
+        self.history_budget = history_budget
+        self.static_prefix = static_prefix
+        self.suffix = suffix
+
+    def fit_history(self, messages, budget):
+        """
+        Split messages into the older ones to summarise and the most recent
+        ones that fit the budget.
+
+        Returns:
+            tuple: (older messages, recent formatted lines)
+        """
+        lines = []
+        used = 0
+        for index in range(len(messages) - 1, -1, -1):
+            line = format_message(messages[index])
+            cost = count_tokens(line) + 1
+            if used + cost > budget:
+                if not lines and budget > 0:
+                    # Always keep the newest message, cut to fit
+                    lines.append(line[:max(budget, 1) * 4])
+                    index -= 1
+                return messages[:index + 1], lines[::-1]
+            lines.append(line)
+            used += cost
+        return [], lines[::-1]
+
+    def summarize(self, older, state):
+        """
+        Summarise turns dropped from the prompt.
+        """
+        if not older:
+            return ""
+        collected = state.filled() if state is not None else {}
+        summary = f"Summary of {len(older)} earlier messages:"
+        if collected:
+            details = "; ".join(f"{display_name(name)}: {value}" for name, value in collected.items())
+            summary += f" the user has provided {details}."
+        else:
+            summary += " no form information was provided."
+        return summary
+
+    def build(self, conversation, state):
+        """
+        Build the prompt for the assistant's next question.
+
+        Args:
+            conversation (list): Messages as {'role', 'content'} dicts
+            state (FormState): The session's form state
+
+        Returns:
+            str: The prompt
+        """
+        missing = [display_name(name) for name in state.missing()] if state is not None else []
+        fields = "Fields still needed:\n" + "\n".join(f"- {name}" for name in missing) + "\n\n"
+
+        older, recent = self.fit_history(conversation, self.history_budget)
+        summary = self.summarize(older, state)
+        if summary and count_tokens(summary) + sum(count_tokens(line) + 1 for line in recent) > self.history_budget:
+            # Make room for the summary by dropping the oldest recent turns;
+            # if the summary alone fills the budget, no turn is kept
+            older, recent = self.fit_history(conversation, self.history_budget - count_tokens(summary))
+            summary = self.summarize(older, state)
+
+        history = "\n".join([summary] + recent if summary else recent)
+        return f"{self.static_prefix}{fields}Conversation history:\n{history}\n\n{self.suffix}"
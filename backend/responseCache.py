@@ -0,0 +1,160 @@
+import copy
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLD = 0.92
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 2048
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize_question(question):
+    """
+    Normalise a question for exact matching (case, punctuation, spacing).
+    """
+    return _SPACE.sub(' ', _PUNCTUATION.sub(' ', question.lower())).strip()
+
+
+class SemanticResponseCache:
+    """
+    Answers to earlier questions, found again by meaning rather than wording.
+
+    Entries are scoped (e.g. by form and its content hash) and matched by
+    cosine similarity between question embeddings, so "what is a PE code?"
+    and "What's the PE code" share an answer. Identical questions (after
+    normalisation) are found without embedding at all. Entries expire after
+    a TTL and the least recently used are evicted beyond max_entries.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES):
+        """
+        Args:
+            threshold (float): Minimum cosine similarity for a hit
+            ttl (float): Seconds an answer stays valid
+            max_entries (int): Entries kept across all scopes
+        """
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # entry id -> (scope, normalised question, unit vector, value, expiry)
+        self._entries = OrderedDict()
+        # scope -> (entry ids, stacked vectors), rebuilt when the scope changes
+        self._matrices = {}
+        self._exact = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def embed(self, question, embeddings):
+        """
+        Embed a question as a unit vector.
+        """
+        vector = np.asarray(embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _remove(self, entry_id):
+        scope, normalized, _, _, _ = self._entries.pop(entry_id)
+        self._matrices.pop(scope, None)
+        if self._exact.get((scope, normalized)) == entry_id:
+            del self._exact[(scope, normalized)]
+
+    def _matrix(self, scope):
+        matrix = self._matrices.get(scope)
+        if matrix is None:
+            ids = [entry_id for entry_id, entry in self._entries.items() if entry[0] == scope]
+            vectors = np.stack([self._entries[entry_id][2] for entry_id in ids]) if ids else None
+            matrix = self._matrices[scope] = (ids, vectors)
+        return matrix
+
+    def _hit(self, entry_id, now):
+        entry = self._entries[entry_id]
+        if entry[4] <= now:
+            self._remove(entry_id)
+            metrics.inc('permitpilot_response_cache_total', 'Response cache lookups', result='expired')
+            return None
+        self._entries.move_to_end(entry_id)
+        metrics.inc('permitpilot_response_cache_total', 'Response cache lookups', result='hit')
+        return copy.deepcopy(entry[3])
+
+    def get(self, scope, question, embeddings):
+        """
+        Look up the answer to a question within a scope.
+
+        Args:
+            scope: Hashable scope, e.g. (form_id, content_hash)
+            question (str): The question
+            embeddings: Embeddings model used for similarity matching
+
+        Returns:
+            tuple: (cached value or None, the question's vector or None) -
+                pass the vector to put() to avoid embedding twice
+        """
+        normalized = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            entry_id = self._exact.get((scope, normalized))
+            if entry_id is not None:
+                value = self._hit(entry_id, now)
+                if value is not None:
+                    return value, None
+
+        vector = self.embed(question, embeddings)
+        with self._lock:
+            ids, vectors = self._matrix(scope)
+            if vectors is not None:
+                similarities = vectors @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    value = self._hit(ids[best], now)
+                    if value is not None:
+                        return value, vector
+        metrics.inc('permitpilot_response_cache_total', 'Response cache lookups', result='miss')
+        return None, vector
+
+    def put(self, scope, question, value, embeddings=None, vector=None):
+        """
+        Store the answer to a question.
+
+        Args:
+            scope: Hashable scope the answer applies to
+            question (str): The question
+            value: The answer (copied on the way in and out)
+            embeddings: Embeddings model, when no vector is given
+            vector (np.ndarray): The question's vector from get()
+        """
+        if vector is None:
+            vector = self.embed(question, embeddings)
+        normalized = normalize_question(question)
+        with self._lock:
+            previous = self._exact.get((scope, normalized))
+            if previous is not None:
+                self._remove(previous)
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (scope, normalized, vector, copy.deepcopy(value), time.time() + self.ttl)
+            self._exact[(scope, normalized)] = entry_id
+            self._matrices.pop(scope, None)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, scope=None):
+        """
+        Drop every entry in a scope, or all entries.
+        """
+        with self._lock:
+            for entry_id in [i for i, entry in self._entries.items() if scope is None or entry[0] == scope]:
+                self._remove(entry_id)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,520 @@
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import time
+import uuid
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+from aiohttp import web
+
+from batchFill import TemplatePool
+from chatForData import FORM_PDF_PATH, SimpleChatBot
+from fieldSchema import form_id_for, get_schema
+from fillPDF import fill_pdf_bytes
+from instrumentation import metrics
+from previewService import DEFAULT_DPI, PreviewService
+from processPDF import PDFChatBot
+from promptBuilder import load_encoding
+from serverSentEvents import aiter_sse, format_sse
+from sessionStore import get_session_store
+from sharedModels import preload, report_startup, startup_stage, startup_timer
+from templateWriter import DEFAULT_CHUNK_SIZE, iter_chunks
+from togetherClient import DEFAULT_API_URL, TogetherClient
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PDF_DIR = os.path.join(os.path.dirname(__file__), '../public/pdfs')
+DEFAULT_MAX_INFLIGHT = 64
+DEFAULT_REQUEST_TIMEOUT = 30.0
+# Seconds between sweeps of expired sessions from the session store
+DEFAULT_SESSION_PURGE_INTERVAL = 300.0
+
+# Routes that must answer even when the service is saturated
+UNLIMITED_PATHS = {'/health', '/metrics'}
+
+
+# Per-process template pool used by the fill workers
+_templates = None
+
+
+def _init_fill_worker(template_paths):
+    global _templates
+    _templates = TemplatePool()
+    for pdf_path in template_paths:
+        _templates.get(pdf_path)
+
+
+def _fill_in_worker(pdf_path, form_data, incremental):
+    """
+    Fill one form in a pool worker.
+
+    Returns:
+        bytes: The filled PDF
+    """
+    if incremental:
+        return fill_pdf_bytes(pdf_path, form_data, incremental=True, name=form_id_for(pdf_path))
+    return _templates.fill_to_bytes(pdf_path, form_data)
+
+
+def json_error(error_class, message, **kwargs):
+    """
+    Build an HTTP error whose body is {"error": message}.
+    """
+    return error_class(text=json.dumps({"error": message}), content_type='application/json', **kwargs)
+
+
+async def read_json(request):
+    """
+    Read a request's JSON object body.
+
+    Raises:
+        web.HTTPBadRequest: If the body is not a JSON object
+    """
+    try:
+        body = await request.json()
+    except ValueError:
+        raise json_error(web.HTTPBadRequest, "Request body must be JSON")
+    if not isinstance(body, dict):
+        raise json_error(web.HTTPBadRequest, "Request body must be a JSON object")
+    return body
+
+
+async def bounded(request, awaitable):
+    """
+    Await CPU or LLM work within the service's request timeout.
+
+    Raises:
+        web.HTTPGatewayTimeout: If the work takes too long
+    """
+    try:
+        return await asyncio.wait_for(awaitable, request.app['request_timeout'])
+    except asyncio.TimeoutError:
+        raise json_error(web.HTTPGatewayTimeout, "Request timed out")
+
+
+@web.middleware
+async def admission_middleware(request, handler):
+    """
+    Reject requests beyond max_inflight with 503 instead of queueing them,
+    and record request counts and latency per route.
+    """
+    app = request.app
+    limited = request.path not in UNLIMITED_PATHS
+    if limited and app['inflight'] >= app['max_inflight']:
+        metrics.inc('permitpilot_http_rejected_total', 'Requests rejected because the service was saturated')
+        raise json_error(web.HTTPServiceUnavailable, "Server busy, retry shortly", headers={'Retry-After': '1'})
+
+    resource = request.match_info.route.resource
+    route = resource.canonical if resource is not None else 'unmatched'
+    start = time.perf_counter()
+    status = 500
+    if limited:
+        app['inflight'] += 1
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if limited:
+            app['inflight'] -= 1
+        metrics.inc('permitpilot_http_requests_total', 'HTTP requests by route and status', route=route,
+                    status=str(status))
+        metrics.observe('permitpilot_http_request_seconds', 'HTTP request time by route',
+                        time.perf_counter() - start, route=route)
+
+
+def _form_path(request):
+    form_id = request.match_info['form_id']
+    pdf_path = request.app['forms'].get(form_id)
+    if pdf_path is None:
+        raise json_error(web.HTTPNotFound, f"Unknown form '{form_id}'")
+    return form_id, pdf_path
+
+
+def _session_lock(app, session_id):
+    # One turn at a time per session, so concurrent requests cannot
+    # overwrite each other's history
+    lock = app['session_locks'].get(session_id)
+    if lock is None:
+        lock = app['session_locks'][session_id] = asyncio.Lock()
+    return lock
+
+
+async def _stream_sse(request, tokens, headers):
+    """
+    Send a token generator as server-sent events.
+
+    Returns:
+        tuple: (prepared response, full text)
+    """
+    response = web.StreamResponse(headers=dict(headers, **{
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+    }))
+    await response.prepare(request)
+    pieces = []
+
+    async def collect():
+        async for token in tokens:
+            pieces.append(token)
+            yield token
+
+    events = aiter_sse(collect())
+    try:
+        async for event in events:
+            await response.write(event)
+    finally:
+        # Closing the token generator cancels the LLM request when the
+        # client disconnected part way
+        await events.aclose()
+        await tokens.aclose()
+    return response, ''.join(pieces)
+
+
+async def list_forms(request):
+    schemas = request.app['schemas']
+    return web.json_response([
+        {"id": form_id, "fields": len(schemas[form_id]) if form_id in schemas else None}
+        for form_id in request.app['forms']
+    ])
+
+
+async def form_schema(request):
+    form_id, pdf_path = _form_path(request)
+    schema = await bounded(request, asyncio.to_thread(get_schema, pdf_path))
+    return web.json_response({
+        "id": form_id,
+        "content_hash": schema.content_hash,
+        "fields": list(schema.fields.values()),
+    })
+
+
+async def fill_form(request):
+    """
+    Fill a form with {"values": {...}, "incremental": false} and stream
+    back the PDF.
+    """
+    form_id, pdf_path = _form_path(request)
+    body = await read_json(request)
+    values = body.get("values")
+    if not isinstance(values, dict):
+        raise json_error(web.HTTPBadRequest, "'values' must be an object of field names to values")
+
+    loop = asyncio.get_running_loop()
+    data = await bounded(request, loop.run_in_executor(
+        request.app['fill_pool'], _fill_in_worker, pdf_path, values, bool(body.get("incremental"))
+    ))
+    response = web.StreamResponse(headers={
+        'Content-Type': 'application/pdf',
+        'Content-Disposition': f'attachment; filename="{form_id}-filled.pdf"',
+    })
+    response.content_length = len(data)
+    await response.prepare(request)
+    for chunk in iter_chunks([data], DEFAULT_CHUNK_SIZE):
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+async def preview(request):
+    """
+    Render one page of a form as an image.
+
+    GET renders the blank template; POST takes {"values": {...}} or
+    {"session_id": ...} (the values a chat session has collected so far).
+    The page, dpi and format come from the query string.
+    """
+    app = request.app
+    form_id, pdf_path = _form_path(request)
+    try:
+        page = int(request.query.get("page", 0))
+        dpi = int(request.query.get("dpi", DEFAULT_DPI))
+    except ValueError:
+        raise json_error(web.HTTPBadRequest, "'page' and 'dpi' must be integers")
+    fmt = request.query.get("format", "png")
+
+    values = None
+    if request.method == 'POST':
+        body = await read_json(request)
+        values = body.get("values")
+        if body.get("session_id"):
+            session = await asyncio.to_thread(app['session_store'].load, body["session_id"])
+            if session is None:
+                raise json_error(web.HTTPNotFound, "Unknown or expired session")
+            values = session.form_state.filled() if session.form_state is not None else {}
+        if values is not None and not isinstance(values, dict):
+            raise json_error(web.HTTPBadRequest, "'values' must be an object of field names to values")
+
+    try:
+        images = await bounded(request, app['preview'].apreview_form(pdf_path, values, [page], dpi, fmt))
+    except ValueError as e:
+        raise json_error(web.HTTPBadRequest, str(e))
+    return web.Response(body=images[page], content_type=f'image/{fmt}', headers={'Cache-Control': 'no-cache'})
+
+
+def _chat_bot(app, form_id):
+    """
+    Create a chat bot that collects the fields of a session's selected form.
+    """
+    pdf_path = app['forms'].get(form_id)
+    if pdf_path is None or form_id == form_id_for(FORM_PDF_PATH):
+        return SimpleChatBot(app['api_key'], client=app['client'])
+    # Only the default form has a curated question list; ask for every text field of the others
+    return SimpleChatBot(app['api_key'], client=app['client'], pdf_path=pdf_path, field_names=None)
+
+
+async def chat(request):
+    """
+    Run one form-filling chat turn: {"message", "form_id"?, "session_id"?,
+    "stream"?}.
+
+    The bot collects the fields of the session's selected form (set here or
+    by /qa), falling back to the default permit form.
+    """
+    app = request.app
+    body = await read_json(request)
+    message = body.get("message")
+    if not isinstance(message, str) or not message.strip():
+        raise json_error(web.HTTPBadRequest, "'message' is required")
+    form_id = body.get("form_id")
+    if form_id is not None and form_id not in app['forms']:
+        raise json_error(web.HTTPNotFound, f"Unknown form '{form_id}'")
+    session_id = body.get("session_id") or uuid.uuid4().hex
+    store = app['session_store']
+
+    async with _session_lock(app, session_id):
+        session = await asyncio.to_thread(store.load_or_create, session_id)
+        if form_id is not None:
+            session.form_id = form_id
+        bot = await asyncio.to_thread(_chat_bot, app, session.form_id)
+        bot.restore_session(session)
+
+        if body.get("stream"):
+            response, _ = await _stream_sse(request, bot.astream_response(message), {'X-Session-Id': session_id})
+            await asyncio.to_thread(store.save, bot.save_session(session))
+            await response.write(format_sse({"session_id": session_id, "form_data": bot.state.filled(),
+                                             "complete": bot.state.is_complete}, event='state'))
+            await response.write_eof()
+            return response
+
+        reply, form_data = await bounded(request, bot.arespond(message))
+        await asyncio.to_thread(store.save, bot.save_session(session))
+    return web.json_response({
+        "session_id": session_id,
+        "response": reply,
+        "form_data": form_data,
+        "complete": bot.state.is_complete,
+    })
+
+
+async def ask(request):
+    """
+    Answer a question about the forms: {"question", "form_id"?,
+    "session_id"?, "stream"?}.
+    """
+    app = request.app
+    qa = app['qa']
+    if qa is None:
+        raise json_error(web.HTTPServiceUnavailable, "Document index is still loading", headers={'Retry-After': '5'})
+    body = await read_json(request)
+    question = body.get("question")
+    if not isinstance(question, str) or not question.strip():
+        raise json_error(web.HTTPBadRequest, "'question' is required")
+    form_id = body.get("form_id")
+    if form_id is not None and form_id not in app['forms']:
+        raise json_error(web.HTTPNotFound, f"Unknown form '{form_id}'")
+    session_id = body.get("session_id") or uuid.uuid4().hex
+    store = app['session_store']
+
+    async with _session_lock(app, session_id):
+        session = await asyncio.to_thread(store.load_or_create, session_id)
+        if form_id is not None:
+            session.form_id = form_id
+        history = list(session.qa_history)
+
+        if body.get("stream"):
+            tokens = qa.astream_question(question, history, session.form_id)
+            response, answer = await _stream_sse(request, tokens, {'X-Session-Id': session_id})
+            session.qa_history.append((question, answer.strip()))
+            await asyncio.to_thread(store.save, session)
+            await response.write_eof()
+            return response
+
+        result = await bounded(request, qa.aask_question(question, history, session.form_id))
+        session.qa_history.append((question, result["answer"]))
+        await asyncio.to_thread(store.save, session)
+    return web.json_response(dict(result, session_id=session_id))
+
+
+async def health(request):
+    app = request.app
+    return web.json_response({
+        "status": "ok",
+        "inflight": app['inflight'],
+        "max_inflight": app['max_inflight'],
+        "forms": len(app['forms']),
+        "qa_ready": app['qa'] is not None,
+        "startup": startup_timer.durations,
+    })
+
+
+async def metrics_endpoint(request):
+    return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+
+async def _load_qa(app):
+    def build():
+        with startup_stage("qa_index"):
+            qa = PDFChatBot(app['api_key'], api_url=app['api_url'])
+            qa.load_corpus(app['pdf_dir'])
+        return qa
+
+    try:
+        app['qa'] = await asyncio.to_thread(build)
+        report_startup()
+    except Exception:
+        logger.exception("Could not load the document index; /qa stays unavailable")
+
+
+async def _purge_sessions(app):
+    # Expired sessions are otherwise only removed when the same session is loaded again
+    while True:
+        await asyncio.sleep(app['session_purge_interval'])
+        try:
+            removed = await asyncio.to_thread(app['session_store'].purge_expired)
+        except Exception:
+            logger.exception("Could not purge expired sessions")
+            continue
+        if removed:
+            logger.info("Purged %d expired sessions", removed)
+
+
+async def _on_startup(app):
+    with startup_stage("tokenizer"):
+        # The first chat prompt would otherwise load it on the event loop
+        await asyncio.to_thread(load_encoding)
+    with startup_stage("schemas"):
+        for form_id, pdf_path in app['forms'].items():
+            try:
+                app['schemas'][form_id] = await asyncio.to_thread(get_schema, pdf_path)
+            except Exception as e:
+                logger.warning("Could not read the field schema of %s: %s", pdf_path, e)
+    # Spawn rather than fork: the parent may have torch and the event loop's
+    # threads running, neither of which is fork-safe
+    app['fill_pool'] = ProcessPoolExecutor(
+        max_workers=app['fill_workers'],
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_fill_worker,
+        initargs=(sorted(app['forms'].values()),)
+    )
+    # Start the workers (and parse the templates) now, not on the first fill
+    for _ in range(app['fill_workers']):
+        app['fill_pool'].submit(os.getpid)
+    # Previews render in the same pool as fills
+    app['preview'] = PreviewService(workers=app['fill_workers'], executor=app['fill_pool'])
+    if app['enable_qa']:
+        app['qa_task'] = asyncio.create_task(_load_qa(app))
+    app['purge_task'] = asyncio.create_task(_purge_sessions(app))
+
+
+async def _on_cleanup(app):
+    if app.get('qa_task') is not None:
+        app['qa_task'].cancel()
+    if app.get('purge_task') is not None:
+        app['purge_task'].cancel()
+    app['fill_pool'].shutdown(wait=False, cancel_futures=True)
+    await app['client'].close()
+    if app['qa'] is not None:
+        await app['qa'].client.close()
+
+
+def create_app(pdf_dir=DEFAULT_PDF_DIR, api_key=None, api_url=None, session_store=None, fill_workers=None,
+               max_inflight=DEFAULT_MAX_INFLIGHT, request_timeout=DEFAULT_REQUEST_TIMEOUT, enable_qa=True,
+               session_purge_interval=DEFAULT_SESSION_PURGE_INTERVAL):
+    """
+    Build the backend HTTP service.
+
+    Fills and page previews run in a process pool, LLM calls on the event loop, and requests
+    beyond max_inflight are turned away with 503 so a burst degrades into
+    fast retries rather than a growing queue.
+
+    Args:
+        pdf_dir (str): Directory of permit templates served as forms
+        api_key (str): Together API key (defaults to TOGETHER_API_KEY)
+        api_url (str): Inference endpoint (defaults to TOGETHER_API_URL or Together's API)
+        session_store (SessionStore): Chat session store (defaults to get_session_store())
+        fill_workers (int): Fill worker processes (defaults to the CPU count)
+        max_inflight (int): Requests handled at once before rejecting with 503
+        request_timeout (float): Seconds allowed for a fill or a non-streamed reply
+        enable_qa (bool): Build the document index in the background and serve /qa
+        session_purge_interval (float): Seconds between sweeps of expired sessions
+
+    Returns:
+        web.Application: The service
+    """
+    app = web.Application(middlewares=[admission_middleware])
+    app['pdf_dir'] = pdf_dir
+    app['forms'] = {form_id_for(path): path for path in sorted(glob.glob(os.path.join(pdf_dir, '*.pdf')))}
+    app['schemas'] = {}
+    app['api_key'] = api_key or os.environ.get("TOGETHER_API_KEY", "")
+    app['api_url'] = api_url or os.environ.get("TOGETHER_API_URL", DEFAULT_API_URL)
+    app['client'] = TogetherClient(app['api_key'], api_url=app['api_url'])
+    app['session_store'] = session_store if session_store is not None else get_session_store()
+    app['session_locks'] = weakref.WeakValueDictionary()
+    app['fill_workers'] = fill_workers or os.cpu_count() or 1
+    app['max_inflight'] = max_inflight
+    app['request_timeout'] = request_timeout
+    app['inflight'] = 0
+    app['enable_qa'] = enable_qa
+    app['qa'] = None
+    app['qa_task'] = None
+    app['session_purge_interval'] = session_purge_interval
+    app['purge_task'] = None
+
+    app.router.add_get('/forms', list_forms)
+    app.router.add_get('/forms/{form_id}/schema', form_schema)
+    app.router.add_post('/forms/{form_id}/fill', fill_form)
+    app.router.add_get('/forms/{form_id}/preview', preview)
+    app.router.add_post('/forms/{form_id}/preview', preview)
+    app.router.add_post('/chat', chat)
+    app.router.add_post('/qa', ask)
+    app.router.add_get('/health', health)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the PermitPilot backend service")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pdf-dir", default=DEFAULT_PDF_DIR)
+    parser.add_argument("--fill-workers", type=int, default=None)
+    parser.add_argument("--max-inflight", type=int, default=DEFAULT_MAX_INFLIGHT)
+    parser.add_argument("--timeout", type=float, default=DEFAULT_REQUEST_TIMEOUT)
+    parser.add_argument("--session-url", default=None, help="'memory' or a SQLAlchemy URL")
+    parser.add_argument("--no-qa", action="store_true", help="Serve forms and chat only")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.no_qa:
+        # Load the embeddings model before serving so the first question
+        # does not pay for it
+        preload()
+    app = create_app(pdf_dir=args.pdf_dir, session_store=get_session_store(args.session_url),
+                     fill_workers=args.fill_workers, max_inflight=args.max_inflight,
+                     request_timeout=args.timeout, enable_qa=not args.no_qa)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import json
+
+
+def format_sse(data, event=None, event_id=None):
+    """
+    Format one server-sent event.
+
+    Args:
+        data: Event payload; strings are sent as-is, anything else as JSON
+        event (str): Event type (omitted for the default 'message' type)
+        event_id (str): Event ID, echoed back by the browser on reconnect
+
+    Returns:
+        bytes: The encoded event, ready to write to a text/event-stream response
+    """
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    # Multi-line payloads need one data field per line
+    lines.extend(f"data: {line}" for line in data.split('\n'))
+    return ('\n'.join(lines) + '\n\n').encode('utf-8')
+
+
+def iter_sse(tokens, done_event='done'):
+    """
+    Wrap a token generator as server-sent events, ending with a done event.
+
+    Args:
+        tokens (iterable): Text pieces
+        done_event (str): Type of the final event, whose data is the full text
+
+    Yields:
+        bytes: Encoded events
+    """
+    pieces = []
+    for token in tokens:
+        pieces.append(token)
+        yield format_sse({"token": token})
+    yield format_sse({"text": ''.join(pieces)}, event=done_event)
+
+
+async def aiter_sse(tokens, done_event='done'):
+    """
+    Async version of iter_sse() for async token generators.
+    """
+    pieces = []
+    async for token in tokens:
+        pieces.append(token)
+        yield format_sse({"token": token})
+    yield format_sse({"text": ''.join(pieces)}, event=done_event)
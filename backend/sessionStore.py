@@ -0,0 +1,365 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from formState import FormState
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_IDLE_TTL = 30 * 60
+DEFAULT_MAX_SESSION_BYTES = 16 * 1024
+DEFAULT_MAX_SESSIONS = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Roles are stored as one letter to keep sessions small
+_ROLE_CODES = {'user': 'u', 'assistant': 'a'}
+_ROLES = {code: role for role, code in _ROLE_CODES.items()}
+
+
+class Session:
+    """
+    Everything a worker needs to continue one applicant's conversation.
+    """
+
+    def __init__(self, session_id=None, conversation=None, form_state=None, form_id=None, qa_history=None):
+        """
+        Args:
+            session_id (str): Session ID (a new random one by default)
+            conversation (list): Form-filling chat messages as {'role', 'content'} dicts
+            form_state (FormState): Values extracted so far
+            form_id (str): Form the applicant selected
+            qa_history (list): (question, answer) pairs from questions about the form
+        """
+        self.session_id = session_id or uuid.uuid4().hex
+        self.conversation = conversation if conversation is not None else []
+        self.form_state = form_state
+        self.form_id = form_id
+        self.qa_history = qa_history if qa_history is not None else []
+
+    def to_dict(self):
+        return {
+            "c": [[_ROLE_CODES.get(msg['role'], msg['role']), msg['content']] for msg in self.conversation],
+            "s": self.form_state.to_dict() if self.form_state is not None else None,
+            "f": self.form_id,
+            "q": [list(pair) for pair in self.qa_history],
+        }
+
+    @classmethod
+    def from_dict(cls, session_id, data):
+        return cls(
+            session_id,
+            conversation=[{"role": _ROLES.get(role, role), "content": content} for role, content in data["c"]],
+            form_state=FormState.from_dict(data["s"]) if data.get("s") is not None else None,
+            form_id=data.get("f"),
+            qa_history=[tuple(pair) for pair in data.get("q", [])],
+        )
+
+
+def encode_session(session):
+    """
+    Serialise a session as zlib-compressed JSON.
+    """
+    return zlib.compress(json.dumps(session.to_dict(), separators=(',', ':')).encode('utf-8'))
+
+
+def decode_session(session_id, blob):
+    return Session.from_dict(session_id, json.loads(zlib.decompress(blob).decode('utf-8')))
+
+
+def encode_bounded(session, max_bytes):
+    """
+    Encode a session within a size cap, dropping its oldest messages and
+    Q&A pairs until it fits.
+
+    The form state is always kept: it already holds every value the dropped
+    messages provided, and the prompt builder summarises from it.
+
+    Args:
+        session (Session): The session, trimmed in place if it is too large
+        max_bytes (int): Cap on the encoded size (None for no cap)
+
+    Returns:
+        bytes: The encoded session
+    """
+    blob = encode_session(session)
+    trimmed = 0
+    while max_bytes and len(blob) > max_bytes and (session.conversation or session.qa_history):
+        # Drop a quarter of the remaining history at a time rather than
+        # re-compressing once per message
+        if session.conversation:
+            drop = max(1, len(session.conversation) // 4)
+            session.conversation = session.conversation[drop:]
+        else:
+            drop = max(1, len(session.qa_history) // 4)
+            session.qa_history = session.qa_history[drop:]
+        trimmed += drop
+        blob = encode_session(session)
+    if trimmed:
+        metrics.inc('permitpilot_session_trimmed_messages_total', 'Messages dropped to fit the session size cap', trimmed)
+    if max_bytes and len(blob) > max_bytes:
+        logger.warning("Session %s is %d bytes after trimming its history", session.session_id, len(blob))
+    return blob
+
+
+class SessionStore(ABC):
+    """
+    Base class for session stores.
+
+    Sessions are saved whole after each turn and expire after idle_ttl
+    seconds without being saved or loaded, so any worker can serve any
+    request; the server calls purge_expired() periodically so abandoned
+    sessions do not accumulate.
+    """
+
+    def __init__(self, idle_ttl=DEFAULT_IDLE_TTL, max_session_bytes=DEFAULT_MAX_SESSION_BYTES):
+        """
+        Args:
+            idle_ttl (float): Seconds a session is kept without activity
+            max_session_bytes (int): Cap on one session's encoded size
+        """
+        self.idle_ttl = idle_ttl
+        self.max_session_bytes = max_session_bytes
+
+    @abstractmethod
+    def load(self, session_id):
+        """
+        Load a session.
+
+        Returns:
+            Session: The session, or None if it does not exist or has expired
+        """
+
+    @abstractmethod
+    def save(self, session):
+        """
+        Save a session, replacing any stored copy.
+        """
+
+    @abstractmethod
+    def delete(self, session_id):
+        """
+        Remove a session if it exists.
+        """
+
+    @abstractmethod
+    def purge_expired(self):
+        """
+        Remove every expired session.
+
+        Returns:
+            int: Number of sessions removed
+        """
+
+    def load_or_create(self, session_id=None):
+        """
+        Load a session, or start a new one if it does not exist or has expired.
+        """
+        session = self.load(session_id) if session_id else None
+        return session if session is not None else Session(session_id)
+
+
+class MemorySessionStore(SessionStore):
+    """
+    Sessions held in process memory as compressed blobs, least recently
+    used first, bounded by both count and total size.
+    """
+
+    def __init__(self, idle_ttl=DEFAULT_IDLE_TTL, max_session_bytes=DEFAULT_MAX_SESSION_BYTES,
+                 max_sessions=DEFAULT_MAX_SESSIONS, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Args:
+            idle_ttl (float): Seconds a session is kept without activity
+            max_session_bytes (int): Cap on one session's encoded size
+            max_sessions (int): Sessions kept before the least recently used is evicted
+            max_bytes (int): Cap on the total size of all sessions
+        """
+        super().__init__(idle_ttl, max_session_bytes)
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        # session_id -> (blob, last access), in access order
+        self._sessions = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def _pop(self, session_id, reason=None):
+        blob, _ = self._sessions.pop(session_id)
+        self._total_bytes -= len(blob)
+        if reason:
+            metrics.inc('permitpilot_sessions_evicted_total', 'Sessions removed by the store', reason=reason)
+
+    def _expire_idle(self, now):
+        # Access order means the idle sessions are all at the front
+        while self._sessions:
+            session_id, (_, accessed) = next(iter(self._sessions.items()))
+            if accessed + self.idle_ttl > now:
+                break
+            self._pop(session_id, 'idle')
+
+    def load(self, session_id):
+        now = time.time()
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            blob, accessed = entry
+            if accessed + self.idle_ttl <= now:
+                self._pop(session_id, 'idle')
+                return None
+            self._sessions[session_id] = (blob, now)
+            self._sessions.move_to_end(session_id)
+        return decode_session(session_id, blob)
+
+    def save(self, session):
+        blob = encode_bounded(session, self.max_session_bytes)
+        now = time.time()
+        with self._lock:
+            if session.session_id in self._sessions:
+                self._pop(session.session_id)
+            self._sessions[session.session_id] = (blob, now)
+            self._total_bytes += len(blob)
+            self._expire_idle(now)
+            while len(self._sessions) > 1 and len(self._sessions) > self.max_sessions:
+                self._pop(next(iter(self._sessions)), 'count')
+            while len(self._sessions) > 1 and self._total_bytes > self.max_bytes:
+                self._pop(next(iter(self._sessions)), 'memory')
+
+    def delete(self, session_id):
+        with self._lock:
+            if session_id in self._sessions:
+                self._pop(session_id)
+
+    def purge_expired(self):
+        with self._lock:
+            before = len(self._sessions)
+            self._expire_idle(time.time())
+            return before - len(self._sessions)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class SQLSessionStore(SessionStore):
+    """
+    Sessions in a SQL database (SQLite by default), shared by every worker
+    that points at it.
+    """
+
+    def __init__(self, url="sqlite:///sessions.db", idle_ttl=DEFAULT_IDLE_TTL,
+                 max_session_bytes=DEFAULT_MAX_SESSION_BYTES):
+        """
+        Args:
+            url (str): SQLAlchemy database URL
+            idle_ttl (float): Seconds a session is kept without activity
+            max_session_bytes (int): Cap on one session's encoded size
+        """
+        import sqlalchemy as sa
+
+        super().__init__(idle_ttl, max_session_bytes)
+        self._sa = sa
+        connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+        self.engine = sa.create_engine(url, connect_args=connect_args)
+        metadata = sa.MetaData()
+        self.table = sa.Table(
+            "chat_sessions", metadata,
+            sa.Column("session_id", sa.String(64), primary_key=True),
+            sa.Column("data", sa.LargeBinary, nullable=False),
+            sa.Column("accessed", sa.Float, nullable=False, index=True),
+        )
+        metadata.create_all(self.engine)
+
+    def load(self, session_id):
+        sa, table = self._sa, self.table
+        now = time.time()
+        with self.engine.begin() as conn:
+            row = conn.execute(sa.select(table.c.data, table.c.accessed).where(table.c.session_id == session_id)).first()
+            if row is None:
+                return None
+            if row.accessed + self.idle_ttl <= now:
+                conn.execute(sa.delete(table).where(table.c.session_id == session_id))
+                metrics.inc('permitpilot_sessions_evicted_total', 'Sessions removed by the store', reason='idle')
+                return None
+            conn.execute(sa.update(table).where(table.c.session_id == session_id).values(accessed=now))
+        return decode_session(session_id, row.data)
+
+    def _upsert(self, values):
+        # A single INSERT ... ON CONFLICT DO UPDATE where the dialect has one
+        dialect = self.engine.dialect.name
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert
+        elif dialect == "postgresql":
+            from sqlalchemy.dialects.postgresql import insert
+        else:
+            return None
+        statement = insert(self.table).values(**values)
+        return statement.on_conflict_do_update(
+            index_elements=[self.table.c.session_id],
+            set_={"data": statement.excluded.data, "accessed": statement.excluded.accessed},
+        )
+
+    def save(self, session):
+        sa, table = self._sa, self.table
+        blob = encode_bounded(session, self.max_session_bytes)
+        values = {"session_id": session.session_id, "data": blob, "accessed": time.time()}
+        upsert = self._upsert(values)
+        if upsert is not None:
+            with self.engine.begin() as conn:
+                conn.execute(upsert)
+            return
+
+        update = sa.update(table).where(table.c.session_id == session.session_id).values(
+            data=blob, accessed=values["accessed"])
+        with self.engine.begin() as conn:
+            if conn.execute(update).rowcount:
+                return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(sa.insert(table).values(**values))
+        except sa.exc.IntegrityError:
+            # Another worker inserted the session between our update and insert
+            with self.engine.begin() as conn:
+                conn.execute(update)
+
+    def delete(self, session_id):
+        with self.engine.begin() as conn:
+            conn.execute(self._sa.delete(self.table).where(self.table.c.session_id == session_id))
+
+    def purge_expired(self):
+        with self.engine.begin() as conn:
+            result = conn.execute(self._sa.delete(self.table).where(self.table.c.accessed <= time.time() - self.idle_ttl))
+        if result.rowcount:
+            metrics.inc('permitpilot_sessions_evicted_total', 'Sessions removed by the store', result.rowcount,
+                        reason='idle')
+        return result.rowcount
+
+    def __len__(self):
+        with self.engine.connect() as conn:
+            return conn.execute(self._sa.select(self._sa.func.count()).select_from(self.table)).scalar()
+
+
+def get_session_store(url=None, **options):
+    """
+    Create the session store configured for this deployment.
+
+    Args:
+        url (str): 'memory' for the in-process store, otherwise a SQLAlchemy
+            database URL (defaults to PERMITPILOT_SESSION_URL, else 'memory')
+        **options: Passed to the store
+
+    Returns:
+        SessionStore: The store
+    """
+    url = url or os.environ.get("PERMITPILOT_SESSION_URL", "memory")
+    if url == "memory":
+        return MemorySessionStore(**options)
+    return SQLSessionStore(url, **options)
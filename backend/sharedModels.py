@@ -0,0 +1,119 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from instrumentation import StageTimer, metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# 'torch', 'onnx' or 'onnx-qint8' (see ingestPipeline.make_embeddings)
+DEFAULT_EMBEDDING_BACKEND = os.environ.get("PERMITPILOT_EMBEDDINGS_BACKEND", "torch")
+
+# Modules behind the QA path, imported on first use rather than at startup
+QA_MODULES = (
+    "langchain_together",
+    "langchain.chains.conversational_retrieval.base",
+    "corpusIndex",
+)
+
+# Time spent in each startup stage of this process
+startup_timer = StageTimer()
+
+_embeddings = {}
+_embeddings_lock = threading.Lock()
+
+
+@contextmanager
+def startup_stage(name):
+    """
+    Time a startup stage, recording it in startup_timer and the
+    permitpilot_startup_seconds metric.
+    """
+    start = time.perf_counter()
+    with startup_timer.stage(name):
+        yield
+    metrics.observe('permitpilot_startup_seconds', 'Process startup time by stage', time.perf_counter() - start,
+                    stage=name)
+
+
+def get_embeddings(model_name=DEFAULT_EMBEDDING_MODEL, backend=None):
+    """
+    Get the process-wide embeddings model, loading it on first use.
+
+    Every chatbot in the process shares one copy of the weights. Loading is
+    serialised by a lock so concurrent first requests load it only once.
+
+    Args:
+        model_name (str): Sentence-transformers model to load
+        backend (str): 'torch', 'onnx' or 'onnx-qint8', as for make_embeddings()
+            (defaults to PERMITPILOT_EMBEDDINGS_BACKEND, else 'torch')
+
+    Returns:
+        HuggingFaceEmbeddings: The shared embeddings model
+    """
+    backend = backend or DEFAULT_EMBEDDING_BACKEND
+    key = (model_name, backend)
+    embeddings = _embeddings.get(key)
+    if embeddings is None:
+        with _embeddings_lock:
+            embeddings = _embeddings.get(key)
+            if embeddings is None:
+                # Deferred so the fill-only path never imports torch
+                from ingestPipeline import make_embeddings
+
+                with startup_stage(f"embeddings:{model_name}"):
+                    embeddings = make_embeddings(model_name, backend=backend)
+                _embeddings[key] = embeddings
+    return embeddings
+
+
+def preload(model_names=(DEFAULT_EMBEDDING_MODEL,), modules=QA_MODULES, warm=True):
+    """
+    Load the QA modules, the prompt tokenizer and the embedding models now
+    instead of on the first request.
+
+    Call this in the parent process before forking workers: the imported
+    code and model weights are then shared copy-on-write rather than loaded
+    again by every worker.
+
+    Args:
+        model_names (tuple): Embedding models to load
+        modules (tuple): Modules to import
+        warm (bool): Embed a short query so lazily initialised buffers are
+            allocated before the fork too
+
+    Returns:
+        dict: Seconds spent in each startup stage so far
+    """
+    for module in modules:
+        with startup_stage(f"import:{module}"):
+            importlib.import_module(module)
+    with startup_stage("tokenizer"):
+        # The chat prompt budget counts tokens; loading may download the BPE file
+        from promptBuilder import load_encoding
+        load_encoding()
+    for model_name in model_names:
+        embeddings = get_embeddings(model_name)
+        if warm:
+            with startup_stage(f"warm:{model_name}"):
+                embeddings.embed_query("permit application")
+    return report_startup()
+
+
+def report_startup():
+    """
+    Log the time spent in each startup stage.
+
+    Returns:
+        dict: Seconds per stage
+    """
+    durations = dict(startup_timer.durations)
+    for name, seconds in durations.items():
+        logger.info("Startup %s: %.3fs", name, seconds)
+    logger.info("Startup total: %.3fs", startup_timer.total)
+    return durations
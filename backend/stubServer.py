@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import json
+import logging
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REPLY = "What is the name of your business?"
+
+
+def create_stub_app(reply=DEFAULT_REPLY, latency=0.0, fail_first=0, fail_status=503, retry_after=None,
+                    token_latency=0.0):
+    """
+    Build a local stand-in for Together's /inference endpoint.
+
+    Args:
+        reply (str): Text returned in every completion
+        latency (float): Seconds to wait before answering, like a real model
+        fail_first (int): Number of initial requests answered with fail_status
+        fail_status (int): Status used for the injected failures (e.g. 429, 503)
+        retry_after (str): Retry-After header sent with the injected failures
+        token_latency (float): Seconds between tokens when streaming
+
+    Returns:
+        web.Application: The stub app; app['requests'] counts requests served and
+            app['cancelled'] streams abandoned by the client
+    """
+    app = web.Application()
+    app['requests'] = 0
+    app['cancelled'] = 0
+
+    async def inference(request):
+        app['requests'] += 1
+        payload = await request.json()
+        if app['requests'] <= fail_first:
+            headers = {'Retry-After': retry_after} if retry_after is not None else None
+            return web.Response(status=fail_status, text="injected failure", headers=headers)
+        if latency:
+            await asyncio.sleep(latency)
+        if payload.get("stream_tokens"):
+            return await stream(request, payload)
+        return web.json_response({
+            "model": payload.get("model"),
+            "output": {"choices": [{"text": reply}]},
+        })
+
+    async def stream(request, payload):
+        # Word-sized tokens as server-sent events, like Together's stream_tokens mode
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        words = reply.split(' ')
+        try:
+            for i, word in enumerate(words):
+                text = word if i == 0 else ' ' + word
+                event = {"choices": [{"text": text}], "token": {"text": text}}
+                await response.write(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+                if token_latency:
+                    await asyncio.sleep(token_latency)
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client stopped reading, as a cancelled stream does
+            logger.info("Client disconnected mid-stream")
+            app['cancelled'] += 1
+        return response
+
+    app.router.add_post('/inference', inference)
+    return app
+
+
+async def start_stub_server(host='127.0.0.1', port=0, **options):
+    """
+    Start the stub server on the running event loop.
+
+    Args:
+        host (str): Interface to bind
+        port (int): Port to bind (0 picks a free port)
+        **options: Passed to create_stub_app()
+
+    Returns:
+        tuple: (web.AppRunner to clean up, inference URL)
+    """
+    runner = web.AppRunner(create_stub_app(**options))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}/inference"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local stub of the Together inference API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--reply", default=DEFAULT_REPLY)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--token-latency", type=float, default=0.0)
+    parser.add_argument("--fail-first", type=int, default=0)
+    parser.add_argument("--fail-status", type=int, default=503)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    app = create_stub_app(reply=args.reply, latency=args.latency, fail_first=args.fail_first,
+                          fail_status=args.fail_status, token_latency=args.token_latency)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+import struct
+
+from pdfrw.objects import PdfArray, PdfDict, PdfString
+
+# Trailer keys describing the source file's own cross-reference layout;
+# they would point at the wrong offsets in a rewritten file
+SOURCE_XREF_KEYS = ('/Prev', '/XRefStm')
+
+# Target size of the pieces handed to a streaming response
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+def format_value(obj):
+    """
+    Format a direct, non-container value the way pdfrw's writer does.
+    """
+    # Objects with an indirect attribute (names, PDF strings, numbers read
+    # from the file) already know their PDF representation
+    if hasattr(obj, 'indirect'):
+        return str(getattr(obj, 'encoded', None) or obj)
+    if isinstance(obj, (str, bytes)):
+        return PdfString.encode(obj)
+    if isinstance(obj, float):
+        return ('%.9f' % obj).rstrip('0').rstrip('.')
+    return str(obj)
+
+
+class ObjectFormatter:
+    """
+    Serializes pdfrw object graphs into numbered indirect objects.
+
+    objnums maps id(obj) -> object number for objects that already have a
+    number; indirect objects seen for the first time get the next free
+    number and are queued so their bodies are formatted too.
+    """
+
+    def __init__(self, objnums, next_objnum):
+        self.objnums = objnums
+        self.next_objnum = next_objnum
+        self.new_objects = []
+        # id(direct dict) -> number of the indirect object it is written inside
+        self.owners = {}
+        self.objects = {}
+        self._current = None
+
+    def reference(self, obj):
+        if isinstance(obj, PdfDict):
+            indirect = obj.indirect or obj.stream is not None
+        else:
+            indirect = getattr(obj, 'indirect', False)
+        if not indirect:
+            if isinstance(obj, PdfDict):
+                self.owners[id(obj)] = self._current
+            return self.format(obj)
+
+        objnum = self.objnums.get(id(obj))
+        if objnum is None:
+            objnum = self.next_objnum
+            self.next_objnum += 1
+            self.objnums[id(obj)] = objnum
+            self.new_objects.append((objnum, obj))
+        return '%d 0 R' % objnum
+
+    def format(self, obj):
+        if isinstance(obj, PdfArray) or (isinstance(obj, (list, tuple)) and not isinstance(obj, PdfDict)):
+            return format_array([self.reference(x) for x in obj], '[%s]')
+        if isinstance(obj, dict):
+            obj = obj if isinstance(obj, PdfDict) else PdfDict(obj)
+            pairs = sorted((getattr(key, 'encoded', None) or key, value) for key, value in obj.iteritems())
+            items = []
+            for key, value in pairs:
+                items.append(key)
+                items.append(self.reference(value))
+            result = format_array(items, '<<%s>>')
+            if obj.stream is not None:
+                result = '%s\nstream\n%s\nendstream' % (result, obj.stream)
+            return result
+        return format_value(obj)
+
+    def drain(self):
+        """
+        Format every newly numbered object, including ones they reference.
+
+        Returns:
+            list: (object number, formatted body) pairs
+        """
+        formatted = []
+        while self.new_objects:
+            objnum, obj = self.new_objects.pop()
+            self.objects[objnum] = obj
+            self._current = objnum
+            formatted.append((objnum, self.format(obj)))
+        return formatted
+
+
+def format_array(items, formatter):
+    """
+    Join formatted items like pdfrw does, wrapping long arrays and dicts
+    onto lines of about 70 characters.
+    """
+    if sum(len(x) for x in items) <= 70:
+        return formatter % ' '.join(items)
+    lines = []
+    count = 1000000
+    for x in items:
+        count += len(x) + 1
+        if count > 71:
+            line = []
+            lines.append(line)
+            count = len(x) + 1
+        line.append(x)
+    return formatter % '\n  '.join(' '.join(line) for line in lines)
+
+
+def _object_bytes(objnum, body):
+    return ('%d 0 obj\n%s\nendobj\n' % (objnum, body)).encode('latin-1')
+
+
+class PreparedTemplate:
+    """
+    A parsed template serialized once, so each filled copy only re-formats
+    the objects a fill changed.
+
+    The pristine document is numbered and formatted up front. render() takes
+    the annotation objects a fill touched, formats just those (plus any new
+    objects they now reference, e.g. appearance streams), splices them in
+    and rebuilds the cross-reference table from the cached object sizes.
+    """
+
+    def __init__(self, template, version='1.3'):
+        """
+        Args:
+            template (PdfReader): The parsed template (must stay pristine between renders)
+            version (str): PDF version written in the header
+        """
+        self.template = template
+        self.header = ('%%PDF-%s\n%%\xe2\xe3\xcf\xd3\n' % version).encode('latin-1')
+
+        self.objnums = {}
+        formatter = ObjectFormatter(self.objnums, 1)
+        # Same traversal order as pdfrw's writer: trailer keys sorted
+        for key, value in sorted(template.iteritems()):
+            if key not in SOURCE_XREF_KEYS and key != '/Size':
+                formatter.reference(value)
+
+        bodies = dict(formatter.drain())
+        self.owners = formatter.owners
+        self.by_objnum = formatter.objects
+        self.object_count = formatter.next_objnum - 1
+        self.objects = [_object_bytes(n, bodies[n]) for n in range(1, self.object_count + 1)]
+
+    def _trailer(self, formatter, size):
+        pairs = [
+            (key, formatter.reference(value))
+            for key, value in sorted(self.template.iteritems())
+            if key not in SOURCE_XREF_KEYS and key != '/Size'
+        ]
+        pairs.append(('/Size', str(size)))
+        items = []
+        for key, value in sorted(pairs):
+            items.append(key)
+            items.append(value)
+        return format_array(items, '<<%s>>')
+
+    def iter_render(self, changed=()):
+        """
+        Serialize the template with its current values, piece by piece.
+
+        Args:
+            changed (iterable): Objects modified since the template was prepared
+
+        Yields:
+            bytes: Consecutive pieces of the PDF (header, objects, xref, trailer)
+        """
+        # Numbers for objects created since preparation live in a per-render
+        # overlay, so the pristine numbering is never modified
+        objnums = dict(self.objnums)
+        formatter = ObjectFormatter(objnums, self.object_count + 1)
+
+        objects = self.objects
+        overrides = {}
+        for obj in changed:
+            objnum = objnums.get(id(obj)) or self.owners.get(id(obj))
+            if objnum is None:
+                raise ValueError("Changed object is not part of the prepared template")
+            if objnum in overrides:
+                continue
+            # A direct dict is re-formatted as part of the object containing it
+            overrides[objnum] = _object_bytes(objnum, formatter.format(self.by_objnum[objnum]))
+        for objnum, body in formatter.drain():
+            overrides[objnum] = _object_bytes(objnum, body)
+
+        trailer = self._trailer(formatter, formatter.next_objnum)
+        for objnum, body in formatter.drain():
+            overrides[objnum] = _object_bytes(objnum, body)
+        total = formatter.next_objnum - 1
+
+        yield self.header
+        offset = len(self.header)
+        xref = [b'0000000000 65535 f\r\n']
+        for objnum in range(1, total + 1):
+            data = overrides.get(objnum) or objects[objnum - 1]
+            xref.append(b'%010d 00000 n\r\n' % offset)
+            yield data
+            offset += len(data)
+
+        yield b'xref\n0 %d\n' % (total + 1) + b''.join(xref)
+        yield ('trailer\n\n%s\nstartxref\n%d\n%%%%EOF\n' % (trailer, offset)).encode('latin-1')
+
+    def render(self, changed=(), output=None):
+        """
+        Serialize the template with its current values.
+
+        Args:
+            changed (iterable): Objects modified since the template was prepared
+            output (file): Binary file object to write to (defaults to a new buffer)
+
+        Returns:
+            bytes: The PDF when no output file is given, otherwise None
+        """
+        parts = self.iter_render(changed)
+        if output is None:
+            return b''.join(parts)
+        for part in parts:
+            output.write(part)
+        return None
+
+
+def iter_chunks(parts, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Regroup a stream of byte pieces into chunks of roughly chunk_size bytes,
+    e.g. for a chunked HTTP response.
+    """
+    pending = []
+    size = 0
+    for part in parts:
+        if len(part) >= chunk_size:
+            # Large pieces (e.g. the original file under an incremental
+            # update) are sliced rather than joined
+            if pending:
+                yield b''.join(pending)
+                pending = []
+                size = 0
+            for start in range(0, len(part), chunk_size):
+                yield part[start:start + chunk_size]
+            continue
+        pending.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield b''.join(pending)
+            pending = []
+            size = 0
+    if pending:
+        yield b''.join(pending)
+
+
+def find_startxref(data):
+    """
+    Get the offset of the last cross-reference section of a PDF file.
+
+    Args:
+        data (bytes): The complete file
+
+    Returns:
+        int: The offset recorded after the final 'startxref'
+    """
+    location = data.rfind(b'startxref')
+    if location < 0:
+        raise ValueError("PDF has no startxref")
+    return int(data[location + len(b'startxref'):].split()[0])
+
+
+def uses_xref_stream(data):
+    """
+    Check whether a file's latest cross-reference section is a stream
+    (PDF 1.5+) rather than a classic xref table.
+    """
+    startxref = find_startxref(data)
+    return not data[startxref:startxref + 32].lstrip().startswith(b'xref')
+
+
+def supports_incremental_update(data, template):
+    """
+    Check whether a file can take an incremental update.
+
+    Encrypted files (which pdfrw cannot write) and files whose trailer is
+    unreadable need a full rewrite.
+    """
+    if template.Encrypt is not None or template.Size is None:
+        return False
+    try:
+        find_startxref(data)
+    except ValueError:
+        return False
+    return True
+
+
+class IncrementalFormatter(ObjectFormatter):
+    """
+    ObjectFormatter that refers to objects read from the source file by
+    their original numbers, numbering only objects created since.
+    """
+
+    def reference(self, obj):
+        key = getattr(obj, 'indirect', None)
+        if isinstance(key, tuple) and id(obj) not in self.objnums:
+            return '%d %d R' % key
+        return super().reference(obj)
+
+
+def _find_owner(template, target):
+    """
+    Find the (number, generation) of the indirect object that holds a
+    direct object, by walking the objects loaded from the file.
+    """
+    for key, obj in list(template.indirect_objects.items()):
+        stack = [obj]
+        while stack:
+            current = stack.pop()
+            if current is target:
+                return key
+            if isinstance(current, PdfDict):
+                children = current.values()
+            elif isinstance(current, PdfArray):
+                children = current
+            else:
+                continue
+            stack.extend(
+                child for child in children
+                if isinstance(child, (PdfDict, PdfArray)) and not isinstance(getattr(child, 'indirect', None), tuple)
+            )
+    return None
+
+
+def _xref_sections(entries):
+    """
+    Group (objnum, offset, generation) entries into contiguous xref subsections.
+    """
+    sections = []
+    for objnum, offset, gen in sorted(entries):
+        if sections and sections[-1][0] + len(sections[-1][1]) == objnum:
+            sections[-1][1].append((offset, gen))
+        else:
+            sections.append((objnum, [(offset, gen)]))
+    return sections
+
+
+def _xref_stream_object(objnum, entries, trailer_pairs):
+    """
+    Format a cross-reference stream object listing entries, which must
+    include the stream object's own entry.
+    """
+    sections = _xref_sections(entries)
+    rows = b''.join(struct.pack('>BIH', 1, offset, gen) for _, section in sections for offset, gen in section)
+    index = ' '.join('%d %d' % (first, len(section)) for first, section in sections)
+    pairs = list(trailer_pairs) + [
+        ('/Type', '/XRef'),
+        ('/W', '[1 4 2]'),
+        ('/Index', '[%s]' % index),
+        ('/Length', str(len(rows))),
+    ]
+    items = []
+    for key, value in sorted(pairs):
+        items.append(key)
+        items.append(value)
+    head = '%d 0 obj\n%s\nstream\n' % (objnum, format_array(items, '<<%s>>'))
+    return head.encode('latin-1') + rows + b'\nendstream\nendobj\n'
+
+
+def iter_incremental_update(data, template, changed):
+    """
+    Append the objects a fill changed to the original file as an
+    incremental update, leaving every original byte in place.
+
+    The update's cross-reference section matches the source: a classic
+    table, or a cross-reference stream for files that use them. Changed
+    objects that lived in object streams are re-written as plain objects.
+
+    Args:
+        data (bytes): The original file the template was parsed from
+        template (PdfReader): The parsed template, already filled
+        changed (iterable): Objects modified by the fill
+
+    Yields:
+        bytes: The original file followed by the update section
+    """
+    if not supports_incremental_update(data, template):
+        raise ValueError("PDF cannot take an incremental update (encrypted or damaged trailer)")
+    prev = find_startxref(data)
+    xref_stream = uses_xref_stream(data)
+    formatter = IncrementalFormatter({}, int(template.Size))
+
+    updated = {}
+    for obj in changed:
+        key = getattr(obj, 'indirect', None)
+        if not isinstance(key, tuple):
+            key = _find_owner(template, obj)
+            if key is None:
+                raise ValueError("Changed object is not part of the template")
+            obj = template.indirect_objects[key]
+        if key not in updated:
+            body = formatter.format(obj)
+            updated[key] = ('%d %d obj\n%s\nendobj\n' % (key[0], key[1], body)).encode('latin-1')
+
+    pairs = [
+        (key, formatter.reference(value))
+        for key, value in template.iteritems()
+        if key in ('/Root', '/Info', '/ID')
+    ]
+    new_objects = dict(formatter.drain())
+    size = max(int(template.Size), formatter.next_objnum)
+    pairs.append(('/Prev', str(prev)))
+
+    yield data
+    if not updated:
+        # Nothing changed: the original file is the result
+        return
+    offset = len(data)
+    if not data.endswith((b'\n', b'\r')):
+        yield b'\n'
+        offset += 1
+    entries = []
+    for (objnum, gen), body in sorted(updated.items()):
+        entries.append((objnum, offset, gen))
+        yield body
+        offset += len(body)
+    for objnum, body in sorted(new_objects.items()):
+        body = _object_bytes(objnum, body)
+        entries.append((objnum, offset, 0))
+        yield body
+        offset += len(body)
+
+    if xref_stream:
+        # The stream object takes the next number and lists itself
+        entries.append((size, offset, 0))
+        pairs.append(('/Size', str(size + 1)))
+        yield _xref_stream_object(size, entries, pairs)
+    else:
+        pairs.append(('/Size', str(size)))
+        items = []
+        for key, value in sorted(pairs):
+            items.append(key)
+            items.append(value)
+        xref = [b'xref\n']
+        for first, rows in _xref_sections(entries):
+            xref.append(b'%d %d\n' % (first, len(rows)))
+            xref.extend(b'%010d %05d n\r\n' % row for row in rows)
+        yield b''.join(xref)
+        yield ('trailer\n%s\n' % format_array(items, '<<%s>>')).encode('latin-1')
+    yield b'startxref\n%d\n%%%%EOF\n' % offset
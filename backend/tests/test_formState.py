@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from formState import FormExtractor, FormState, asked_field, parse_json_object
+from togetherClient import TogetherAPIError
+
+FIELDS = [
+    '(Name of Business DBA)',
+    '(Business Phone)',
+    '(City)',
+    '(Zip)',
+    '(Business EMail)',
+    '(Square Footage)',
+]
+
+
+class ScriptedClient:
+    """
+    Stands in for TogetherClient: returns queued replies and records prompts.
+    """
+
+    def __init__(self, *replies):
+        self.replies = list(replies)
+        self.prompts = []
+
+    async def complete_text(self, payload):
+        self.prompts.append(payload['prompt'])
+        reply = self.replies.pop(0)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+def extract_local(message, state, question=None):
+    return FormExtractor(ScriptedClient(), 'model').extract_local(message, state, question)
+
+
+def test_phone_digits_are_not_taken_as_zip():
+    state = FormState(FIELDS)
+
+    found, _ = extract_local("call 775-555-1234", state)
+
+    assert found == {'(Business Phone)': '(775) 555-1234'}
+
+
+def test_unprompted_zip_only_at_end_of_message():
+    state = FormState(FIELDS)
+
+    assert extract_local("we are at 12345 Main St", state)[0] == {}
+    assert extract_local("123 Main St, Reno 89501", state)[0] == {'(Zip)': '89501'}
+
+
+def test_value_goes_to_the_field_just_asked_about():
+    state = FormState(FIELDS + ['(Owner Phone)'])
+
+    # Two phone fields: only routed when the question names one of them
+    assert extract_local("775 555 1234", state)[0] == {}
+    found, _ = extract_local("775 555 1234", state, "What is the owner phone number?")
+    assert found == {'(Owner Phone)': '(775) 555-1234'}
+
+
+def test_bare_number_is_square_footage_only_when_asked():
+    state = FormState(FIELDS)
+
+    assert extract_local("about 1,200", state)[0] == {}
+    assert extract_local("about 1,200", state, "What is the square footage?")[0] == {'(Square Footage)': '1200'}
+
+
+def test_email_and_remainder():
+    state = FormState(FIELDS)
+
+    found, remainder = extract_local("Email Info@Acme.com please", state)
+
+    assert found == {'(Business EMail)': 'info@acme.com'}
+    assert 'acme' not in remainder.lower()
+
+
+def test_asked_field_matches_question_words():
+    assert asked_field("Which city are you located in?", FIELDS) == '(City)'
+    assert asked_field(None, FIELDS) is None
+
+
+def test_llm_extraction_validates_and_records():
+    client = ScriptedClient('Sure! {"Name of Business DBA": "Acme Diner", "Zip": "not a zip", "City": "Reno"}')
+    state = FormState(FIELDS)
+
+    recorded = asyncio.run(FormExtractor(client, 'model').aextract_llm("Acme Diner in Reno", state))
+
+    assert recorded == {'(Name of Business DBA)': 'Acme Diner', '(City)': 'Reno'}
+    assert state.filled() == recorded
+    # Only the still-missing fields are offered to the model
+    assert '"Zip"' in client.prompts[0]
+
+
+@pytest.mark.parametrize('reply', ['{[1]: 2}', 'no json here', TogetherAPIError('down')])
+def test_llm_extraction_survives_bad_output(reply):
+    state = FormState(FIELDS)
+
+    recorded = asyncio.run(FormExtractor(ScriptedClient(reply), 'model').aextract_llm("hello", state))
+
+    assert recorded == {}
+    assert state.filled() == {}
+
+
+def test_needs_llm_ignores_filler():
+    extractor = FormExtractor(ScriptedClient(), 'model')
+    state = FormState(FIELDS)
+
+    assert not extractor.needs_llm("  it is  ", state)
+    assert extractor.needs_llm("Acme Diner", state)
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"a": 1} and {x}', {'a': 1}),
+    ("Sure! {'b': '12 Main St'} ok", {'b': '12 Main St'}),
+    ('x {"a": {"n": 1}} y', {'a': {'n': 1}}),
+    ('{[1]: 2}', {}),
+    ('{' * 5000, {}),
+    ('nothing', {}),
+])
+def test_parse_json_object(text, expected):
+    assert parse_json_object(text) == expected
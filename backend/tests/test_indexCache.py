@@ -0,0 +1,94 @@
+import os
+
+import pytest
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+from indexCache import IndexCache
+
+PARAMS = {"embedding_model": "fake", "chunk_size": 100, "chunk_overlap": 10}
+
+
+@pytest.fixture
+def embeddings():
+    return DeterministicFakeEmbedding(size=16)
+
+
+def write_pdf(path, content):
+    # The cache only hashes the file, so any bytes stand in for a template
+    with open(path, 'wb') as f:
+        f.write(content)
+    return str(path)
+
+
+def make_store(embeddings, texts):
+    return FAISS.from_texts(texts, embeddings, metadatas=[{"page": i} for i in range(len(texts))])
+
+
+def test_round_trip_keeps_chunks_and_vectors(tmp_path, embeddings):
+    cache = IndexCache(str(tmp_path / "cache"))
+    pdf_path = write_pdf(tmp_path / "form.pdf", b"%PDF-1.4 one")
+    store = make_store(embeddings, ["permit fee", "owner signature"])
+    cache.save(pdf_path, store, **PARAMS)
+
+    loaded = cache.load(pdf_path, embeddings, **PARAMS)
+
+    assert loaded.index.ntotal == 2
+    docs = [loaded.docstore.search(loaded.index_to_docstore_id[i]) for i in range(2)]
+    assert [doc.page_content for doc in docs] == ["permit fee", "owner signature"]
+    assert [doc.metadata["page"] for doc in docs] == [0, 1]
+    assert (loaded.index.reconstruct_n(0, 2) == store.index.reconstruct_n(0, 2)).all()
+
+
+def test_miss_on_different_params(tmp_path, embeddings):
+    cache = IndexCache(str(tmp_path / "cache"))
+    pdf_path = write_pdf(tmp_path / "form.pdf", b"%PDF-1.4 one")
+    cache.save(pdf_path, make_store(embeddings, ["a"]), **PARAMS)
+
+    assert cache.load(pdf_path, embeddings, **dict(PARAMS, chunk_size=200)) is None
+
+
+def test_replaced_template_invalidates_old_entry(tmp_path, embeddings):
+    cache = IndexCache(str(tmp_path / "cache"))
+    pdf_path = write_pdf(tmp_path / "form.pdf", b"%PDF-1.4 one")
+    cache.save(pdf_path, make_store(embeddings, ["old"]), **PARAMS)
+    old_key = cache.make_key(pdf_path, **PARAMS)
+
+    write_pdf(pdf_path, b"%PDF-1.4 two, a longer replacement")
+    os.utime(pdf_path, (1, 1))
+    cache.save(pdf_path, make_store(embeddings, ["new"]), **PARAMS)
+
+    assert cache.make_key(pdf_path, **PARAMS) != old_key
+    assert not os.path.exists(os.path.join(cache.cache_dir, old_key))
+    assert len(list(cache._entries())) == 1
+
+
+def test_evicts_least_recently_used(tmp_path, embeddings):
+    cache = IndexCache(str(tmp_path / "cache"))
+    paths = [write_pdf(tmp_path / f"form{i}.pdf", b"%%PDF-1.4 form %d" % i) for i in range(3)]
+    for path in paths:
+        cache.save(path, make_store(embeddings, ["chunk " * 20]), **PARAMS)
+    sizes = [size for _, _, _, size in cache._entries()]
+
+    # The first entry was used longest ago
+    for age, path in zip((30, 10, 20), paths):
+        meta = os.path.join(cache.cache_dir, cache.make_key(path, **PARAMS), "meta.json")
+        os.utime(meta, (1000 - age, 1000 - age))
+    cache.max_bytes = sum(sizes) - 1
+    cache.evict()
+
+    assert cache.load(paths[1], embeddings, **PARAMS) is not None
+    assert cache.load(paths[2], embeddings, **PARAMS) is not None
+    assert cache.load(paths[0], embeddings, **PARAMS) is None
+
+
+def test_unreadable_entry_is_discarded(tmp_path, embeddings):
+    cache = IndexCache(str(tmp_path / "cache"))
+    pdf_path = write_pdf(tmp_path / "form.pdf", b"%PDF-1.4 one")
+    cache.save(pdf_path, make_store(embeddings, ["a"]), **PARAMS)
+    entry = os.path.join(cache.cache_dir, cache.make_key(pdf_path, **PARAMS))
+    with open(os.path.join(entry, "index.faiss"), 'wb') as f:
+        f.write(b"not an index")
+
+    assert cache.load(pdf_path, embeddings, **PARAMS) is None
+    assert not os.path.exists(entry)
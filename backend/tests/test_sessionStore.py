@@ -0,0 +1,134 @@
+import pytest
+
+import sessionStore
+from formState import FormState
+from sessionStore import (MemorySessionStore, Session, SessionStore, SQLSessionStore, decode_session,
+                          encode_bounded, encode_session)
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(sessionStore.time, 'time', clock)
+    return clock
+
+
+def make_session(session_id='s1', messages=2):
+    state = FormState(['(City)', '(Zip)'], {'(City)': 'Reno'})
+    conversation = [{'role': 'user' if i % 2 == 0 else 'assistant', 'content': f'message {i} ' * 10}
+                    for i in range(messages)]
+    return Session(session_id, conversation, state, form_id='Food', qa_history=[('q?', 'a.')])
+
+
+def test_encode_round_trip():
+    session = make_session()
+
+    decoded = decode_session('s1', encode_session(session))
+
+    assert decoded.conversation == session.conversation
+    assert decoded.form_state.filled() == {'(City)': 'Reno'}
+    assert decoded.form_id == 'Food'
+    assert decoded.qa_history == [('q?', 'a.')]
+
+
+def test_encode_bounded_drops_oldest_messages_first():
+    session = make_session(messages=400)
+    newest = session.conversation[-1]
+
+    blob = encode_bounded(session, 600)
+
+    assert len(blob) <= 600
+    assert 0 < len(session.conversation) < 400
+    assert session.conversation[-1] == newest
+    # The form state is never trimmed
+    assert decode_session('s1', blob).form_state.filled() == {'(City)': 'Reno'}
+
+
+def test_encode_bounded_trims_qa_history_after_conversation():
+    session = make_session(messages=4)
+    session.qa_history = [(f'question {i} ' * 20, f'answer {i} ' * 20) for i in range(400)]
+
+    encode_bounded(session, 600)
+
+    assert session.conversation == []
+    assert 0 < len(session.qa_history) < 400
+    assert session.qa_history[-1][0].startswith('question 399')
+
+
+def test_encode_bounded_leaves_small_sessions_alone():
+    session = make_session(messages=4)
+
+    encode_bounded(session, 16 * 1024)
+
+    assert len(session.conversation) == 4
+
+
+def test_incomplete_store_cannot_be_constructed():
+    class LoadOnly(SessionStore):
+        def load(self, session_id):
+            return None
+
+    with pytest.raises(TypeError):
+        LoadOnly()
+
+
+def test_memory_store_evicts_least_recently_used(clock):
+    store = MemorySessionStore(max_sessions=2)
+    store.save(make_session('a'))
+    store.save(make_session('b'))
+    clock.now += 1
+    store.load('a')
+    store.save(make_session('c'))
+
+    assert store.load('b') is None
+    assert store.load('a') is not None
+    assert store.load('c') is not None
+
+
+def test_memory_store_bounds_total_bytes(clock):
+    size = len(encode_session(make_session('a')))
+    store = MemorySessionStore(max_bytes=size * 2 + size // 2)
+    for session_id in 'abc':
+        store.save(make_session(session_id))
+
+    assert len(store) == 2
+    assert store.total_bytes <= store.max_bytes
+    assert store.load('a') is None
+
+
+def test_memory_store_expires_idle_sessions(clock):
+    store = MemorySessionStore(idle_ttl=60)
+    store.save(make_session('a'))
+    clock.now += 30
+    store.save(make_session('b'))
+    clock.now += 31
+
+    assert store.load('a') is None
+    assert store.purge_expired() == 0
+    clock.now += 30
+    assert store.purge_expired() == 1
+    assert len(store) == 0
+
+
+def test_sql_store_round_trip_and_purge(tmp_path, clock):
+    store = SQLSessionStore(f"sqlite:///{tmp_path / 'sessions.db'}", idle_ttl=60)
+    session = make_session('a')
+    store.save(session)
+    session.form_id = 'Other'
+    store.save(session)
+
+    assert len(store) == 1
+    assert store.load('a').form_id == 'Other'
+
+    store.save(make_session('b'))
+    clock.now += 61
+    assert store.purge_expired() == 2
+    assert len(store) == 0
@@ -0,0 +1,86 @@
+import pymupdf
+import pytest
+from pdfrw import PdfReader
+
+from fillPDF import fill_pdf_bytes, iter_filled_pdf
+from templateWriter import find_startxref, supports_incremental_update, uses_xref_stream
+
+VALUES = {'(Business Name)': "Acme Diner (Reno)", '(City)': 'Reno', '(Agree)': 'Yes'}
+
+
+def make_form(xref_stream):
+    """
+    A one-page form with two text fields and a checkbox, saved with a
+    classic cross-reference table or with object and xref streams.
+    """
+    doc = pymupdf.open()
+    page = doc.new_page()
+    for i, name in enumerate(['Business Name', 'City']):
+        widget = pymupdf.Widget()
+        widget.field_name = name
+        widget.field_type = pymupdf.PDF_WIDGET_TYPE_TEXT
+        widget.rect = pymupdf.Rect(50, 50 + 40 * i, 300, 75 + 40 * i)
+        page.add_widget(widget)
+    widget = pymupdf.Widget()
+    widget.field_name = 'Agree'
+    widget.field_type = pymupdf.PDF_WIDGET_TYPE_CHECKBOX
+    widget.rect = pymupdf.Rect(50, 150, 65, 165)
+    page.add_widget(widget)
+    return doc.tobytes(garbage=1, use_objstms=1 if xref_stream else 0)
+
+
+def read_values(data):
+    doc = pymupdf.open(stream=data, filetype='pdf')
+    return {widget.field_name: widget.field_value for widget in doc[0].widgets()}
+
+
+@pytest.mark.parametrize('xref_stream', [False, True], ids=['xref-table', 'xref-stream'])
+def test_incremental_update_reads_back(xref_stream):
+    template = make_form(xref_stream)
+    assert uses_xref_stream(template) == xref_stream
+    assert supports_incremental_update(template, PdfReader(fdata=template))
+
+    filled = fill_pdf_bytes(template, VALUES, incremental=True)
+
+    # Every original byte stays in place; the update is appended after it
+    assert filled.startswith(template)
+    assert uses_xref_stream(filled) == xref_stream
+    assert find_startxref(filled) > len(template)
+    values = read_values(filled)
+    assert values['Business Name'] == "Acme Diner (Reno)"
+    assert values['City'] == 'Reno'
+    assert values['Agree'] not in (None, '', 'Off')
+
+
+@pytest.mark.parametrize('xref_stream', [False, True], ids=['xref-table', 'xref-stream'])
+def test_full_rewrite_reads_back(xref_stream):
+    filled = fill_pdf_bytes(make_form(xref_stream), VALUES)
+
+    values = read_values(filled)
+    assert values['Business Name'] == "Acme Diner (Reno)"
+    assert values['City'] == 'Reno'
+
+
+def test_fills_leave_cached_template_pristine():
+    template = make_form(False)
+    fill_pdf_bytes(template, VALUES, incremental=True)
+
+    values = read_values(fill_pdf_bytes(template, {'(City)': 'Sparks'}, incremental=True))
+
+    assert values['City'] == 'Sparks'
+    assert values['Business Name'] in (None, '')
+
+
+def test_no_changes_returns_original_file():
+    template = make_form(True)
+
+    assert fill_pdf_bytes(template, {'(Not A Field)': 'x'}, incremental=True) == template
+
+
+def test_chunks_join_to_the_same_file():
+    template = make_form(False)
+
+    chunks = list(iter_filled_pdf(template, VALUES, incremental=True, chunk_size=512))
+
+    assert len(chunks) > 1
+    assert b''.join(chunks) == fill_pdf_bytes(template, VALUES, incremental=True)
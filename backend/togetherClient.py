@@ -0,0 +1,360 @@
+import asyncio
+import email.utils
+import json
+import logging
+import random
+import threading
+import time
+
+import aiohttp
+
+from instrumentation import metrics
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_API_URL = "https://api.together.xyz/inference"
+
+# Statuses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class TogetherAPIError(Exception):
+    """
+    Raised when a Together API call fails after all retries.
+    """
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+def retry_after_seconds(value):
+    """
+    Parse a Retry-After header (delay in seconds or an HTTP date).
+
+    Returns:
+        float: Seconds to wait, or None if the header is missing or invalid
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def sse_data(line):
+    """
+    Get the payload of a server-sent events 'data:' line, or None for
+    blank lines, comments and other fields.
+    """
+    line = line.decode('utf-8') if isinstance(line, bytes) else line
+    line = line.rstrip('\r\n')
+    if not line.startswith('data:'):
+        return None
+    return line[5:].lstrip(' ')
+
+
+def event_text(event):
+    """
+    Get the generated text from one streamed completion event.
+    """
+    choices = event.get('choices')
+    if choices:
+        return choices[0].get('text') or ''
+    return (event.get('token') or {}).get('text') or ''
+
+
+class _LoopThread:
+    """
+    An event loop running in a daemon thread, for driving async code from
+    synchronous callers.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="together-client", daemon=True)
+        self.thread.start()
+
+    def run(self, coro, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+
+_background = None
+_background_lock = threading.Lock()
+
+
+def run_sync(coro, timeout=None):
+    """
+    Run a coroutine on the shared background event loop and wait for it.
+
+    Args:
+        coro: The coroutine to run
+        timeout (float): Seconds to wait for the result
+
+    Returns:
+        The coroutine's result
+    """
+    global _background
+    with _background_lock:
+        if _background is None:
+            _background = _LoopThread()
+    return _background.run(coro, timeout)
+
+
+def iterate_sync(agen, timeout=None):
+    """
+    Drive an async generator on the background loop as a blocking generator.
+
+    Closing the returned generator closes the async one, so abandoning a
+    stream cancels the underlying request.
+
+    Args:
+        agen: The async generator
+        timeout (float): Seconds to wait for each item
+
+    Yields:
+        The async generator's items
+    """
+    try:
+        while True:
+            try:
+                yield run_sync(agen.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(agen.aclose())
+
+
+class TogetherClient:
+    """
+    Asyncio client for Together's inference API.
+
+    Connections are pooled and kept alive per event loop, requests are
+    bounded by a semaphore, and 429/5xx responses and connection errors are
+    retried with exponential backoff (honouring Retry-After). The *_sync
+    methods run the same code on a shared background loop for callers that
+    are not async.
+    """
+
+    def __init__(self, api_key, api_url=DEFAULT_API_URL, timeout=30.0, connect_timeout=5.0, max_retries=3,
+                 backoff=0.5, max_backoff=8.0, max_concurrency=16, pool_size=32, keepalive_timeout=60.0,
+                 stream_timeout=30.0):
+        """
+        Args:
+            api_key (str): Together API key
+            api_url (str): Inference endpoint (point at stubServer for local testing)
+            timeout (float): Total seconds allowed per request attempt
+            connect_timeout (float): Seconds allowed to open a connection
+            max_retries (int): Retries after the first attempt
+            backoff (float): Base delay in seconds, doubled on each retry
+            max_backoff (float): Cap on a single retry delay
+            max_concurrency (int): Requests in flight at once per event loop
+            pool_size (int): Pooled connections per event loop
+            keepalive_timeout (float): Seconds an idle connection is kept open
+            stream_timeout (float): Seconds a stream may go without sending anything
+        """
+        self.api_url = api_url
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_concurrency = max_concurrency
+        self.pool_size = pool_size
+        self.keepalive_timeout = keepalive_timeout
+        self.stream_timeout = stream_timeout
+        # event loop -> (session, semaphore); aiohttp sessions and asyncio
+        # semaphores are bound to the loop they are first used on
+        self._loops = {}
+
+    async def _state(self):
+        loop = asyncio.get_running_loop()
+        # Sessions of loops that have since closed (asyncio.run() calls, test
+        # loops) can no longer be used; drop them so they are not kept forever
+        for stale in [other for other in self._loops if other.is_closed()]:
+            session, _ = self._loops.pop(stale)
+            # With its loop closed this only marks the session and connector
+            # closed; their sockets are freed with them
+            await session.close()
+        state = self._loops.get(loop)
+        if state is None or state[0].closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_timeout)
+            session = aiohttp.ClientSession(connector=connector, headers=self.headers, timeout=self.timeout)
+            state = self._loops[loop] = (session, asyncio.Semaphore(self.max_concurrency))
+        return state
+
+    def _delay(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        # Jitter keeps simultaneous retries from synchronising
+        return delay * (0.5 + random.random() / 2)
+
+    async def _request(self, session, payload, timeout=None):
+        """
+        POST a payload, retrying transient failures.
+
+        Returns:
+            aiohttp.ClientResponse: A successful response, still open; the
+                caller must release or close it
+
+        Raises:
+            TogetherAPIError: On a non-retryable error or when retries run out
+        """
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            retry_after = None
+            status = 'error'
+            start = time.perf_counter()
+            try:
+                response = await session.post(self.api_url, json=payload, timeout=timeout or self.timeout)
+                status = response.status
+                if status < 400:
+                    return response
+                text = await response.text()
+                response.release()
+                if status not in RETRY_STATUSES:
+                    raise TogetherAPIError(f"HTTP {status}: {text}", status)
+                retry_after = retry_after_seconds(response.headers.get("Retry-After"))
+                last_error = TogetherAPIError(f"HTTP {status}: {text}", status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                last_error = TogetherAPIError(f"{type(e).__name__}: {e}")
+            finally:
+                metrics.observe('permitpilot_llm_request_seconds', 'Together API time to response headers',
+                                time.perf_counter() - start)
+                metrics.inc('permitpilot_llm_requests_total', 'Together API requests by status', status=str(status))
+
+            if attempt < self.max_retries:
+                delay = self._delay(attempt, retry_after)
+                logger.warning("Together request failed (%s), retrying in %.2fs", last_error, delay)
+                await asyncio.sleep(delay)
+        raise last_error
+
+    async def complete(self, payload):
+        """
+        POST a payload to the inference endpoint, retrying transient failures.
+
+        Args:
+            payload (dict): Request body (model, prompt, sampling parameters)
+
+        Returns:
+            dict: The decoded JSON response
+
+        Raises:
+            TogetherAPIError: If the request still fails after all retries
+        """
+        session, semaphore = await self._state()
+        async with semaphore:
+            response = await self._request(session, payload)
+            try:
+                return await response.json()
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                raise TogetherAPIError(f"{type(e).__name__}: {e}")
+            finally:
+                response.release()
+
+    async def complete_text(self, payload):
+        """
+        Get the generated text for a payload.
+
+        Returns:
+            str: The first choice's text, stripped
+
+        Raises:
+            TogetherAPIError: If the request fails or the response has no choices
+        """
+        result = await self.complete(payload)
+        if 'output' in result and 'choices' in result['output']:
+            return result['output']['choices'][0]['text'].strip()
+        raise TogetherAPIError("Unexpected API response format")
+
+    async def stream_text(self, payload):
+        """
+        Stream generated text as it arrives, using Together's server-sent
+        events mode (stream_tokens).
+
+        Only opening the stream is retried; once tokens have been yielded a
+        failure is raised to the caller. Closing the generator early (e.g.
+        the user disconnected) drops the connection, which stops generation.
+
+        Args:
+            payload (dict): Request body (model, prompt, sampling parameters)
+
+        Yields:
+            str: Pieces of generated text
+
+        Raises:
+            TogetherAPIError: If the stream cannot be opened or fails part way
+        """
+        session, semaphore = await self._state()
+        payload = dict(payload, stream_tokens=True)
+        # No total deadline for a stream, only a limit on the gap between events
+        timeout = aiohttp.ClientTimeout(total=None, connect=self.timeout.connect, sock_read=self.stream_timeout)
+        async with semaphore:
+            start = time.perf_counter()
+            response = await self._request(session, payload, timeout=timeout)
+            completed = False
+            first = True
+            try:
+                async for line in response.content:
+                    data = sse_data(line)
+                    if data is None:
+                        continue
+                    if data == '[DONE]':
+                        break
+                    event = json.loads(data)
+                    if 'error' in event:
+                        raise TogetherAPIError(f"Stream error: {event['error']}")
+                    text = event_text(event)
+                    if text:
+                        if first:
+                            metrics.observe('permitpilot_llm_first_token_seconds', 'Together API time to first token',
+                                            time.perf_counter() - start)
+                            first = False
+                        yield text
+                completed = True
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                raise TogetherAPIError(f"{type(e).__name__}: {e}")
+            finally:
+                # A finished stream can go back to the pool; an abandoned one
+                # must be closed so the server stops generating
+                if completed:
+                    response.release()
+                else:
+                    response.close()
+
+    def stream_text_sync(self, payload, timeout=None):
+        """
+        Blocking generator over stream_text(), for callers that are not async.
+        """
+        return iterate_sync(self.stream_text(payload), timeout)
+
+    async def close(self):
+        """
+        Close the pooled connections opened on the running event loop.
+        """
+        state = self._loops.pop(asyncio.get_running_loop(), None)
+        if state is not None:
+            await state[0].close()
+
+    def complete_sync(self, payload, timeout=None):
+        return run_sync(self.complete(payload), timeout)
+
+    def complete_text_sync(self, payload, timeout=None):
+        return run_sync(self.complete_text(payload), timeout)
+
+    def close_sync(self):
+        """
+        Close the pooled connections used by the *_sync methods.
+        """
+        if _background is not None:
+            run_sync(self.close())